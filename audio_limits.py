@@ -0,0 +1,19 @@
+"""Telegram's size limit for audio, and what the download Lambda does with
+tracks that don't fit. Shared by the bot and the download Lambda (which gets a
+copy from deploy-lambda.sh), so the bot only turns away what the Lambda would.
+"""
+
+import os
+
+MAX_FILE_SIZE = int(50e6)  # 50MB, Telegram's limit for bots
+MIN_AUDIO_BITRATE = 32  # kbps, below this files are split or rejected, not shrunk
+SIZE_MARGIN = 0.95  # Bitrates are averages, leave some headroom under the limit
+# Send tracks too long for MIN_AUDIO_BITRATE in parts, rather than rejecting
+# them. Set it the same for the bot and the download Lambda.
+SPLIT_LARGE_FILES = os.environ.get("SPLIT_LARGE_FILES", "true").lower() == "true"
+
+
+def too_long(duration, max_size=MAX_FILE_SIZE) -> bool:
+    """Whether `duration` seconds wouldn't fit in `max_size` even at
+    MIN_AUDIO_BITRATE"""
+    return duration * MIN_AUDIO_BITRATE * 125 > max_size * SIZE_MARGIN
@@ -0,0 +1,242 @@
+import asyncio
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from uuid import uuid4
+
+import boto3
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.config import Config
+
+AWS_REGION = "eu-west-2"
+AWS_PROFILE = "LambdaFlowFullAccess"
+MAX_AWS_CONNECTIONS = 10
+
+
+class AwsBackend:
+    def __init__(
+        self,
+        sqs_queue,
+        sns_topic,
+        new_users_table,
+        errors_table,
+        max_connections=MAX_AWS_CONNECTIONS,
+        profile_name=AWS_PROFILE,
+        region_name=AWS_REGION,
+    ):
+        session = boto3.Session(profile_name=profile_name)
+        config = Config(max_pool_connections=max_connections)
+        self.sqs_client = session.client("sqs", region_name=region_name, config=config)
+        self.sns_client = session.client("sns", region_name=region_name, config=config)
+        self.dynamodb = session.resource(
+            "dynamodb", region_name=region_name, config=config
+        )
+        self.new_users_table = self.dynamodb.Table(new_users_table)
+        self.errors_table = self.dynamodb.Table(errors_table)
+        self.sns_topic = sns_topic
+        self.queue_url = self.sqs_client.get_queue_url(QueueName=sqs_queue)["QueueUrl"]
+
+    def put_new_user(self, user_id, message_id):
+        self.new_users_table.put_item(
+            Item={"user_id": user_id, "message_id": message_id}
+        )
+
+    def get_new_user(self, user_id):
+        row = self.new_users_table.get_item(Key={"user_id": user_id})
+        return row["Item"] if "Item" in row else None
+
+    def delete_new_user(self, user_id):
+        self.new_users_table.delete_item(Key={"user_id": user_id})
+
+    def _paginate(self, method, **kwargs):
+        """Every item from a query or scan, not just its first 1MB page"""
+        items = []
+        while True:
+            response = method(**kwargs)
+            items.extend(response["Items"])
+            if "LastEvaluatedKey" not in response:
+                return items
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def query_errors(self, chat_id):
+        return self._paginate(
+            self.errors_table.query, KeyConditionExpression=Key("chat_id").eq(chat_id)
+        )
+
+    def scan_due_errors(self, now, max_attempts):
+        """Errors in every chat that are due another attempt. Rows from before
+        attempts were counted have neither attribute, and are due."""
+        return self._paginate(
+            self.errors_table.scan,
+            FilterExpression=(
+                Attr("next_retry").not_exists() | Attr("next_retry").lte(int(now))
+            )
+            & (Attr("attempts").not_exists() | Attr("attempts").lt(max_attempts)),
+        )
+
+    def put_errors(self, items):
+        with self.errors_table.batch_writer() as batch:
+            for item in items:
+                batch.put_item(Item=item)
+
+    def delete_errors(self, items):
+        # BatchWriteItem, 25 deletes a request, resending unprocessed items
+        with self.errors_table.batch_writer() as batch:
+            for item in items:
+                batch.delete_item(
+                    Key={"chat_id": item["chat_id"], "message_id": item["message_id"]}
+                )
+
+    def publish(self, message, attributes):
+        self.sns_client.publish(
+            TopicArn=self.sns_topic, Message=message, MessageAttributes=attributes
+        )
+
+    def publish_batch(self, entries):
+        return self.sns_client.publish_batch(
+            TopicArn=self.sns_topic, PublishBatchRequestEntries=entries
+        )
+
+    def send_message_batch(self, entries):
+        return self.sqs_client.send_message_batch(
+            QueueUrl=self.queue_url, Entries=entries
+        )
+
+
+class InMemoryBackend:
+    """Offline stand-in for AwsBackend. `latency` seconds are slept on every call
+    to mimic an AWS round trip; published messages are kept in `published`."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.new_users = {}
+        self.errors = defaultdict(dict)
+        self.published = []
+        self.queue_url = f"memory://{uuid4()}"
+
+    def _round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def put_new_user(self, user_id, message_id):
+        self._round_trip()
+        with self.lock:
+            self.new_users[user_id] = {"user_id": user_id, "message_id": message_id}
+
+    def get_new_user(self, user_id):
+        self._round_trip()
+        with self.lock:
+            return self.new_users.get(user_id)
+
+    def delete_new_user(self, user_id):
+        self._round_trip()
+        with self.lock:
+            self.new_users.pop(user_id, None)
+
+    def put_error(self, chat_id, message_id, video_url, attempts=0, next_retry=0):
+        with self.lock:
+            self.errors[chat_id][message_id] = {
+                "chat_id": chat_id,
+                "message_id": message_id,
+                "video_url": video_url,
+                "attempts": attempts,
+                "next_retry": next_retry,
+            }
+
+    def put_errors(self, items):
+        self._round_trip()
+        with self.lock:
+            for item in items:
+                self.errors[item["chat_id"]][item["message_id"]] = dict(item)
+
+    def query_errors(self, chat_id):
+        self._round_trip()
+        with self.lock:
+            return list(self.errors[chat_id].values())
+
+    def scan_due_errors(self, now, max_attempts):
+        self._round_trip()
+        with self.lock:
+            return [
+                item
+                for errors in self.errors.values()
+                for item in errors.values()
+                if item["next_retry"] <= now and item["attempts"] < max_attempts
+            ]
+
+    def delete_errors(self, items):
+        self._round_trip()
+        with self.lock:
+            for item in items:
+                self.errors[item["chat_id"]].pop(item["message_id"], None)
+
+    def publish(self, message, attributes):
+        self._round_trip()
+        with self.lock:
+            self.published.append({"Message": message, "MessageAttributes": attributes})
+
+    def publish_batch(self, entries):
+        self._round_trip()
+        with self.lock:
+            self.published.extend(entries)
+        return {"Successful": [{"Id": entry["Id"]} for entry in entries], "Failed": []}
+
+    def send_message_batch(self, entries):
+        return self.publish_batch(entries)
+
+
+class AsyncStore:
+    """Awaitable access to the bot's AWS resources.
+
+    The blocking boto3 calls run on a bounded thread pool (sized like the boto3
+    connection pools), so a slow DynamoDB or SNS round trip only holds up the
+    handler that made it. Pass an `InMemoryBackend` to run handlers offline.
+    """
+
+    def __init__(self, backend, max_workers=MAX_AWS_CONNECTIONS):
+        self.backend = backend
+        self.executor = ThreadPoolExecutor(max_workers, thread_name_prefix="aws-io")
+
+    @property
+    def queue_url(self):
+        return self.backend.queue_url
+
+    async def _run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(fn, *args))
+
+    async def save_init_message_data(self, user_id, message_id):
+        await self._run(self.backend.put_new_user, user_id, message_id)
+
+    async def get_init_message_data(self, user_id):
+        return await self._run(self.backend.get_new_user, user_id)
+
+    async def delete_init_message_data(self, user_id):
+        await self._run(self.backend.delete_new_user, user_id)
+
+    async def query_errors(self, chat_id):
+        return await self._run(self.backend.query_errors, chat_id)
+
+    async def scan_due_errors(self, now, max_attempts):
+        return await self._run(self.backend.scan_due_errors, now, max_attempts)
+
+    async def put_errors(self, items):
+        await self._run(self.backend.put_errors, items)
+
+    async def delete_errors(self, items):
+        await self._run(self.backend.delete_errors, items)
+
+    async def publish(self, message, attributes):
+        await self._run(self.backend.publish, message, attributes)
+
+    async def publish_batch(self, entries):
+        return await self._run(self.backend.publish_batch, entries)
+
+    async def send_message_batch(self, entries):
+        return await self._run(self.backend.send_message_batch, entries)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,142 @@
+"""Import cost of each entry point, the part of a cold start the code controls.
+
+Every entry point is imported in a fresh interpreter under `python -X
+importtime`, `--repeat` times, after one untimed run to write the .pyc files.
+
+    python bench/coldstart.py --json coldstart.json
+    python bench/coldstart.py --baseline coldstart.json
+
+Reports the median import time per entry point, the packages that cost most
+and whether any module kept off that path (e.g. yt-dlp in the download
+Lambda, which only needs it once a track isn't cached) was loaded. With
+`--baseline` it exits non-zero when an entry point got more than `--tolerance`
+slower than the baseline, or loaded a module it shouldn't.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from collections import Counter
+from pathlib import Path
+from typing import NamedTuple
+
+import lambdas
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+class EntryPoint(NamedTuple):
+    directory: str
+    module: str
+    # Modules that should only be imported on the paths that use them
+    deferred: tuple[str, ...] = ()
+
+
+ENTRY_POINTS = {
+    "download": EntryPoint("dlbot-lambda", "app", ("yt_dlp", "mutagen", "requests")),
+    "worker": EntryPoint("dlbot-lambda", "worker", ("yt_dlp", "mutagen")),
+    "send": EntryPoint("dlbot-send-lambda", "app", ("yt_dlp", "mutagen")),
+    "bot": EntryPoint(".", "telegram_bot", ("yt_dlp",)),
+}
+
+
+def parse_importtime(output, module):
+    """(total ms for `module`, self ms per top level package) from -X importtime"""
+    total = None
+    packages = Counter()
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line.removeprefix("import time:").split("|")
+        packages[name.strip().split(".")[0]] += int(own) / 1000
+        if name.rstrip() == f" {module}":
+            total = int(cumulative) / 1000
+    return total, packages
+
+
+def measure(entry: EntryPoint, repeat) -> dict:
+    totals = []
+    packages = Counter()
+    for run in range(repeat + 1):
+        code = (
+            f"import json, sys, {entry.module}; "
+            f"print(json.dumps([m for m in {entry.deferred!r} if m in sys.modules]))"
+        )
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            cwd=ROOT / entry.directory,
+            # The modules shared with the bot, copied into the images on deploy
+            env={**os.environ, "PYTHONPATH": str(ROOT)},
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode:
+            raise RuntimeError(f"Importing {entry.module} failed:\n{result.stderr}")
+        if not run:
+            continue  # Wrote the .pyc files
+        total, run_packages = parse_importtime(result.stderr, entry.module)
+        totals.append(total)
+        packages.update(run_packages)
+    return {
+        "import_ms": round(statistics.median(totals), 1),
+        "min_ms": round(min(totals), 1),
+        "max_ms": round(max(totals), 1),
+        "heaviest_packages_ms": {
+            name: round(ms / repeat, 1) for name, ms in packages.most_common(8)
+        },
+        "deferred_loaded": json.loads(result.stdout.splitlines()[-1]),
+    }
+
+
+def regressions(report, baseline, tolerance) -> list[str]:
+    problems = []
+    for name, result in report.items():
+        if result["deferred_loaded"]:
+            problems.append(f"{name} imports {', '.join(result['deferred_loaded'])}")
+        if name in baseline:
+            limit = baseline[name]["import_ms"] * (1 + tolerance)
+            if result["import_ms"] > limit:
+                problems.append(
+                    f"{name} imports in {result['import_ms']}ms, "
+                    f"baseline {baseline[name]['import_ms']}ms"
+                )
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--only", choices=sorted(ENTRY_POINTS), action="append", help="Entry points"
+    )
+    parser.add_argument("--json", help="Also write the report to this file")
+    parser.add_argument("--baseline", help="Report from an earlier --json run")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Fraction")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="dlbot-coldstart-") as workdir:
+        lambdas.configure_environment(workdir)
+        report = {
+            name: measure(entry, args.repeat)
+            for name, entry in ENTRY_POINTS.items()
+            if not args.only or name in args.only
+        }
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(output)
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = regressions(report, json.load(f), args.tolerance)
+        for problem in problems:
+            print(f"REGRESSION: {problem}", file=sys.stderr)
+        sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+"""In-process stand-ins for the services the bot and the Lambdas talk to.
+
+Each fake sleeps for a configurable latency (plus transfer time for payloads)
+and counts what it did in `stats`, so a load test sees realistic waiting without
+any network access.
+"""
+
+import asyncio
+import hashlib
+import io
+import itertools
+import os
+import random
+import shutil
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from typing import NamedTuple
+
+from telegram import Audio, Chat, ChatMember, InputFile, Message, MessageId, User
+from telegram.error import BadRequest, RetryAfter
+
+MB = 1024**2
+
+stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def count(name, seconds=0.0, nbytes=0):
+    with _stats_lock:
+        stats[f"{name}.calls"] += 1
+        stats[f"{name}.seconds"] += seconds
+        stats[f"{name}.bytes"] += nbytes
+
+
+def take_stats() -> dict:
+    """Counters since the last call, e.g. per Lambda invocation"""
+    with _stats_lock:
+        snapshot = dict(stats)
+        stats.clear()
+    return snapshot
+
+
+class Latency(NamedTuple):
+    request: float  # Seconds per round trip
+    bandwidth: float  # Bytes per second for payloads
+
+    def delay(self, nbytes=0) -> float:
+        return self.request * random.uniform(0.5, 1.5) + nbytes / self.bandwidth
+
+
+TELEGRAM_LATENCY = Latency(0.15, 20 * MB)
+S3_LATENCY = Latency(0.03, 80 * MB)
+DYNAMODB_LATENCY = Latency(0.01, 100 * MB)
+SOURCE_LATENCY = Latency(0.5, 10 * MB)  # yt-dlp extraction and media download
+
+
+# MPEG-1 Layer III, 128kbps, 44.1kHz: a 4 byte header and 413 bytes of silence
+MP3_FRAME = b"\xff\xfb\x90\x00" + bytes(413)
+MP3_FRAME_SECONDS = 1152 / 44100
+
+
+def synthetic_mp3(filename, duration):
+    """Write `duration` seconds of silent 128kbps MP3 that mutagen and ffmpeg
+    can read like a real download"""
+    frames = int(duration / MP3_FRAME_SECONDS)
+    chunk = MP3_FRAME * 1000
+    tmp = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "wb") as f:
+        for _ in range(frames // 1000):
+            f.write(chunk)
+        f.write(MP3_FRAME * (frames % 1000))
+    os.replace(tmp, filename)
+
+
+class TelegramLimits:
+    """Telegram's flood limits: roughly one message per second per chat and 30
+    per second overall, answered with RetryAfter when exceeded"""
+
+    def __init__(self, per_chat=1.0, overall=30.0):
+        self.per_chat = per_chat
+        self.overall = overall
+        self.lock = threading.Lock()
+        self.sent = defaultdict(list)
+
+    def check(self, chat_id):
+        now = time.monotonic()
+        with self.lock:
+            for key, limit in ((chat_id, self.per_chat), (None, self.overall)):
+                recent = [t for t in self.sent[key] if t > now - 1]
+                self.sent[key] = recent
+                if len(recent) >= max(limit, 1):
+                    count("telegram.retry_after")
+                    raise RetryAfter(1)
+            self.sent[chat_id].append(now)
+            self.sent[None].append(now)
+
+
+class FakeBot:
+    """The parts of telegram.Bot the bot and both Lambdas use.
+
+    Placeholders get unique message IDs across processes. `edit_message_media`
+    with an audio file or file_id counts as a delivery and is appended to
+    `deliveries` as (chat_id, message_id, wall clock time).
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, latency=TELEGRAM_LATENCY, limits: TelegramLimits = None):
+        self.latency = latency
+        self.limits = limits
+        self.deliveries = []
+        self.failures = []
+        self.username = "dlbot_bench"
+
+    def _next_id(self):
+        return os.getpid() * 1_000_000 + next(self._ids)
+
+    async def _call(self, name, chat_id=None, nbytes=0):
+        if self.limits is not None and chat_id is not None:
+            self.limits.check(chat_id)
+        seconds = self.latency.delay(nbytes)
+        await asyncio.sleep(seconds)
+        count(f"telegram.{name}", seconds, nbytes)
+
+    def _message(self, chat_id, message_id=None, audio_id=None):
+        return Message(
+            message_id=message_id or self._next_id(),
+            date=datetime.now(timezone.utc),
+            chat=Chat(int(chat_id), Chat.PRIVATE),
+            audio=(
+                Audio(audio_id, audio_id, duration=0) if audio_id is not None else None
+            ),
+        )
+
+    async def initialize(self):
+        pass
+
+    async def get_me(self):
+        await self._call("get_me")
+        return User(1, self.username, is_bot=True, username=self.username)
+
+    async def get_chat_member(self, chat_id, user_id):
+        await self._call("get_chat_member")
+        return ChatMember(User(user_id, "user", is_bot=False), ChatMember.MEMBER)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._call("send_message", chat_id)
+        return self._message(chat_id)
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        await self._call("send_photo", chat_id, len(photo or b""))
+        return self._message(chat_id)
+
+    async def send_audio(self, chat_id, audio, **kwargs):
+        data = audio.read() if hasattr(audio, "read") else audio
+        await self._call("send_audio", chat_id, len(data))
+        return self._message(chat_id)
+
+    async def copy_message(self, chat_id, from_chat_id, message_id, **kwargs):
+        await self._call("copy_message", chat_id)
+        return MessageId(self._next_id())
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        await self._call("edit_message_text", chat_id)
+        return self._message(chat_id, message_id)
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        await self._call("delete_message", chat_id)
+        return True
+
+    async def edit_message_media(self, media, chat_id=None, message_id=None, **kwargs):
+        content = media.media
+        if isinstance(content, InputFile):
+            nbytes = len(content.input_file_content)
+            file_id = f"file-{hashlib.sha1(content.input_file_content).hexdigest()}"
+        else:
+            nbytes = 0
+            file_id = content
+            if not str(file_id).startswith("file-"):
+                raise BadRequest("Wrong file identifier/http url specified")
+        await self._call("edit_message_media", chat_id, nbytes)
+        if media.title is not None:
+            # Placeholder text, e.g. "File too large!"
+            self.failures.append((chat_id, message_id, time.time(), media.title))
+            return self._message(chat_id, message_id)
+        self.deliveries.append((chat_id, message_id, time.time()))
+        return self._message(chat_id, message_id, file_id)
+
+
+class FakeS3:
+    """S3 client backed by a directory, so processes standing in for separate
+    Lambda containers share one bucket"""
+
+    class exceptions:
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self, root, latency=S3_LATENCY):
+        self.root = root
+        self.latency = latency
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key.lstrip("/"))
+
+    def _wait(self, name, nbytes=0):
+        seconds = self.latency.delay(nbytes)
+        time.sleep(seconds)
+        count(f"s3.{name}", seconds, nbytes)
+
+    def _write(self, path, f):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as out:
+            shutil.copyfileobj(f, out)
+        os.replace(tmp, path)
+
+    def _size(self, path):
+        try:
+            return os.path.getsize(path)
+        except FileNotFoundError:
+            raise self.exceptions.NoSuchKey(path) from None
+
+    def get_object(self, Bucket, Key):
+        path = self._path(Bucket, Key)
+        self._wait("get_object", self._size(path))
+        with open(path, "rb") as f:
+            return {"Body": io.BytesIO(f.read()), "ContentLength": self._size(path)}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        data = Body.encode() if isinstance(Body, str) else Body
+        self._wait("put_object", len(data))
+        self._write(self._path(Bucket, Key), io.BytesIO(data))
+
+    def upload_file(self, Filename, Bucket, Key, Config=None, **kwargs):
+        self._wait("upload_file", os.path.getsize(Filename))
+        with open(Filename, "rb") as f:
+            self._write(self._path(Bucket, Key), f)
+
+    def download_fileobj(self, Bucket, Key, Fileobj, Config=None, **kwargs):
+        path = self._path(Bucket, Key)
+        self._wait("download_fileobj", self._size(path))
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, Fileobj)
+
+    def download_file(self, Bucket, Key, Filename, Config=None, **kwargs):
+        with open(Filename, "wb") as f:
+            self.download_fileobj(Bucket, Key, f)
+
+    def delete_object(self, Bucket, Key):
+        self._wait("delete_object")
+        try:
+            os.remove(self._path(Bucket, Key))
+        except FileNotFoundError:
+            pass
+
+    def list_objects_v2(self, Bucket, Prefix=""):
+        self._wait("list_objects_v2")
+        base = os.path.join(self.root, Bucket)
+        contents = []
+        for directory, _, files in os.walk(base):
+            for name in files:
+                path = os.path.join(directory, name)
+                key = os.path.relpath(path, base)
+                if key.startswith(Prefix.lstrip("/")) and not name.endswith(".tmp"):
+                    contents.append({"Key": key, "Size": os.path.getsize(path)})
+        return {"Contents": contents, "KeyCount": len(contents)}
+
+
+class FakeTable:
+    """DynamoDB Table resource keyed on whatever key attributes are passed"""
+
+    class _Exceptions:
+        class ConditionalCheckFailedException(Exception):
+            pass
+
+    class _Client:
+        def __init__(self, exceptions):
+            self.exceptions = exceptions
+
+    class _Meta:
+        def __init__(self, client):
+            self.client = client
+
+    def __init__(self, key_names=("key",), latency=DYNAMODB_LATENCY):
+        self.key_names = key_names
+        self.latency = latency
+        self.items = {}
+        self.lock = threading.Lock()
+        self.meta = self._Meta(self._Client(self._Exceptions))
+
+    def _key(self, item):
+        return tuple(item[name] for name in self.key_names)
+
+    def _wait(self, name):
+        seconds = self.latency.delay()
+        time.sleep(seconds)
+        count(f"dynamodb.{name}", seconds)
+
+    def get_item(self, Key):
+        self._wait("get_item")
+        with self.lock:
+            item = self.items.get(self._key(Key))
+        return {"Item": dict(item)} if item is not None else {}
+
+    def put_item(self, Item, **kwargs):
+        self._wait("put_item")
+        with self.lock:
+            self.items[self._key(Item)] = dict(Item)
+
+    def delete_item(self, Key, **kwargs):
+        self._wait("delete_item")
+        with self.lock:
+            self.items.pop(self._key(Key), None)
+
+
+class FakeSource:
+    """Deterministic catalogue of fake videos standing in for yt-dlp.
+
+    Durations are derived from the video ID, so the same URL always produces
+    the same file, and `download` takes as long as extraction plus fetching a
+    128kbps file of that length over SOURCE_LATENCY.
+    """
+
+    def __init__(self, latency=SOURCE_LATENCY, min_duration=120, max_duration=600):
+        self.latency = latency
+        self.min_duration = min_duration
+        self.max_duration = max_duration
+
+    def duration(self, video_id) -> int:
+        digest = int(hashlib.sha1(video_id.encode()).hexdigest(), 16)
+        return self.min_duration + digest % (self.max_duration - self.min_duration)
+
+    def info(self, video_id) -> dict:
+        return {
+            "id": video_id,
+            "title": f"Artist {video_id[-2:]} - Track {video_id}",
+            "uploader": f"Artist {video_id[-2:]}",
+            "duration": self.duration(video_id),
+            "extractor": "youtube",
+            "extractor_key": "Youtube",
+            "webpage_url": f"https://www.youtube.com/watch?v={video_id}",
+        }
+
+    def download(self, video_id, filename) -> dict:
+        info = self.info(video_id)
+        nbytes = info["duration"] * 128 * 125
+        seconds = self.latency.delay(nbytes)
+        time.sleep(seconds)
+        synthetic_mp3(filename, info["duration"])
+        count("source.download", seconds, nbytes)
+        return info
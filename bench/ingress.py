@@ -0,0 +1,273 @@
+"""Update ingress benchmark: long polling against the webhook server.
+
+A fake Bot API server hands the same stream of updates to either an
+Application polling `getUpdates` (as `telegram_bot.run_polling` does) or to
+`webhook.serve`, by POSTing each update the way Telegram does, with up to
+`--connections` requests in flight. The handler only records when each update
+reached it, plus `--work` seconds of simulated work, so only the ingress is
+measured.
+
+    python bench/ingress.py --updates 5000 --rate 1000 --work 0.05
+
+Reports throughput and the delay from an update being available to its handler
+starting (p50/p95/p99) for both modes, and for the webhook how long Telegram
+waited for each acknowledgement.
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from aiohttp import ClientSession, web
+from telegram import Update
+from telegram.ext import Application, TypeHandler
+
+ROOT = Path(__file__).resolve().parent.parent
+TOKEN = "123456:bench"
+SECRET = "bench-secret"
+
+
+def make_update(update_id) -> dict:
+    user = {"id": update_id % 500 + 1, "is_bot": False, "first_name": "bench"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user["id"], "type": "private"},
+            "from": user,
+            "text": "https://youtu.be/bgWUwywrXOM",
+        },
+    }
+
+
+class FakeBotAPI:
+    """Enough of the Bot API for an Application to start and poll"""
+
+    def __init__(self):
+        self.updates = []
+        self.arrived = asyncio.Condition()
+
+    async def add(self, update):
+        async with self.arrived:
+            self.updates.append(update)
+            self.arrived.notify_all()
+
+    async def get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+
+        def pending():
+            # Update IDs are the list indexes
+            return self.updates[offset : offset + limit]
+
+        async with self.arrived:
+            try:
+                await asyncio.wait_for(
+                    self.arrived.wait_for(pending), timeout=max(timeout, 0.01)
+                )
+            except asyncio.TimeoutError:
+                pass
+            return pending()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        if method == "getMe":
+            result = {
+                "id": 123456,
+                "is_bot": True,
+                "first_name": "bench",
+                "username": "bench_bot",
+            }
+        elif method == "getUpdates":
+            result = await self.get_updates(params)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(f"/bot{TOKEN}/{{method}}", self.handle)
+        return app
+
+
+class Recorder:
+    def __init__(self, expected, work):
+        self.expected = expected
+        self.work = work
+        self.available = {}  # update_id: when the update could be fetched
+        self.delays = []
+        self.done = asyncio.Event()
+
+    async def handle(self, update: Update, context):
+        self.delays.append(time.perf_counter() - self.available[update.update_id])
+        if self.work:
+            await asyncio.sleep(self.work)
+        if len(self.delays) == self.expected:
+            self.done.set()
+
+
+def build_application(api_port, recorder, updater=True) -> Application:
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(f"http://127.0.0.1:{api_port}/bot")
+        .concurrent_updates(True)
+    )
+    if not updater:
+        builder = builder.updater(None)
+    application = builder.build()
+    application.add_handler(TypeHandler(Update, recorder.handle))
+    return application
+
+
+async def produce(count, rate, deliver, recorder):
+    """Make `count` updates available at `rate` per second"""
+    start = time.perf_counter()
+    tasks = []
+    for update_id in range(count):
+        due = start + update_id / rate
+        if (delay := due - time.perf_counter()) > 0:
+            await asyncio.sleep(delay)
+        recorder.available[update_id] = time.perf_counter()
+        tasks.append(asyncio.create_task(deliver(make_update(update_id))))
+    await asyncio.gather(*tasks)
+
+
+async def run_polling(args, api, api_port) -> dict:
+    recorder = Recorder(args.updates, args.work)
+    application = build_application(api_port, recorder)
+    await application.initialize()
+    await application.start()
+    await application.updater.start_polling(poll_interval=0, timeout=10)
+    start = time.perf_counter()
+    await produce(args.updates, args.rate, api.add, recorder)
+    await recorder.done.wait()
+    elapsed = time.perf_counter() - start
+    await application.updater.stop()
+    await application.stop()
+    await application.shutdown()
+    return report(recorder, elapsed)
+
+
+async def run_webhook(args, api_port) -> dict:
+    import webhook
+
+    recorder = Recorder(args.updates, args.work)
+    application = build_application(api_port, recorder, updater=False)
+    stop = asyncio.Event()
+    server = asyncio.create_task(
+        webhook.serve(
+            application,
+            "127.0.0.1",
+            args.webhook_port,
+            SECRET,
+            stop,
+            queue_size=args.queue_size,
+            concurrency=args.concurrency,
+        )
+    )
+    url = f"http://127.0.0.1:{args.webhook_port}{webhook.WEBHOOK_PATH}"
+    headers = {webhook.SECRET_HEADER: SECRET}
+    connections = asyncio.Semaphore(args.connections)
+    acks = []
+    refused = 0
+
+    async def deliver(update):
+        nonlocal refused
+        # Telegram keeps trying until the update is acknowledged
+        while True:
+            async with connections:
+                sent = time.perf_counter()
+                async with session.post(url, json=update, headers=headers) as r:
+                    acks.append(time.perf_counter() - sent)
+                    if r.status == 200:
+                        return
+            refused += 1
+            await asyncio.sleep(0.1)
+
+    async with ClientSession() as session:
+        # Wait for the server to be listening
+        while True:
+            try:
+                async with session.post(url, json={}, headers={}) as r:
+                    break
+            except OSError:
+                await asyncio.sleep(0.05)
+        start = time.perf_counter()
+        await produce(args.updates, args.rate, deliver, recorder)
+        await recorder.done.wait()
+        elapsed = time.perf_counter() - start
+    stop.set()
+    await server
+    return {
+        **report(recorder, elapsed),
+        "ack_p50_ms": percentile_ms(acks, 50),
+        "ack_p99_ms": percentile_ms(acks, 99),
+        "refused": refused,
+    }
+
+
+def percentile_ms(values, pct):
+    return round(statistics.quantiles(values, n=100)[pct - 1] * 1000, 1)
+
+
+def report(recorder, elapsed) -> dict:
+    return {
+        "updates": len(recorder.delays),
+        "seconds": round(elapsed, 2),
+        "updates_per_s": round(len(recorder.delays) / elapsed, 1),
+        "delay_p50_ms": percentile_ms(recorder.delays, 50),
+        "delay_p95_ms": percentile_ms(recorder.delays, 95),
+        "delay_p99_ms": percentile_ms(recorder.delays, 99),
+    }
+
+
+async def bench(args) -> dict:
+    api = FakeBotAPI()
+    runner = web.AppRunner(api.app())
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.api_port).start()
+    try:
+        results = {}
+        if "polling" in args.modes:
+            results["polling"] = await run_polling(args, api, args.api_port)
+        if "webhook" in args.modes:
+            results["webhook"] = await run_webhook(args, args.api_port)
+        return results
+    finally:
+        await runner.cleanup()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--rate", type=float, default=1000, help="Updates per second")
+    parser.add_argument("--work", type=float, default=0.0, help="Seconds per update")
+    parser.add_argument(
+        "--connections", type=int, default=40, help="Telegram's max_connections"
+    )
+    parser.add_argument("--queue-size", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=256)
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        choices=["polling", "webhook"],
+        default=["polling", "webhook"],
+    )
+    parser.add_argument("--api-port", type=int, default=8081)
+    parser.add_argument("--webhook-port", type=int, default=8082)
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, str(ROOT))
+    print(json.dumps(asyncio.run(bench(args)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""Worker processes standing in for Lambda containers.
+
+Each process imports one Lambda's code once, swaps its AWS, Telegram and yt-dlp
+dependencies for the fakes, then handles invocations one at a time like a warm
+container. Results are plain tuples so they can be sent back to the driver.
+"""
+
+import asyncio
+import os
+import resource
+import sys
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+from fakes import FakeBot, FakeS3, FakeSource, FakeTable, TelegramLimits, take_stats
+
+ROOT = Path(__file__).resolve().parent.parent
+BUCKET = "bench"
+
+
+class Invocation(NamedTuple):
+    pid: int
+    started: float
+    duration: float
+    # High-water mark of the container, like Lambda's "Max Memory Used"
+    max_rss_mb: float
+    deliveries: list
+    failures: list
+    batch_item_failures: int
+    error: str | None
+    stats: dict
+
+
+class BenchRuntime:
+    """Same interface as the Lambdas' runtimes, holding a FakeBot"""
+
+    def __init__(self, bot, s3=None, file_ids_table=None, limiter=None):
+        self.loop = asyncio.new_event_loop()
+        self.bot = bot
+        self.s3 = s3
+        self.file_ids_table = file_ids_table
+        self.limiter = limiter
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+
+def configure_environment(workdir):
+    """Environment both Lambdas and the bot read at import time. Set before
+    the worker processes are spawned so they inherit it."""
+    os.environ.update(
+        {
+            "AWS_DEFAULT_REGION": "eu-west-2",
+            "AWS_ACCESS_KEY_ID": "bench",
+            "AWS_SECRET_ACCESS_KEY": "bench",
+            "AWS_BACKEND": "memory",
+            "BOT_TOKEN": "123456:bench",
+            "DLBOT_TOKEN": "123456:bench",
+            "SNS_TOPIC": "bench",
+            "SNS_POST_TOPIC": "bench",
+            "SQS_QUEUE": "bench",
+            "MEMBERS_CHANNEL_ID": "-1001",
+            "MEMBERS_CHANNEL_LINK": "https://t.me/bench",
+            "NEW_USERS_TABLE": "bench-new-users",
+            "ERRORS_TABLE": "bench-errors",
+            "S3_BUCKET": BUCKET,
+            "BUCKET_NAME": BUCKET,
+            "FILE_IDS_DB": os.path.join(workdir, "file_ids.sqlite3"),
+            "LEASES_DB": os.path.join(workdir, "leases.sqlite3"),
+            "COMPLETIONS_DB": os.path.join(workdir, "completions.sqlite3"),
+            "YTDLP_CACHE_DIR": os.path.join(workdir, "yt-dlp-cache"),
+            "SCRATCH_DIR": os.path.join(workdir, "scratch"),
+            # Spans are written to stdout, where they'd bury the report
+            "TRACING": os.environ.get("TRACING", "false"),
+        }
+    )
+
+
+_handler = None
+_bot = None
+
+
+def use_lambda_directory(directory, service):
+    """Import from `directory`, then the repo root for the modules shared with
+    the bot (deploy-lambda.sh copies them into each image)"""
+    sys.path[:0] = [str(ROOT / directory), str(ROOT)]
+    os.environ.setdefault("TRACING_SERVICE", service)  # Set in the Dockerfiles
+
+
+def init_download_worker(workdir, enforce_limits):
+    """Import dlbot-lambda with fake S3, DynamoDB, Telegram and yt-dlp"""
+    global _handler, _bot
+    use_lambda_directory("dlbot-lambda", "download")
+    import app
+    import downloader
+    import lib
+    import runtime
+    import yt_downloader_cache
+    from cache_keys import make_key, youtube_video_id
+    from conversion import ConversionPlan
+    from download_cache import DownloadCache
+    from yt_downloader_cache import MemoryTier, S3Tier, TieredCache
+
+    s3 = FakeS3(os.path.join(workdir, "s3"))
+    source = FakeSource()
+
+    def download_audio(url, directory, cache_cls=None, codec=None, cached=None):
+        video_id = youtube_video_id(url)
+        key = make_key("youtube", video_id)
+        if cached is not None and cached(key):
+            return downloader.Cached(url, key)
+        filename = os.path.join(directory, f"{video_id}.mp3")
+        info = source.download(video_id, filename)
+        return url, info, filename, ConversionPlan("bench", "mp3", True)
+
+    _bot = FakeBot(limits=TelegramLimits() if enforce_limits else None)
+    runtime._runtime = BenchRuntime(_bot)
+    app.download_cache = DownloadCache(client=s3)
+    lib.table = FakeTable(("chat_id", "message_id"))
+    downloader.download_audio = download_audio
+    yt_downloader_cache.backend = TieredCache([MemoryTier(), S3Tier(s3)])
+    _handler = app.lambda_handler
+
+
+def init_send_worker(workdir, enforce_limits):
+    """Import dlbot-send-lambda with fake S3, DynamoDB and Telegram"""
+    global _handler, _bot
+    use_lambda_directory("dlbot-send-lambda", "send")
+    import app
+    import runtime
+    from ratelimit import get_rate_limiter
+
+    _bot = FakeBot(limits=TelegramLimits() if enforce_limits else None)
+    runtime._runtime = BenchRuntime(
+        _bot,
+        FakeS3(os.path.join(workdir, "s3")),
+        FakeTable(("key",)),
+        get_rate_limiter(),
+    )
+    _handler = app.lambda_handler
+
+
+def warm_up() -> int:
+    return os.getpid()
+
+
+def invoke(event) -> Invocation:
+    take_stats()
+    _bot.deliveries.clear()
+    _bot.failures.clear()
+    started = time.time()
+    error = None
+    failed = 0
+    try:
+        response = _handler(event, None)
+        failed = len(response.get("batchItemFailures", []))
+    except Exception as e:
+        error = f"{e.__class__.__name__}: {e}"
+    return Invocation(
+        pid=os.getpid(),
+        started=started,
+        duration=time.time() - started,
+        max_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        deliveries=list(_bot.deliveries),
+        failures=list(_bot.failures),
+        batch_item_failures=failed,
+        error=error,
+        stats=take_stats(),
+    )
@@ -0,0 +1,393 @@
+"""End-to-end load test of the bot and both Lambdas against in-process fakes.
+
+Simulated users send a mix of single video and playlist links to
+`telegram_bot.message_handler`. Every message the bot publishes invokes
+`dlbot-lambda/app.lambda_handler` in a pool of worker processes, one per
+simulated Lambda container, sharing a fake S3 bucket and file_id, lease and
+completion stores on disk. The `send` phase drives `dlbot-send-lambda/app.lambda_handler` the
+same way with objects already in the bucket.
+
+    python bench/loadtest.py --users 20 --messages 3 --containers 8
+
+Reports time-to-audio percentiles (user message to audio in the placeholder),
+throughput, peak RSS per Lambda container and time spent in each fake service.
+"""
+
+import argparse
+import asyncio
+import contextvars
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, wait
+from functools import partial
+from pathlib import Path
+from types import SimpleNamespace
+from typing import NamedTuple
+
+import lambdas
+from fakes import FakeBot, FakeS3, FakeSource, TelegramLimits, synthetic_mp3
+
+ROOT = Path(__file__).resolve().parent.parent
+SNS_LATENCY = 0.03
+
+current_request = contextvars.ContextVar("current_request")
+
+
+class Request(NamedTuple):
+    user: int
+    url: str
+    kind: str
+    sent_at: float
+
+
+class UserFacingBot(FakeBot):
+    """Remembers which user request each placeholder belongs to"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.placeholders = {}
+
+    async def send_audio(self, chat_id, audio, **kwargs):
+        message = await super().send_audio(chat_id, audio, **kwargs)
+        self.placeholders[message.message_id] = current_request.get()
+        return message
+
+
+def sns_record(entry):
+    return {
+        "Sns": {
+            "Message": entry["Message"],
+            "MessageAttributes": {
+                name: {"Type": attr["DataType"], "Value": attr["StringValue"]}
+                for name, attr in entry["MessageAttributes"].items()
+            },
+        }
+    }
+
+
+def sqs_record(entry):
+    return {
+        "messageId": entry["Id"],
+        "body": entry["MessageBody"],
+        "messageAttributes": {
+            name: {"dataType": attr["DataType"], "stringValue": attr["StringValue"]}
+            for name, attr in entry["MessageAttributes"].items()
+        },
+    }
+
+
+def make_queue_backend(pool):
+    """InMemoryBackend whose published messages invoke the download Lambda:
+    one invocation per SNS message, or one per SQS batch"""
+    from aws_io import InMemoryBackend
+
+    class LambdaQueue(InMemoryBackend):
+        def __init__(self):
+            super().__init__(latency=SNS_LATENCY)
+            self.futures = []
+            self.futures_lock = threading.Lock()
+
+        def _invoke(self, records):
+            future = pool.submit(lambdas.invoke, {"Records": records})
+            with self.futures_lock:
+                self.futures.append(future)
+
+        def publish(self, message, attributes):
+            super().publish(message, attributes)
+            self._invoke(
+                [sns_record({"Message": message, "MessageAttributes": attributes})]
+            )
+
+        def publish_batch(self, entries):
+            response = super().publish_batch(entries)
+            for entry in entries:
+                self._invoke([sns_record(entry)])
+            return response
+
+        def send_message_batch(self, entries):
+            response = super().publish_batch(entries)
+            self._invoke([sqs_record(entry) for entry in entries])
+            return response
+
+    return LambdaQueue()
+
+
+def fake_extract_playlist(source: FakeSource, url):
+    from metadata_cache import PlaylistEntry, PlaylistInfo
+
+    playlist_id = url.rsplit("=", 1)[-1]
+    length = int(playlist_id[-2:])
+    time.sleep(source.latency.delay())
+    entries = []
+    for i in range(length):
+        video_id = f"bp{playlist_id[2:6]}{i:05d}"
+        info = source.info(video_id)
+        entries.append(
+            PlaylistEntry(
+                url=info["webpage_url"],
+                id=video_id,
+                ie_key=info["extractor_key"],
+                title=info["title"],
+                duration=info["duration"],
+            )
+        )
+    return PlaylistInfo(f"Playlist {playlist_id}", length, None, [], entries)
+
+
+def make_update(user_id, text, bot):
+    async def reply_text(text, **kwargs):
+        return await bot.send_message(user_id, text)
+
+    return SimpleNamespace(
+        effective_chat=SimpleNamespace(id=user_id),
+        effective_user=SimpleNamespace(id=user_id, first_name=f"user{user_id}"),
+        message=SimpleNamespace(text=text, reply_text=reply_text),
+    )
+
+
+def pick_url(rng: random.Random, args) -> tuple[str, str]:
+    if rng.random() < args.playlist_ratio:
+        playlist = rng.randrange(args.catalogue)
+        length = rng.randint(2, args.playlist_length)
+        return (
+            f"https://www.youtube.com/playlist?list=PL{playlist:04d}{length:02d}",
+            "playlist",
+        )
+    # A small catalogue makes popular videos repeat, exercising the caches
+    return (
+        f"https://www.youtube.com/watch?v=bs{rng.randrange(args.catalogue):09d}",
+        "single",
+    )
+
+
+async def simulate_user(user_id, args, bot, handler, rng):
+    context = SimpleNamespace(bot=bot)
+    for _ in range(args.messages):
+        await asyncio.sleep(rng.expovariate(1 / args.think_time))
+        url, kind = pick_url(rng, args)
+        request = Request(user_id, url, kind, time.time())
+        current_request.set(request)
+        await handler(make_update(user_id, url, bot), context)
+
+
+def percentiles(values) -> dict:
+    if len(values) < 2:
+        return {"p50": values[0] if values else None, "p95": None, "p99": None}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+
+def summarise_invocations(invocations) -> dict:
+    totals = Counter()
+    for invocation in invocations:
+        totals.update(invocation.stats)
+    peak_rss = {}
+    for invocation in invocations:
+        peak_rss[invocation.pid] = max(
+            peak_rss.get(invocation.pid, 0), invocation.max_rss_mb
+        )
+    return {
+        "invocations": len(invocations),
+        "errors": sum(invocation.error is not None for invocation in invocations),
+        "batch_item_failures": sum(i.batch_item_failures for i in invocations),
+        "duration_s": percentiles([i.duration for i in invocations]),
+        "peak_rss_mb": percentiles([i.max_rss_mb for i in invocations]),
+        "peak_rss_mb_per_container": peak_rss,
+        "services": {
+            name.removesuffix(".calls"): {
+                "calls": calls,
+                "seconds": round(totals[name.replace(".calls", ".seconds")], 3),
+                "mb": round(totals[name.replace(".calls", ".bytes")] / 1e6, 3),
+            }
+            for name, calls in sorted(totals.items())
+            if name.endswith(".calls")
+        },
+    }
+
+
+def make_pool(initializer, args, workdir):
+    pool = ProcessPoolExecutor(
+        args.containers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=initializer,
+        initargs=(workdir, args.enforce_limits),
+    )
+    # Start every container before the clock does, so only warm invocations
+    # are measured
+    wait([pool.submit(lambdas.warm_up) for _ in range(args.containers)])
+    return pool
+
+
+async def run_download_phase(args, workdir) -> dict:
+    import metadata_cache
+    import telegram_bot
+    from aws_io import AsyncStore
+
+    pool = make_pool(lambdas.init_download_worker, args, workdir)
+    queue = make_queue_backend(pool)
+    telegram_bot.store = AsyncStore(queue)
+    telegram_bot.USE_SQS = args.sqs
+    metadata_cache.extract_playlist = partial(fake_extract_playlist, FakeSource())
+    bot = UserFacingBot(limits=TelegramLimits() if args.enforce_limits else None)
+
+    started = time.time()
+    rng = random.Random(args.seed)
+    await asyncio.gather(
+        *(
+            simulate_user(
+                user_id,
+                args,
+                bot,
+                telegram_bot.message_handler,
+                random.Random(rng.random()),
+            )
+            for user_id in range(1, args.users + 1)
+        )
+    )
+    # Playlists keep publishing while earlier tracks are processed
+    await telegram_bot.dispatcher.join()
+    while True:
+        with queue.futures_lock:
+            pending = [future for future in queue.futures if not future.done()]
+        if not pending:
+            break
+        await asyncio.to_thread(wait, pending)
+    finished = time.time()
+    pool.shutdown()
+
+    invocations = [future.result() for future in queue.futures]
+    delivered = {}
+    for invocation in invocations:
+        for _, message_id, at in invocation.deliveries:
+            delivered.setdefault(message_id, at)
+    time_to_audio = [
+        delivered[message_id] - request.sent_at
+        for message_id, request in bot.placeholders.items()
+        if message_id in delivered
+    ]
+    by_kind = {
+        kind: percentiles(
+            [
+                delivered[message_id] - request.sent_at
+                for message_id, request in bot.placeholders.items()
+                if message_id in delivered and request.kind == kind
+            ]
+        )
+        for kind in ("single", "playlist")
+    }
+    return {
+        "placeholders": len(bot.placeholders),
+        "delivered": len(time_to_audio),
+        "not_delivered": len(bot.placeholders) - len(time_to_audio),
+        "elapsed_s": finished - started,
+        "throughput_tracks_per_s": len(time_to_audio) / (finished - started),
+        "time_to_audio_s": percentiles(time_to_audio),
+        "time_to_audio_s_by_kind": by_kind,
+        "lambda": summarise_invocations(invocations),
+    }
+
+
+def run_send_phase(args, workdir) -> dict:
+    s3 = FakeS3(os.path.join(workdir, "s3"))
+    records = []
+    for i in range(args.send_records):
+        chat_id = 1 + i % args.users
+        s3_key = f"{chat_id}/send{i:06d}.mp3"
+        with tempfile.NamedTemporaryFile(suffix=".mp3") as f:
+            synthetic_mp3(f.name, 180)
+            s3.upload_file(f.name, lambdas.BUCKET, s3_key)
+        attributes = {
+            "chat_id": str(chat_id),
+            "message_id": str(900_000_000 + 2 * i),
+            "placeholder_id": str(900_000_001 + 2 * i),
+        }
+        records.append(
+            {
+                "Sns": {
+                    "Message": s3_key,
+                    "MessageAttributes": {
+                        name: {"Type": "String", "Value": value}
+                        for name, value in attributes.items()
+                    },
+                }
+            }
+        )
+
+    pool = make_pool(lambdas.init_send_worker, args, workdir)
+    started = time.time()
+    futures = [pool.submit(lambdas.invoke, {"Records": [record]}) for record in records]
+    invocations = [future.result() for future in futures]
+    finished = time.time()
+    pool.shutdown()
+    time_to_audio = [
+        at - started for invocation in invocations for *_, at in invocation.deliveries
+    ]
+    return {
+        "records": len(records),
+        "delivered": len(time_to_audio),
+        "elapsed_s": finished - started,
+        "throughput_tracks_per_s": len(time_to_audio) / (finished - started),
+        "time_to_audio_s": percentiles(time_to_audio),
+        "lambda": summarise_invocations(invocations),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=3, help="Links per user")
+    parser.add_argument("--think-time", type=float, default=5.0, help="Mean seconds")
+    parser.add_argument("--playlist-ratio", type=float, default=0.2)
+    parser.add_argument("--playlist-length", type=int, default=8)
+    parser.add_argument("--catalogue", type=int, default=50, help="Distinct videos")
+    parser.add_argument("--containers", type=int, default=4, help="Lambda concurrency")
+    parser.add_argument("--sqs", action="store_true", help="Queue via SQS batches")
+    parser.add_argument(
+        "--no-scheduler", action="store_true", help="Publish tracks straight away"
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        help="Seconds between the scheduler's checks for finished tracks",
+    )
+    parser.add_argument("--enforce-limits", action="store_true")
+    parser.add_argument("--send-records", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="Also write the report to this file")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="dlbot-bench-") as workdir:
+        lambdas.configure_environment(workdir)
+        os.environ.update(
+            {
+                "SCHEDULE_DOWNLOADS": str(not args.no_scheduler).lower(),
+                "MAX_IN_FLIGHT": str(args.containers),
+            }
+        )
+        if args.poll_interval is not None:
+            os.environ["COMPLETION_POLL_INTERVAL"] = str(args.poll_interval)
+        sys.path.insert(0, str(ROOT))
+        report = {"args": vars(args)}
+        report["download"] = asyncio.run(run_download_phase(args, workdir))
+        if args.send_records:
+            report["send"] = run_send_phase(args, workdir)
+    output = json.dumps(report, indent=2, default=str)
+    print(output)
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""Discrete-event simulation of download queue wait under mixed load.
+
+A few users paste long playlists while many others send single links. Tracks
+are served by `--concurrency` download Lambdas, taking `--service-time` seconds
+on average. Each policy sees the same arrivals:
+
+- fifo: every track published straight away, what SNS/SQS alone gives
+- fair: `scheduler.FairQueue` in front, weighted-fair per user, singles first
+  and caps on tracks in flight. As in the bot, a dispatched track holds its
+  slot until its download finishes and the next poll (`--poll-interval`
+  seconds apart) hears about it.
+
+    python bench/scheduler_sim.py --playlist-users 3 --single-users 40
+    python bench/scheduler_sim.py --playlist-users 1 --playlists 1 --single-users 0
+
+Reports queue wait (arrival to a Lambda picking the track up) percentiles per
+kind of track, and for single links sent while a playlist was queued.
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import random
+import statistics
+import sys
+from collections import deque
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from scheduler import (  # noqa: E402
+    CHAT_IN_FLIGHT,
+    COMPLETION_POLL_INTERVAL,
+    MAX_IN_FLIGHT,
+    FairQueue,
+    ScheduledItem,
+)
+
+
+def arrivals(args) -> list[ScheduledItem]:
+    """Every track as it arrives, in order"""
+    rng = random.Random(args.seed)
+    items = []
+    for user in range(args.playlist_users):
+        at = rng.uniform(0, args.duration / 4)
+        for _ in range(args.playlists):
+            # Tracks of one playlist arrive as fast as their placeholders go out
+            for track in range(args.playlist_length):
+                items.append(ScheduledItem(None, user, user, "playlist", at + track))
+            at += rng.uniform(0, 10)
+    for user in range(args.playlist_users, args.playlist_users + args.single_users):
+        at = rng.expovariate(args.singles / args.duration)
+        while at < args.duration:
+            items.append(ScheduledItem(None, user, user, "single", at))
+            at += rng.expovariate(args.singles / args.duration)
+    return sorted(items, key=lambda item: item.enqueued_at)
+
+
+def simulate(queue, items, args) -> list[tuple[ScheduledItem, float]]:
+    """Run every item through `queue` (None to publish straight away) and a
+    shared FIFO in front of the Lambdas, returning (item, wait) pairs.
+
+    As in the bot, a dispatched item releases its place in `queue` once its
+    download has finished, at worst `--poll-interval` seconds later.
+    """
+    rng = random.Random(args.seed + 1)
+    events = []  # (time, sequence, kind, item) of slots releasing, downloads finishing
+    backlog = deque()  # Published, waiting for a Lambda
+    busy = 0
+    waits = []
+    sequence = itertools.count()
+    pending = deque(items)
+    while pending or events or backlog or (queue is not None and len(queue)):
+        next_arrival = pending[0].enqueued_at if pending else float("inf")
+        next_event = events[0][0] if events else float("inf")
+        if next_arrival <= next_event:
+            now = next_arrival
+            item = pending.popleft()
+            if queue is None:
+                backlog.append(item)
+            else:
+                queue.push(item)
+        else:
+            now, _, kind, item = heapq.heappop(events)
+            if kind == "release":
+                queue.done(item)
+            else:
+                busy -= 1
+                if queue is not None:
+                    release = now + args.poll_interval
+                    heapq.heappush(events, (release, next(sequence), "release", item))
+        while queue is not None and (item := queue.pop()) is not None:
+            backlog.append(item)
+        while backlog and busy < args.concurrency:
+            item = backlog.popleft()
+            waits.append((item, now - item.enqueued_at))
+            busy += 1
+            service = rng.lognormvariate(0, 0.5) * args.service_time
+            heapq.heappush(events, (now + service, next(sequence), "finish", item))
+    return waits
+
+
+def percentiles(values) -> dict:
+    if len(values) < 2:
+        return {"p50": values[0] if values else None, "p95": None, "p99": None}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {
+        "p50": round(cuts[49], 2),
+        "p95": round(cuts[94], 2),
+        "p99": round(cuts[98], 2),
+    }
+
+
+def summarise(waits, items) -> dict:
+    playlist_times = [item.enqueued_at for item in items if item.kind == "playlist"]
+    busy = (min(playlist_times), max(playlist_times)) if playlist_times else (0, 0)
+    return {
+        "single": percentiles([w for item, w in waits if item.kind == "single"]),
+        "single_during_playlists": percentiles(
+            [
+                w
+                for item, w in waits
+                if item.kind == "single" and busy[0] <= item.enqueued_at <= busy[1]
+            ]
+        ),
+        "playlist": percentiles([w for item, w in waits if item.kind == "playlist"]),
+        "makespan_s": round(
+            max(item.enqueued_at + w for item, w in waits) - items[0].enqueued_at, 1
+        ),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--playlist-users", type=int, default=3)
+    parser.add_argument("--playlists", type=int, default=3, help="Per playlist user")
+    parser.add_argument("--playlist-length", type=int, default=30)
+    parser.add_argument("--single-users", type=int, default=40)
+    parser.add_argument("--singles", type=float, default=5, help="Mean per user")
+    parser.add_argument("--duration", type=float, default=600.0, help="Seconds")
+    parser.add_argument("--concurrency", type=int, default=10, help="Lambdas")
+    parser.add_argument("--service-time", type=float, default=15.0, help="Seconds")
+    parser.add_argument("--max-in-flight", type=int, default=MAX_IN_FLIGHT)
+    parser.add_argument("--chat-in-flight", type=int, default=CHAT_IN_FLIGHT)
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=COMPLETION_POLL_INTERVAL,
+        help="COMPLETION_POLL_INTERVAL, seconds",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    items = arrivals(args)
+    report = {
+        "args": vars(args),
+        "tracks": len(items),
+        "fifo": summarise(simulate(None, items, args), items),
+        "fair": summarise(
+            simulate(
+                FairQueue(
+                    max_in_flight=args.max_in_flight,
+                    chat_in_flight=args.chat_in_flight,
+                ),
+                items,
+                args,
+            ),
+            items,
+        ),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Tells the bot's scheduler when the download Lambda is done with a track.
+
+The bot tags every track it dispatches with a dispatch ID, and the download
+Lambda records the ID once the track's record has been processed (sent, or
+its failure reported to the chat). The bot polls for the IDs it's waiting on,
+so its caps count the tracks really in flight. Shared by the bot and the
+download Lambda (which gets a copy from deploy-lambda.sh).
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+# A DynamoDB table keyed on `key`, with `expires` as its TTL attribute
+COMPLETIONS_TABLE = os.environ.get("COMPLETIONS_TABLE")
+# Or a SQLite file both can reach (development, load tests)
+COMPLETIONS_DB = os.environ.get("COMPLETIONS_DB")
+COMPLETION_TTL = 3600  # Seconds a completion is kept for the bot to see
+BATCH_GET_LIMIT = 100  # Keys per BatchGetItem
+
+
+class DynamoCompletionStore:
+    def __init__(self, table):
+        self.table = table
+
+    def complete(self, dispatch_id):
+        self.table.put_item(
+            Item={
+                "key": f"done/{dispatch_id}",
+                "expires": int(time.time()) + COMPLETION_TTL,
+            }
+        )
+
+    def completed(self, dispatch_ids) -> set[str]:
+        """Which of `dispatch_ids` are done. Keys DynamoDB leaves unprocessed
+        count as not done yet, the next poll asks again."""
+        client = self.table.meta.client
+        done = set()
+        dispatch_ids = list(dispatch_ids)
+        for i in range(0, len(dispatch_ids), BATCH_GET_LIMIT):
+            keys = [
+                {"key": f"done/{dispatch_id}"}
+                for dispatch_id in dispatch_ids[i : i + BATCH_GET_LIMIT]
+            ]
+            response = client.batch_get_item(
+                RequestItems={self.table.name: {"Keys": keys}}
+            )
+            for item in response["Responses"].get(self.table.name, []):
+                done.add(item["key"].removeprefix("done/"))
+        return done
+
+
+class SQLiteCompletionStore:
+    """Local stand-in for DynamoCompletionStore (development, load tests)"""
+
+    def __init__(self, path=COMPLETIONS_DB):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS completions (id TEXT PRIMARY KEY, at REAL)"
+        )
+
+    def complete(self, dispatch_id):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO completions (id, at) VALUES (?, ?)",
+                (dispatch_id, time.time()),
+            )
+
+    def completed(self, dispatch_ids) -> set[str]:
+        dispatch_ids = list(dispatch_ids)
+        if not dispatch_ids:
+            return set()
+        placeholders = ", ".join("?" * len(dispatch_ids))
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT id FROM completions WHERE id IN ({placeholders})",
+                dispatch_ids,
+            ).fetchall()
+        return {row[0] for row in rows}
+
+
+def get_completion_store(dynamodb=None):
+    """The configured store, or None: without one the bot can't tell how many
+    tracks are in flight. `dynamodb` is the boto3 DynamoDB resource."""
+    if COMPLETIONS_TABLE and dynamodb is not None:
+        return DynamoCompletionStore(dynamodb.Table(COMPLETIONS_TABLE))
+    if COMPLETIONS_DB:
+        return SQLiteCompletionStore(COMPLETIONS_DB)
+    return None
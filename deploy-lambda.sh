@@ -8,6 +8,17 @@ REGION=$AWS_REGION
 IMAGE=$LAMBDA_FUNCTION_IMAGE
 FUNCTION=$LAMBDA_FUNCTION_NAME
 
+# Modules shared with the bot have one copy, at the top of the repo. Copy them
+# into the Lambda's build context (the current directory) for the build.
+ROOT=$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)
+SHARED_MODULES=(audio_limits.py completions.py ratelimit.py runtime.py tracing.py)
+if [ "$PWD" != "$ROOT" ]; then
+  for module in "${SHARED_MODULES[@]}"; do
+    cp "$ROOT/$module" .
+  done
+  trap 'rm -f "${SHARED_MODULES[@]}"' EXIT
+fi
+
 aws ecr get-login-password --region "$REGION" --profile "$PROFILE" | docker login --username AWS --password-stdin "$ACCOUNT.dkr.ecr.$REGION.amazonaws.com"
 docker build -t "$IMAGE" .
 docker tag "$IMAGE:latest" "$ACCOUNT.dkr.ecr.$REGION.amazonaws.com/$IMAGE:latest"
@@ -1,28 +1,57 @@
 import asyncio
+import json
 import logging
 import os
+from typing import NamedTuple
 
-from telegram import Bot
-
-from boto3_clients import s3_client
-from constants import S3_BUCKET
+import yt_downloader_cache
+from boto3_clients import dynamodb_client
+from cache_keys import canonical_key
+from completions import get_completion_store
+from constants import (
+    LEASE_POLL_INTERVAL,
+    LEASE_RENEW_INTERVAL,
+    MAX_FILE_SIZE,
+    RECORD_CONCURRENCY,
+    SPLIT_LARGE_FILES,
+)
+from conversion import FileTooLarge
+from download_cache import DownloadCache
+from file_ids import get_file_id_store
 from lib import (
-    download_url,
+    record_error_message,
+    retry_attempts,
+    sent_file_id,
+    split_track,
     update_placeholder_audio_message,
+    update_placeholder_audio_parts,
+    update_placeholder_from_file_id,
     update_placeholder_text,
 )
-from yt_downloader_cache import S3PersistentCache
+from runtime import get_runtime
+from scratch import ScratchSpace
+from single_flight import get_lease_store, new_owner
+from tracing import add as add_to_span, correlation_id, new_correlation_id, span
 
 SNS_TOPIC = os.environ["SNS_TOPIC"]
-BOT_TOKEN = os.environ["BOT_TOKEN"]
-
-MAX_FILE_SIZE = int(50e6)  # 50MB
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+download_cache = DownloadCache()
+file_ids = get_file_id_store()
+leases = get_lease_store()
+# Tells the bot's scheduler which of the tracks it dispatched are done
+completions = get_completion_store(dynamodb_client)
+scratch = ScratchSpace()
 
-def get_message_attrs(chat_id, message_id, placeholder_id=None, url=None):
+
+def get_message_attrs(
+    chat_id, message_id, placeholder_id=None, url=None, cache_key=None
+):
+    """Attributes of a message for the send Lambda. Given `cache_key`, the
+    track's download cache key, the send Lambda remembers the file_id Telegram
+    gives the track and sends it by that from then on."""
     attrs = {
         "message_id": {
             "DataType": "String",
@@ -37,72 +66,437 @@ def get_message_attrs(chat_id, message_id, placeholder_id=None, url=None):
         }
     if url:
         attrs["url"] = {"DataType": "String", "StringValue": url}
+    if cache_key:
+        attrs["cache_key"] = {"DataType": "String", "StringValue": cache_key}
     return attrs
 
 
-def lambda_handler(event, _):
+def parse_placeholder_ids(value) -> list[int]:
+    """Per-track placeholders for a playlist, comma separated in playlist order"""
+    if not value:
+        return []
+    return [int(placeholder_id) for placeholder_id in value.split(",")]
+
+
+def parse_playlist_entries(value) -> list[str] | None:
+    """Playlist entry URLs from the bot's flat extraction, as a JSON list"""
+    return json.loads(value) if value else None
+
+
+def codec_key(key, codec=None):
+    """Tracks explicitly requested in another codec are cached separately"""
+    if key and codec:
+        return f"{key}@{codec}"
+    return key
+
+
+def in_download_cache(key, codec=None) -> bool:
+    return download_cache.lookup(codec_key(key, codec)) is not None
+
+
+def remember_file_id(key, message):
+    file_id = sent_file_id(message)
+    if key and file_id:
+        try:
+            file_ids.put(key, file_id)
+        except Exception as e:
+            logger.warning(f"Could not store file_id for {key} ({e})")
+
+
+class Job(NamedTuple):
+    video_url: str
+    chat_id: int
+    placeholder_message_id: int
+    track_placeholder_ids: list[int]
+    cache_key: str | None
+    playlist_entries: list[str] | None
+    codec: str | None
+    correlation_id: str | None
+    attempts: int  # Times the track has been retried after failing
+    dispatch_id: str | None  # Reported to the bot's scheduler when done
+
+
+def parse_record(record) -> Job:
     # Extract the URL and chat_id/message_id from the SNS message/attributes
-    loop = asyncio.new_event_loop()
-    bot = Bot(token=BOT_TOKEN)
-    for queued_message in event["Records"]:
-        if "Sns" in queued_message:
-            video_url = queued_message["Sns"]["Message"]
-            attributes = queued_message["Sns"]["MessageAttributes"]
-            chat_id = int(attributes["chat_id"]["Value"])
-            placeholder_message_id = int(attributes["placeholder_audio_id"]["Value"])
+    if "Sns" in record:
+        video_url = record["Sns"]["Message"]
+        attributes = record["Sns"]["MessageAttributes"]
+        value = "Value"
+    else:
+        video_url = record["body"]
+        attributes = record["messageAttributes"]
+        value = "stringValue"
+    return Job(
+        video_url=video_url,
+        chat_id=int(attributes["chat_id"][value]),
+        placeholder_message_id=int(attributes["placeholder_audio_id"][value]),
+        track_placeholder_ids=parse_placeholder_ids(
+            attributes.get("placeholder_audio_ids", {}).get(value)
+        ),
+        # Metadata the bot already extracted, so it isn't extracted again here
+        cache_key=attributes.get("cache_key", {}).get(value),
+        playlist_entries=parse_playlist_entries(
+            attributes.get("playlist_entries", {}).get(value)
+        ),
+        codec=attributes.get("codec", {}).get(value),
+        correlation_id=attributes.get("correlation_id", {}).get(value),
+        attempts=int(attributes.get("attempts", {}).get(value, 0)),
+        dispatch_id=attributes.get("dispatch_id", {}).get(value),
+    )
 
-        else:
-            video_url = queued_message["body"]
-            attributes = queued_message["messageAttributes"]
-            chat_id = int(attributes["chat_id"]["stringValue"])
-            placeholder_message_id = int(
-                attributes["placeholder_audio_id"]["stringValue"]
+
+async def iterate_in_thread(iterator):
+    """Advance a blocking iterator (e.g. the download pipeline) without
+    blocking the event loop"""
+    done = object()
+    while (item := await asyncio.to_thread(next, iterator, done)) is not done:
+        yield item
+
+
+def job_key(job: Job) -> str | None:
+    key = job.cache_key
+    if key is None and "playlist" not in job.video_url:
+        key = canonical_key(job.video_url)
+    return codec_key(key, job.codec)
+
+
+async def send_cached(bot, job: Job, key, directory=None) -> bool:
+    """Send the track from Telegram's file_id or the download cache, if either
+    has it. Returns whether it was sent. Tracks sent in parts are fetched into
+    `directory`, the scratch directory of a job already running (a playlist's),
+    or else a job's of their own."""
+    video_url, chat_id = job.video_url, job.chat_id
+    placeholder_message_id = job.placeholder_message_id
+
+    # Telegram already has this track, send it by file_id without touching S3
+    file_id = await asyncio.to_thread(file_ids.get, key)
+    if file_id is not None:
+        with span("send_file_id"):
+            sent = await update_placeholder_from_file_id(
+                chat_id, placeholder_message_id, file_id, bot
+            )
+        if sent:
+            logger.info(f"Sent {key} by cached file_id")
+            return True
+        await asyncio.to_thread(file_ids.delete, key)
+
+    # Still on this container's disk from an earlier job
+    warm = await asyncio.to_thread(scratch.open, key)
+    if warm is not None:
+        f, size = warm
+        logger.info(f"Sending {key} from the warm scratch space")
+        with f, span("send_audio", bytes=size, warm=True):
+            message = await update_placeholder_audio_message(
+                chat_id, placeholder_message_id, f, bot, video_url
             )
+        await asyncio.to_thread(remember_file_id, key, message)
+        return True
+
+    cached = await asyncio.to_thread(download_cache.lookup, key)
+    if cached is None:
+        return False
+    if cached.size >= MAX_FILE_SIZE:
+        logger.info(f"Download cache hit for {key}, sending in parts")
+        if directory is not None:
+            # Admitting a job of its own here could wait on the running jobs
+            # forever, this one included
+            await send_cached_in_parts(bot, job, cached, directory)
+        else:
+            async with scratch.job() as directory:
+                await send_cached_in_parts(bot, job, cached, directory)
+        return True
+    logger.info(f"Download cache hit for {key}")
+    with span("s3_fetch", bytes=cached.size):
+        f = await asyncio.to_thread(download_cache.open, cached)
+    with f, span("send_audio", bytes=cached.size):
+        message = await update_placeholder_audio_message(
+            chat_id, placeholder_message_id, f, bot, video_url
+        )
+    await asyncio.to_thread(remember_file_id, key, message)
+    return True
+
+
+async def send_cached_in_parts(bot, job: Job, cached, directory):
+    filename = os.path.join(directory, os.path.basename(cached.s3_key))
+    try:
+        with span("s3_fetch", bytes=cached.size):
+            await asyncio.to_thread(download_cache.download, cached, filename)
+        await send_in_parts(
+            bot,
+            job.chat_id,
+            job.placeholder_message_id,
+            filename,
+            job.video_url,
+            cached.title,
+            cached.artist,
+            cached.duration,
+        )
+    finally:
+        # The directory may be in use for the rest of a playlist
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+async def process_job(bot, job: Job):
+    # Check whether the track was already downloaded, it's possible the send operation
+    # failed, but the download was completed successfully; or we just still have a
+    # cached version. Playlists are cached per track as they are downloaded.
+    key = job_key(job)
+    if key is None:
+        await download_and_send(bot, job, key)
+        return
+    if await send_cached(bot, job, key):
+        return
+
+    # Only one worker downloads a track at a time. Anyone else asking for it
+    # meanwhile waits for that download to reach the cache and sends it from
+    # there, or takes over if the lease is released or expires without it.
+    owner = new_owner()
+    waited = False
+    while not await asyncio.to_thread(leases.acquire, key, owner):
+        if not waited:
+            logger.info(f"{key} is being downloaded by another worker, waiting")
+            waited = True
+        add_to_span("lease_polls")
+        await asyncio.sleep(LEASE_POLL_INTERVAL)
+        if await send_cached(bot, job, key):
+            return
+    renewal = asyncio.create_task(keep_lease(key, owner))
+    try:
+        if waited and await send_cached(bot, job, key):
+            return
+        await download_and_send(bot, job, key)
+    finally:
+        renewal.cancel()
+        await asyncio.to_thread(leases.release, key, owner)
+
 
-        # Check whether file(s) already exist, it's possible the send operation failed,
-        # but the download was completed successfully; or we just still have a cached version.
-        prefix = f"downloads/{hash(video_url)}/"
-        existing = s3_client.list_objects_v2(Bucket=S3_BUCKET, Prefix=prefix)
-        if "Contents" not in existing:
-            # Download file(s) using yt-dlp
-            for file in download_url(
+async def keep_lease(key, owner):
+    """Renew the lease every LEASE_RENEW_INTERVAL seconds, so downloads
+    running past DOWNLOAD_LEASE_TTL aren't taken over by another worker"""
+    while True:
+        await asyncio.sleep(LEASE_RENEW_INTERVAL)
+        try:
+            if not await asyncio.to_thread(leases.renew, key, owner):
+                logger.warning(f"Lost the lease on {key}, it expired")
+                return
+        except Exception as e:
+            logger.warning(f"Could not renew the lease on {key} ({e})")
+
+
+async def download_and_send(bot, job: Job, key):
+    video_url, chat_id = job.video_url, job.chat_id
+    placeholder_message_id = job.placeholder_message_id
+    track_placeholder_ids = job.track_placeholder_ids
+
+    # Download file(s) using yt-dlp, only imported now it's needed
+    from downloader import Cached, S3PersistentCache, download_url
+
+    # Without a key up front (playlists, sites canonical_key doesn't know),
+    # each track is looked up in the download cache once it's extracted
+    cached = None if key else lambda track_key: in_download_cache(track_key, job.codec)
+
+    # The job's files are removed along with its directory, whatever happens
+    async with scratch.job() as directory:
+        try:
+            results = await asyncio.to_thread(
+                download_url,
                 video_url,
+                directory,
                 chat_id,
                 cache_cls=S3PersistentCache,
-            ):  # Yields a single file unless URL is for a playlist
-                file_size = os.path.getsize(file.filename)
-                if file_size >= MAX_FILE_SIZE:
-                    loop.run_until_complete(
-                        update_placeholder_text(
-                            chat_id,
-                            placeholder_message_id,
-                            bot,
-                            video_url,
-                            "File too large!",
+                entries=job.playlist_entries,
+                codec=job.codec,
+                cached=cached,
+            )  # Yields a single file unless URL is for a playlist
+        except FileTooLarge as e:
+            logger.info(f"Not downloading {video_url}: {e}")
+            await update_placeholder_text(
+                chat_id, placeholder_message_id, bot, video_url, "File too large!"
+            )
+            return
+        async for result in iterate_in_thread(results):
+            # Playlist tracks can each have their own placeholder
+            track_placeholder_id = (
+                track_placeholder_ids[result.index]
+                if result.index < len(track_placeholder_ids)
+                else placeholder_message_id
+            )
+            if result.error is None:
+                try:
+                    if isinstance(result.file, Cached):
+                        await send_found(
+                            bot, job, result, track_placeholder_id, directory
+                        )
+                    else:
+                        await send_downloaded(
+                            bot, job, key, result.file, track_placeholder_id
                         )
-                    )
                     continue
-
-                # Save the content to S3
-                s3_key = file.filename.replace("/tmp/", prefix)
-
-                with open(file.filename, "rb") as f:
-                    audio_bytes = f.read()
-                    s3_client.put_object(Bucket=S3_BUCKET, Key=s3_key, Body=audio_bytes)
-                    loop.run_until_complete(
-                        update_placeholder_audio_message(
-                            chat_id, placeholder_message_id, audio_bytes, bot, video_url
+                except Exception as e:
+                    # A playlist carries on without the track, redelivering the
+                    # record would send every other track again
+                    if not track_placeholder_ids:
+                        raise
+                    result = result._replace(error=e)
+                finally:
+                    if not isinstance(result.file, Cached):
+                        # Sent or not, it's in the download cache or will be
+                        # downloaded again, and the next tracks need the space.
+                        # Kept if it's needed in the warm scratch space.
+                        await asyncio.to_thread(
+                            scratch.release,
+                            result.file.filename,
+                            codec_key(result.file.key, job.codec) or key,
                         )
+            if isinstance(result.error, FileTooLarge):
+                if track_placeholder_ids:
+                    await update_placeholder_text(
+                        chat_id,
+                        track_placeholder_id,
+                        bot,
+                        result.url,
+                        "File too large!",
                     )
-        else:
-            for obj in existing["Contents"]:
-                s3_key = obj["Key"]
-                file_object = s3_client.get_object(Bucket=S3_BUCKET, Key=s3_key)
-                audio_bytes = file_object["Body"].read()
-                loop.run_until_complete(
-                    update_placeholder_audio_message(
-                        chat_id, placeholder_message_id, audio_bytes, bot, video_url
-                    )
+                continue
+            logger.error(
+                f"Failed to download or send {result.url}: {result.error}",
+                exc_info=result.error,
+            )
+            if track_placeholder_ids:
+                await update_placeholder_text(
+                    chat_id,
+                    track_placeholder_id,
+                    bot,
+                    result.url,
+                    "Download failed",
+                )
+                await asyncio.to_thread(
+                    record_error_message,
+                    chat_id,
+                    track_placeholder_id,
+                    result.url,
+                    result.error,
                 )
 
-        return {"statusCode": 200}
+
+async def send_found(bot, job: Job, result, placeholder_id, directory):
+    """Send a track the download stage found in the download cache"""
+    track_job = job._replace(
+        video_url=result.url, placeholder_message_id=placeholder_id
+    )
+    key = codec_key(result.file.key, job.codec)
+    if not await send_cached(bot, track_job, key, directory):
+        # Evicted since it was looked up, it's downloaded on the retry
+        raise LookupError(f"{result.file.key} is no longer cached")
+
+
+async def send_downloaded(bot, job: Job, key, file, placeholder_id):
+    """Store a downloaded track in the download cache and send it"""
+    chat_id = job.chat_id
+    file_size = os.path.getsize(file.filename)
+
+    # Save the content to S3, streamed from disk in parts
+    with span("s3_store", bytes=file_size):
+        await asyncio.to_thread(
+            download_cache.store,
+            codec_key(file.key, job.codec) or key,
+            file.filename,
+            artist=file.artist,
+            title=file.title,
+            duration=file.duration,
+        )
+
+    if file_size >= MAX_FILE_SIZE:
+        await send_in_parts(
+            bot,
+            chat_id,
+            placeholder_id,
+            file.filename,
+            file.url,
+            file.title,
+            file.artist,
+            file.duration,
+        )
+        return
+
+    with open(file.filename, "rb") as f, span("send_audio", bytes=file_size):
+        message = await update_placeholder_audio_message(
+            chat_id, placeholder_id, f, bot, file.url
+        )
+    await asyncio.to_thread(
+        remember_file_id, codec_key(file.key, job.codec) or key, message
+    )
+
+
+async def send_in_parts(
+    bot, chat_id, message_id, filename, url, title, artist=None, duration=None
+):
+    if not SPLIT_LARGE_FILES:
+        await update_placeholder_text(chat_id, message_id, bot, url, "File too large!")
+        return
+    with span("split") as split:
+        parts = await asyncio.to_thread(split_track, filename, title, artist, duration)
+        split.set(parts=len(parts))
+    try:
+        with span("send_audio", bytes=os.path.getsize(filename)):
+            await update_placeholder_audio_parts(chat_id, message_id, parts, bot, url)
+    finally:
+        for part in parts:
+            os.remove(part)
+
+
+async def report_completion(dispatch_id):
+    try:
+        await asyncio.to_thread(completions.complete, dispatch_id)
+    except Exception as e:
+        logger.warning(f"Could not report {dispatch_id} done ({e})")
+
+
+async def process_records(bot, records) -> list[tuple[dict, Exception]]:
+    """Process every record, up to RECORD_CONCURRENCY at once, and return the
+    ones that failed along with their errors"""
+    semaphore = asyncio.Semaphore(RECORD_CONCURRENCY)
+
+    async def process(record):
+        async with semaphore:
+            job = parse_record(record)
+            # Each record runs in its own task, so the ID is only set for this job
+            correlation_id.set(job.correlation_id or new_correlation_id())
+            retry_attempts.set(job.attempts)
+            with span("job", url=job.video_url, chat_id=job.chat_id):
+                await process_job(bot, job)
+            # Not when the job raised: the record is delivered again
+            if completions and job.dispatch_id:
+                await report_completion(job.dispatch_id)
+
+    results = await asyncio.gather(
+        *(process(record) for record in records), return_exceptions=True
+    )
+    failures = []
+    for record, result in zip(records, results):
+        if isinstance(result, Exception):
+            logger.error(f"Failed to process record: {result}", exc_info=result)
+            failures.append((record, result))
+    return failures
+
+
+def lambda_handler(event, _):
+    runtime = get_runtime()
+    failures = runtime.run(process_records(runtime.bot, event["Records"]))
+    # Finish the yt-dlp cache's background writes before Lambda freezes the process
+    yt_downloader_cache.backend.flush()
+    logger.info(f"yt-dlp cache stats: {dict(yt_downloader_cache.backend.stats)}")
+    logger.info(f"Scratch space: {scratch.metrics()}")
+    for record, error in failures:
+        # SNS invokes with one record at a time and retries on error
+        if "Sns" in record:
+            raise error
+    # SQS only redelivers the records listed here (needs ReportBatchItemFailures
+    # enabled on the event source mapping)
+    return {
+        "statusCode": 200,
+        "batchItemFailures": [
+            {"itemIdentifier": record["messageId"]} for record, _ in failures
+        ],
+    }
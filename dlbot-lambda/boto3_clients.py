@@ -1,5 +1,8 @@
 import boto3
+from botocore.config import Config
 
-sns_client = boto3.client("sns", region_name="eu-west-2")
-s3_client = boto3.client("s3")
-dynamodb_client = boto3.resource("dynamodb")
+# Created once per container, so warm invocations reuse the pooled connections
+CLIENT_CONFIG = Config(max_pool_connections=16, tcp_keepalive=True)
+
+s3_client = boto3.client("s3", config=CLIENT_CONFIG)
+dynamodb_client = boto3.resource("dynamodb", config=CLIENT_CONFIG)
@@ -0,0 +1,62 @@
+import re
+from urllib.parse import parse_qs, urlparse
+
+YOUTUBE_HOSTS = {
+    "youtube.com",
+    "www.youtube.com",
+    "m.youtube.com",
+    "music.youtube.com",
+    "youtube-nocookie.com",
+    "www.youtube-nocookie.com",
+    "youtu.be",
+}
+YOUTUBE_PATH_PATTERN = re.compile(r"^/(?:shorts|embed|live|v)/([^/?#]+)")
+YOUTUBE_ID_PATTERN = re.compile(r"^[0-9A-Za-z_-]{11}$")
+
+
+def youtube_video_id(url: str) -> str | None:
+    parsed = urlparse(url)
+    host = (parsed.hostname or "").lower()
+    if host not in YOUTUBE_HOSTS:
+        return None
+    if host == "youtu.be":
+        candidate = parsed.path.strip("/").split("/")[0]
+    elif parsed.path == "/watch":
+        candidate = parse_qs(parsed.query).get("v", [""])[0]
+    else:
+        match = YOUTUBE_PATH_PATTERN.match(parsed.path)
+        candidate = match.group(1) if match else ""
+    return candidate if YOUTUBE_ID_PATTERN.match(candidate) else None
+
+
+def make_key(extractor: str, video_id: str) -> str:
+    return f"{extractor.lower()}/{video_id.replace('/', '_')}"
+
+
+def info_key(info: dict) -> str:
+    """Cache key for an already extracted yt-dlp info dict"""
+    return make_key(info.get("extractor_key") or info["extractor"], info["id"])
+
+
+def canonical_key(url: str) -> str | None:
+    """Normalise a video URL to an `extractor/video_id` key, or None if unknown.
+
+    YouTube links (youtu.be, watch?v=...&t=30, music.youtube.com, shorts) are
+    resolved without touching yt-dlp; anything else falls back to matching the
+    URL against yt-dlp's extractors.
+    """
+    video_id = youtube_video_id(url)
+    if video_id is not None:
+        return make_key("youtube", video_id)
+
+    from yt_dlp.extractor import gen_extractor_classes
+
+    for ie in gen_extractor_classes():
+        if ie.ie_key() == "Generic" or not ie.suitable(url):
+            continue
+        try:
+            temp_id = ie.get_temp_id(url)
+        except Exception:
+            temp_id = None
+        return make_key(ie.ie_key(), temp_id) if temp_id else None
+    return None
@@ -1,5 +1,49 @@
 import os
 
+# Sizes and bitrates shared with the bot
+from audio_limits import (
+    MAX_FILE_SIZE,
+    MIN_AUDIO_BITRATE,
+    SIZE_MARGIN,
+    SPLIT_LARGE_FILES,
+)
+
 S3_BUCKET = os.environ.get("S3_BUCKET", "dlbot")
 CACHE_KEY = "/cache"
 MAX_AUDIO_UPDATE_RETRIES = 5
+RETRY_BACKOFF = int(os.environ.get("RETRY_BACKOFF", 300))  # Seconds before a retry
+DOWNLOADS_PREFIX = "downloads"
+FILE_IDS_TABLE = os.environ.get("FILE_IDS_TABLE")
+FILE_IDS_DB = os.environ.get("FILE_IDS_DB", "/tmp/file_ids.sqlite3")
+LEASES_TABLE = os.environ.get("LEASES_TABLE")
+# Telegram RetryAfter pauses shared with the bot and the other containers
+RATE_LIMIT_TABLE = os.environ.get("RATE_LIMIT_TABLE")
+LEASES_DB = os.environ.get("LEASES_DB", "/tmp/leases.sqlite3")
+DOWNLOAD_LEASE_TTL = int(os.environ.get("DOWNLOAD_LEASE_TTL", 300))  # Seconds
+# The lease is renewed this often while its download runs, so it only expires
+# if the worker holding it dies
+LEASE_RENEW_INTERVAL = DOWNLOAD_LEASE_TTL / 3
+LEASE_POLL_INTERVAL = 2.0  # Seconds between cache checks while another worker downloads
+PLAYLIST_WORKERS = int(os.environ.get("PLAYLIST_WORKERS", 4))
+RECORD_CONCURRENCY = int(os.environ.get("RECORD_CONCURRENCY", 4))
+WORKER_QUEUE_URL = os.environ.get("WORKER_QUEUE_URL")  # For worker.py
+WORKER_POLL_WAIT = 20  # Seconds, the longest SQS long poll
+# Downloads in progress, see scratch.py. The quota leaves room on Lambda's
+# default 512MB /tmp for the caches and databases kept there.
+SCRATCH_DIR = os.environ.get("SCRATCH_DIR", "/tmp/dlbot-scratch")
+SCRATCH_QUOTA = int(os.environ.get("SCRATCH_QUOTA", 400e6))
+# Room a job needs to start: a download and its conversion
+SCRATCH_JOB_RESERVE = int(os.environ.get("SCRATCH_JOB_RESERVE", 100e6))
+# Bytes of finished tracks kept to send again without S3, off by default
+SCRATCH_WARM_CACHE = int(os.environ.get("SCRATCH_WARM_CACHE", 0))
+# Playlist tracks downloaded ahead of the one being sent, and the most bytes
+# they may take up, by default a share of the quota for each of the
+# RECORD_CONCURRENCY jobs that may run at once
+PLAYLIST_LOOKAHEAD = int(os.environ.get("PLAYLIST_LOOKAHEAD", 4))
+PLAYLIST_TMP_BUDGET = int(
+    os.environ.get("PLAYLIST_TMP_BUDGET", SCRATCH_QUOTA // RECORD_CONCURRENCY)
+)
+YTDLP_CACHE_DIR = os.environ.get("YTDLP_CACHE_DIR", "/tmp/yt-dlp-cache")
+NEGATIVE_CACHE_TTL = 300  # Seconds to remember yt-dlp cache keys that don't exist
+DEFAULT_AUDIO_CODEC = os.environ.get("DEFAULT_AUDIO_CODEC", "auto")
+STREAM_CONVERSION = os.environ.get("STREAM_CONVERSION", "false").lower() == "true"
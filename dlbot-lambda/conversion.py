@@ -0,0 +1,162 @@
+import logging
+import math
+import subprocess
+from typing import NamedTuple
+
+from audio_limits import too_long
+from constants import (
+    DEFAULT_AUDIO_CODEC,
+    MAX_FILE_SIZE,
+    MIN_AUDIO_BITRATE,
+    SIZE_MARGIN,
+    SPLIT_LARGE_FILES,
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Output codec -> acodec prefixes yt-dlp reports for streams that can be copied as is
+COPYABLE_CODECS = {
+    "mp3": ("mp3",),
+    "m4a": ("mp4a", "aac"),
+    "opus": ("opus",),
+}
+ENCODERS = {
+    "mp3": ["-codec:a", "libmp3lame", "-q:a", "5"],
+    "m4a": ["-codec:a", "aac", "-b:a", "192k"],
+    "opus": ["-codec:a", "libopus", "-b:a", "128k"],
+}
+ENCODER_NAMES = {"mp3": "libmp3lame", "m4a": "aac", "opus": "libopus"}
+# Typical output bitrates (kbps) of ENCODERS, for estimating sizes
+ENCODER_BITRATES = {"mp3": 130, "m4a": 192, "opus": 128}
+# Telegram only plays MP3 and M4A as audio, prefer whichever can be remuxed
+AUTO_CODECS = ("m4a", "mp3")
+STREAMABLE_PROTOCOLS = ("http", "https")
+
+
+class FileTooLarge(Exception):
+    def __init__(self, estimated_size):
+        super().__init__(f"Estimated size {estimated_size / 1e6:.0f}MB is too large")
+        self.estimated_size = estimated_size
+
+
+class ConversionPlan(NamedTuple):
+    format: str  # yt-dlp format selector to download
+    ext: str  # Output codec/extension
+    remux: bool  # Copy the audio stream into the new container instead of re-encoding
+    source: dict | None = None  # The selected format, if it was known up front
+    bitrate: int | None = None  # Reduced bitrate (kbps) so the output fits
+
+    @property
+    def streamable(self) -> bool:
+        """Whether ffmpeg can read the source URL directly, converting while
+        it downloads instead of after"""
+        return (
+            self.source is not None
+            and self.source.get("protocol") in STREAMABLE_PROTOCOLS
+            and bool(self.source.get("url"))
+        )
+
+
+def audio_formats(formats) -> list[dict]:
+    return [
+        f
+        for f in formats or []
+        if f.get("vcodec") == "none" and f.get("acodec") not in (None, "none")
+    ]
+
+
+def best(formats) -> dict | None:
+    return max(formats, key=lambda f: f.get("abr") or f.get("tbr") or 0, default=None)
+
+
+def estimate_size(fmt, duration) -> float | None:
+    """Size in bytes from the format's metadata, or duration x bitrate"""
+    if size := fmt.get("filesize") or fmt.get("filesize_approx"):
+        return size
+    if duration and (bitrate := fmt.get("abr") or fmt.get("tbr")):
+        return duration * bitrate * 125
+
+
+def plan_conversion(
+    info, codec=None, max_size=MAX_FILE_SIZE, allow_split=SPLIT_LARGE_FILES
+) -> ConversionPlan:
+    """Pick the format to download and whether it needs transcoding.
+
+    `codec` is "mp3", "m4a", "opus" or "auto" (the default, see
+    DEFAULT_AUDIO_CODEC). If an audio-only stream already uses the requested
+    codec it is remuxed, which is much cheaper than decoding and re-encoding;
+    "auto" takes any stream Telegram can play as is, and only transcodes to MP3
+    when there is none.
+
+    Sizes are estimated before anything is downloaded: streams that wouldn't
+    fit in `max_size` aren't remuxed and transcodes get a lower bitrate. If
+    even MIN_AUDIO_BITRATE wouldn't fit, the track is planned at normal quality
+    (the output's size decides whether it's sent in parts), or FileTooLarge is
+    raised when `allow_split` is off.
+    """
+    codec = codec or DEFAULT_AUDIO_CODEC
+    duration = info.get("duration")
+    limit = max_size * SIZE_MARGIN
+    candidates = audio_formats(info.get("formats"))
+    for output in AUTO_CODECS if codec == "auto" else (codec,):
+        copyable = [
+            f
+            for f in candidates
+            if f["acodec"].startswith(COPYABLE_CODECS[output])
+            and (estimate_size(f, duration) or 0) <= limit
+        ]
+        if source := best(copyable):
+            return ConversionPlan(source["format_id"], output, True, source)
+
+    output = "mp3" if codec == "auto" else codec
+    bitrate = None
+    if duration and duration * ENCODER_BITRATES[output] * 125 > limit:
+        if too_long(duration, max_size):
+            if not allow_split:
+                raise FileTooLarge(duration * MIN_AUDIO_BITRATE * 125)
+            return plan_conversion(info, codec, math.inf, allow_split=False)
+        bitrate = int(limit / (duration * 125))
+    if source := best(candidates):
+        return ConversionPlan(source["format_id"], output, False, source, bitrate)
+    return ConversionPlan("bestaudio/best", output, False, bitrate=bitrate)
+
+
+def ffmpeg_command(plan: ConversionPlan, source, filename) -> list[str]:
+    if plan.remux:
+        codec_args = ["-codec:a", "copy"]
+    elif plan.bitrate:
+        codec_args = ["-codec:a", ENCODER_NAMES[plan.ext], "-b:a", f"{plan.bitrate}k"]
+    else:
+        codec_args = ENCODERS[plan.ext]
+    container_args = ["-movflags", "+faststart"] if plan.ext == "m4a" else []
+    return [
+        "ffmpeg",
+        "-y",
+        "-loglevel",
+        "error",
+        *source,
+        "-vn",
+        *codec_args,
+        *container_args,
+        filename,
+    ]
+
+
+def convert(plan: ConversionPlan, source, filename):
+    """Remux or transcode a downloaded file"""
+    logger.info(f"{'Remuxing' if plan.remux else 'Transcoding'} {source}")
+    subprocess.run(ffmpeg_command(plan, ["-i", source], filename), check=True)
+
+
+def stream_convert(plan: ConversionPlan, filename):
+    """Have ffmpeg read the selected format straight from its URL, so the
+    download and the conversion happen in a single pass"""
+    headers = "".join(
+        f"{name}: {value}\r\n"
+        for name, value in (plan.source.get("http_headers") or {}).items()
+    )
+    source = ["-headers", headers] if headers else []
+    source += ["-i", plan.source["url"]]
+    logger.info(f"Streaming format {plan.format} into {filename}")
+    subprocess.run(ffmpeg_command(plan, source, filename), check=True)
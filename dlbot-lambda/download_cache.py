@@ -0,0 +1,99 @@
+import json
+import logging
+import os
+import tempfile
+from typing import IO, NamedTuple
+
+from boto3_clients import s3_client
+from constants import DOWNLOADS_PREFIX, S3_BUCKET
+from runtime import TRANSFER_CONFIG
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class CachedTrack(NamedTuple):
+    key: str
+    s3_key: str
+    artist: str | None
+    title: str | None
+    size: int
+    duration: float | None
+    format: str
+
+
+class DownloadCache:
+    """Finished MP3s in S3, addressed by canonical `extractor/video_id` key.
+
+    Each entry is `downloads/<key>/<video_id>.<ext>` plus a `manifest.json`
+    next to it. The manifest is written last, so an entry only becomes
+    visible once the audio object is complete.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(self, client=s3_client, bucket=S3_BUCKET, prefix=DOWNLOADS_PREFIX):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def _manifest_key(self, key):
+        return f"{self.prefix}/{key}/{self.MANIFEST}"
+
+    def lookup(self, key) -> CachedTrack | None:
+        try:
+            obj = self.client.get_object(
+                Bucket=self.bucket, Key=self._manifest_key(key)
+            )
+        except self.client.exceptions.NoSuchKey:
+            return None
+        except Exception as e:
+            logger.warning(f"Download cache lookup for {key} failed ({e})")
+            return None
+        manifest = json.loads(obj["Body"].read())
+        return CachedTrack(key=key, **manifest)
+
+    def open(self, track: CachedTrack) -> IO[bytes]:
+        """Stream the cached audio to a temporary file on disk and return it,
+        positioned at the start. The file is deleted when closed."""
+        f = tempfile.TemporaryFile()
+        try:
+            self.client.download_fileobj(
+                self.bucket, track.s3_key, f, Config=TRANSFER_CONFIG
+            )
+        except Exception:
+            f.close()
+            raise
+        f.seek(0)
+        return f
+
+    def download(self, track: CachedTrack, filename) -> str:
+        self.client.download_file(
+            self.bucket, track.s3_key, filename, Config=TRANSFER_CONFIG
+        )
+        return filename
+
+    def store(
+        self, key, filename, artist=None, title=None, duration=None
+    ) -> CachedTrack:
+        _, ext = os.path.splitext(filename)
+        s3_key = f"{self.prefix}/{key}/{os.path.basename(filename)}"
+        self.client.upload_file(filename, self.bucket, s3_key, Config=TRANSFER_CONFIG)
+        track = CachedTrack(
+            key=key,
+            s3_key=s3_key,
+            artist=artist,
+            title=title,
+            size=os.path.getsize(filename),
+            duration=duration,
+            format=ext.lstrip("."),
+        )
+        manifest = track._asdict()
+        del manifest["key"]
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self._manifest_key(key),
+            Body=json.dumps(manifest),
+            ContentType="application/json",
+        )
+        return track
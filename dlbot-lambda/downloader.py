@@ -0,0 +1,272 @@
+"""Everything that needs yt-dlp. Imported only when a track has to be
+downloaded, so invocations served from the caches never load yt-dlp and its
+extractors."""
+
+import json
+import logging
+import os
+from functools import partial
+from typing import NamedTuple, Type
+
+import requests
+import yt_dlp
+from yt_dlp.cache import Cache
+
+import yt_downloader_cache
+from cache_keys import info_key
+from constants import STREAM_CONVERSION
+from conversion import convert, plan_conversion, stream_convert
+from lib import set_tags
+from pipeline import TrackResult, run_pipeline
+from tracing import span
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+BOT_TOKEN = os.environ["BOT_TOKEN"]
+
+# Reused across warm invocations to keep the connection to api.telegram.org open
+telegram_session = requests.Session()
+
+
+def send_message_blocking(chat_id, text) -> int:
+    r = telegram_session.get(
+        f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage?chat_id={chat_id}&text={text}"
+    )
+    if r.ok:
+        return r.json()["result"]["message_id"]
+
+
+# Conversion is planned per track (see conversion.py) rather than always
+# running the FFmpegExtractAudio postprocessor. Files go in the job's scratch
+# directory (see get_opts), named apart from the converted `<id>.<ext>`, which
+# may have the same extension.
+DOWNLOAD_OPTIONS = {
+    "outtmpl": "%(id)s.download.%(ext)s",
+    "format": "bestaudio/best",
+    "cachedir": False,
+    "logtostderr": True,
+}
+
+# Fields of a url_transparent result that don't override the resolved video's
+TRANSPARENT_SKIPPED = ("_type", "url", "id", "extractor", "extractor_key", "ie_key")
+
+
+class File(NamedTuple):
+    filename: str
+    artist: str
+    title: str
+    url: str
+    key: str | None = None
+    duration: float | None = None
+
+
+class Cached(NamedTuple):
+    """A track found in the download cache once its key was known, returned
+    instead of downloading it again"""
+
+    url: str
+    key: str
+
+
+def file_size(file: File | Cached) -> int:
+    """Bytes a track takes up in the job's directory"""
+    return 0 if isinstance(file, Cached) else os.path.getsize(file.filename)
+
+
+class S3PersistentCache(Cache):
+    """yt-dlp cache (player signatures, nsig functions, oauth tokens) backed by
+    memory, then /tmp, then S3 (`yt_downloader_cache.backend`)"""
+
+    def store(self, section, key, data, dtype="json"):
+        from yt_dlp.cache import __version__
+
+        self._ydl.write_debug(f"Saving {section}.{key} to cache")
+        string = json.dumps({"yt-dlp_version": __version__, "data": data})
+        yt_downloader_cache.backend.put(f"{section}/{key}", string)
+
+    def load(self, section, key, dtype="json", default=None, *, min_ver=None):
+        self._ydl.write_debug(f"Loading {section}.{key} from cache")
+        string = yt_downloader_cache.backend.get(f"{section}/{key}")
+        if string is None:
+            return default
+        try:
+            return self._validate(json.loads(string), min_ver)
+        except (ValueError, KeyError) as e:
+            self._ydl.report_warning(f"Cache retrieval of {section}.{key} failed ({e})")
+        return default
+
+
+class Downloader(yt_dlp.YoutubeDL):
+    def __init__(self, options, cache_cls: Type[Cache] = S3PersistentCache):
+        options["username"] = "oauth2"
+        options["password"] = ""
+        super().__init__(options)
+        self.cache = cache_cls(self)
+
+
+def parse_metadata(result):
+    artist = result.get("artist", None)
+    if artist:
+        artists = artist.split(", ")
+        artist = ", ".join(sorted(set(artists), key=lambda x: artists.index(x)))
+    title = result.get("title") or result.get("alt_title")
+    try:
+        if artist is None and " - " in title:
+            artist = title.split(" - ")[0]
+            title = title.split(" - ")[-1]
+    except IndexError:
+        artist = None
+        title = result.get("title") or result.get("alt_title")
+    logger.info(f"Returning: {artist}, {title}")
+    return artist, title
+
+
+def get_opts(directory):
+    opts = DOWNLOAD_OPTIONS.copy()
+    opts["paths"] = {"home": directory, "temp": directory}
+    return opts
+
+
+def resolve(ydl, result) -> dict:
+    """The info dict of the video an unprocessed extraction result leads to:
+    the first entry of a playlist (e.g. a watch?v=...&list=RD... link), and
+    `url`/`url_transparent` results extracted in turn, as yt-dlp's own
+    processing would"""
+    while True:
+        if result.get("_type") in ("playlist", "multi_video"):
+            result = next(iter(result["entries"]))
+        elif result.get("_type") in ("url", "url_transparent"):
+            resolved = ydl.extract_info(
+                result["url"],
+                download=False,
+                ie_key=result.get("ie_key"),
+                process=False,
+            )
+            if result["_type"] == "url_transparent":
+                # The outer result's metadata wins, as in yt-dlp
+                resolved = {
+                    **resolved,
+                    **{
+                        name: value
+                        for name, value in result.items()
+                        if value is not None and name not in TRANSPARENT_SKIPPED
+                    },
+                }
+            result = resolved
+        else:
+            return result
+
+
+def download_audio(url, directory, cache_cls=Cache, codec=None, cached=None):
+    """Download stage: extract the formats, plan the conversion and fetch the
+    chosen audio stream into `directory`, without running any postprocessor.
+
+    `cached(key)` says whether the download cache has the track, checked as soon
+    as extraction gives its key (URLs without a canonical key can't be looked
+    up before that). If it does, the track is returned as Cached instead.
+    """
+    opts = get_opts(directory)
+    with span("extract", url=url) as extract, Downloader(opts, cache_cls) as ydl:
+        result = resolve(ydl, ydl.extract_info(url, download=False, process=False))
+        key = info_key(result)
+        if cached is not None and cached(key):
+            extract.set(cached=True)
+            return Cached(url, key)
+        plan = plan_conversion(result, codec)
+        extract.set(format=plan.format, remux=plan.remux)
+        if STREAM_CONVERSION and plan.streamable:
+            return url, result, None, plan
+
+    opts = get_opts(directory)
+    opts["format"] = plan.format
+    with span("download", url=url) as download, Downloader(opts, cache_cls) as ydl:
+        info = ydl.process_ie_result(result, download=True)
+        filepath = info["requested_downloads"][0]["filepath"]
+        download.set(bytes=os.path.getsize(filepath))
+        return url, info, filepath, plan
+
+
+def convert_audio(downloaded, directory):
+    """Conversion stage: remux or transcode the download, or stream it from the
+    source URL when the download stage skipped it. Cached tracks pass through."""
+    if isinstance(downloaded, Cached):
+        return downloaded
+    url, info, source, plan = downloaded
+    filename = os.path.join(directory, f"{info['id']}.{plan.ext}")
+    with span("convert", url=url, remux=plan.remux, stream=source is None) as conv:
+        if source is None:
+            stream_convert(plan, filename)
+        elif source != filename:
+            convert(plan, source, filename)
+            os.remove(source)
+        if not os.path.exists(filename):
+            raise FileNotFoundError(filename)
+        conv.set(bytes=os.path.getsize(filename))
+    artist, title = parse_metadata(info)
+    with span("set_tags"):
+        set_tags(filename, title, artist)
+    return File(filename, artist, title, url, info_key(info), info.get("duration"))
+
+
+def download_single_url(url, directory, cache_cls=Cache, codec=None, cached=None):
+    downloaded = download_audio(url, directory, cache_cls, codec, cached)
+    return convert_audio(downloaded, directory), 0
+
+
+def download_playlist(
+    url,
+    directory,
+    chat_id=None,
+    cache_cls=Cache,
+    entries=None,
+    codec=None,
+    cached=None,
+):
+    """Download the videos in the playlist concurrently, yielding a TrackResult
+    for each one as soon as it is ready. `entries` are the entry URLs when the
+    bot has already extracted (and announced) the playlist."""
+    if entries is None:
+        with Downloader({"extract_flat": True}, cache_cls) as flat:
+            info = flat.extract_info(url, download=False)
+            title = info["title"]
+            count = info["playlist_count"]
+            send_message_blocking(chat_id, f"{title} ({count} tracks)")
+        entries = [entry["url"] for entry in info["entries"]]
+    yield from run_pipeline(
+        entries,
+        partial(
+            download_audio,
+            directory=directory,
+            cache_cls=cache_cls,
+            codec=codec,
+            cached=cached,
+        ),
+        partial(convert_audio, directory=directory),
+        size=file_size,
+    )
+
+
+def download_url(
+    url: str,
+    directory,
+    chat_id=None,
+    cache_cls=Cache,
+    entries=None,
+    codec=None,
+    cached=None,
+):
+    """Download `url` into `directory`, a job's scratch directory. Tracks
+    `cached` says are in the download cache come back as Cached."""
+    if "playlist" in url:
+        return download_playlist(
+            url, directory, chat_id, cache_cls, entries, codec, cached
+        )
+    else:
+        file, exit_code = download_single_url(url, directory, cache_cls, codec, cached)
+        if not exit_code:
+            return (f for f in [TrackResult(0, url, file)])
+        raise StopIteration
+
+
+if __name__ == "__main__":
+    print(download_url("https://www.youtube.com/watch?v=bgWUwywrXOM", "/tmp"))
@@ -0,0 +1,59 @@
+import os
+import sqlite3
+import threading
+
+from boto3_clients import dynamodb_client
+from constants import FILE_IDS_DB, FILE_IDS_TABLE
+
+
+class DynamoFileIdStore:
+    """Canonical video key -> Telegram file_id, in a DynamoDB table keyed on `key`"""
+
+    def __init__(self, table):
+        self.table = table
+
+    def get(self, key) -> str | None:
+        row = self.table.get_item(Key={"key": key})
+        return row["Item"]["file_id"] if "Item" in row else None
+
+    def put(self, key, file_id):
+        self.table.put_item(Item={"key": key, "file_id": file_id})
+
+    def delete(self, key):
+        self.table.delete_item(Key={"key": key})
+
+
+class SQLiteFileIdStore:
+    """Local stand-in for DynamoFileIdStore (development, load tests)"""
+
+    def __init__(self, path=FILE_IDS_DB):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS file_ids (key TEXT PRIMARY KEY, file_id TEXT)"
+        )
+
+    def get(self, key) -> str | None:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT file_id FROM file_ids WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, file_id):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO file_ids (key, file_id) VALUES (?, ?)",
+                (key, file_id),
+            )
+
+    def delete(self, key):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM file_ids WHERE key = ?", (key,))
+
+
+def get_file_id_store():
+    if FILE_IDS_TABLE:
+        return DynamoFileIdStore(dynamodb_client.Table(FILE_IDS_TABLE))
+    os.makedirs(os.path.dirname(FILE_IDS_DB), exist_ok=True)
+    return SQLiteFileIdStore(FILE_IDS_DB)
@@ -1,84 +1,33 @@
 import asyncio
-import io
 import logging
 import os
-from random import randint
-from typing import NamedTuple, Type
-
-import requests
-import yt_dlp
-from mutagen.easyid3 import EasyID3
-from telegram import Bot, InputMediaAudio
-from telegram.error import RetryAfter
-from yt_dlp.cache import Cache
-
-from yt_downloader_cache import S3PersistentCache
-from constants import MAX_AUDIO_UPDATE_RETRIES
+import time
+from contextvars import ContextVar
+
+from telegram import Bot, InputMediaAudio, Message
+from telegram.error import BadRequest
+
+from constants import MAX_AUDIO_UPDATE_RETRIES, RATE_LIMIT_TABLE, RETRY_BACKOFF
+from ratelimit import get_rate_limiter
+from splitter import split_audio
 from boto3_clients import dynamodb_client
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
-BOT_TOKEN = os.environ["BOT_TOKEN"]
 
-
-def send_message_blocking(chat_id, text) -> int:
-    r = requests.get(
-        f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage?chat_id={chat_id}&text={text}"
-    )
-    if r.ok:
-        return r.json()["result"]["message_id"]
-
-
-DOWNLOAD_OPTIONS = {
-    "paths": {"home": "/tmp/", "temp": "/tmp/"},
-    "outtmpl": "%(id)s.%(ext)s",
-    "format": "bestaudio/best",
-    "cachedir": False,
-    "logtostderr": True,
-    "postprocessors": [
-        {
-            "key": "FFmpegExtractAudio",
-            "preferredcodec": "mp3",
-        }
-    ],
-}
-
-
-class File(NamedTuple):
-    filename: str
-    artist: str
-    title: str
-    url: str
-
-
-class Downloader(yt_dlp.YoutubeDL):
-    def __init__(self, options, cache_cls: Type[Cache] = S3PersistentCache):
-        options["username"] = "oauth2"
-        options["password"] = ""
-        super().__init__(options)
-        self.cache = cache_cls(self)
-
-
-def parse_metadata(result):
-    artist = result.get("artist", None)
-    if artist:
-        artists = artist.split(", ")
-        artist = ", ".join(sorted(set(artists), key=lambda x: artists.index(x)))
-    title = result.get("title") or result.get("alt_title")
-    try:
-        if artist is None and " - " in title:
-            artist = title.split(" - ")[0]
-            title = title.split(" - ")[-1]
-    except IndexError:
-        artist = None
-        title = result.get("title") or result.get("alt_title")
-    logger.info(f"Returning: {artist}, {title}")
-    return artist, title
+# Shared by every Telegram request this container makes
+rate_limiter = get_rate_limiter(
+    dynamodb_client.Table(RATE_LIMIT_TABLE) if RATE_LIMIT_TABLE else None
+)
 
 
 def set_tags(filepath, title, artist=None):
+    import mutagen
+
     try:
-        metatag = EasyID3(filepath)
+        metatag = mutagen.File(filepath, easy=True)
+        if metatag.tags is None:
+            metatag.add_tags()
         metatag["title"] = title
         if artist is not None:
             metatag["artist"] = artist
@@ -87,66 +36,42 @@ def set_tags(filepath, title, artist=None):
         logger.error(f"Error settings tags: {e}")
 
 
-def get_opts():
-    opts = DOWNLOAD_OPTIONS.copy()
-    return opts
-
-
-def download_single_url(url, cache_cls=Cache):
-    opts = get_opts()
-    with Downloader(opts, cache_cls) as ydl:
-        result = ydl.extract_info(url, download=True)
-        if "entries" in result:
-            info = result["entries"][0]
-        else:
-            info = result
-        artist, title = parse_metadata(info)
-        filename = f"/tmp/{info['id']}.mp3"
-        if not os.path.exists(filename):
-            raise FileNotFoundError
-        set_tags(filename, title, artist)
-        return File(filename, artist, title, url), 0
-
-
-def download_playlist(url, chat_id=None, cache_cls=Cache):
-    """Download each video in the playlist and return the information as a list of tuples"""
-    with Downloader({"extract_flat": True}, cache_cls) as flat:
-        info = flat.extract_info(url, download=False)
-        title = info["title"]
-        count = info["playlist_count"]
-        send_message_blocking(chat_id, f"{title} ({count} tracks)")
-    for entry in info["entries"]:
-        result, exit_code = download_single_url(entry["url"], cache_cls)
-        if not exit_code:
-            yield result
-
-
-def download_url(url: str, chat_id=None, cache_cls=Cache):
-    if "playlist" in url:
-        return download_playlist(url, chat_id, cache_cls)
-    else:
-        file, exit_code = download_single_url(url, cache_cls)
-        if not exit_code:
-            return (f for f in [file])
-        raise StopIteration
+def split_track(filename, title, artist=None, duration=None) -> list[str]:
+    """Split an oversized file into Telegram sized parts, tagged "Title (1/3)" etc."""
+    parts = split_audio(filename, duration)
+    for i, part in enumerate(parts, 1):
+        set_tags(part, f"{title} ({i}/{len(parts)})", artist)
+    return parts
 
 
 ERRORS_TABLE = os.environ["ERRORS_TABLE"]
-table = dynamodb_client.Table(ERRORS_TABLE)
-
-
-def record_error_message(chat_id, message_id, video_url):
-    table.put_item(
-        Item={
-            "chat_id": chat_id,
-            "message_id": message_id,
-            "video_url": video_url,
-        }
-    )
+table = None  # Only needed once something fails
+
+# Times the current job has been retried, set per job like the correlation ID
+retry_attempts: ContextVar[int] = ContextVar("retry_attempts", default=0)
+
+
+def record_error_message(chat_id, message_id, video_url, error=None):
+    """Save the failure for /retry and the bot's retry sweep, which tries it
+    again from `next_retry`, backing off exponentially with every attempt"""
+    global table
+    if table is None:
+        table = dynamodb_client.Table(ERRORS_TABLE)
+    attempts = retry_attempts.get()
+    item = {
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "video_url": video_url,
+        "attempts": attempts,
+        "next_retry": int(time.time() + RETRY_BACKOFF * 2**attempts),
+    }
+    if error is not None:
+        item["error"] = str(error)[:1000]
+    table.put_item(Item=item)
 
 
 async def update_placeholder_text(
-    chat_id, message_id, bot, video_url, message, record_error=False, retry=0
+    chat_id, message_id, bot, video_url, message, record_error=False
 ):
     dummy_audio = InputMediaAudio(
         media=b"",
@@ -154,48 +79,31 @@ async def update_placeholder_text(
         caption=video_url,
     )
     try:
-        await bot.edit_message_media(dummy_audio, chat_id, message_id)
+        await rate_limiter.call(
+            chat_id,
+            lambda: bot.edit_message_media(dummy_audio, chat_id, message_id),
+            retries=MAX_AUDIO_UPDATE_RETRIES,
+        )
     except Exception as e:
-        if isinstance(e, RetryAfter):
-            sleep_time = e.retry_after
-        else:
-            sleep_time = randint(3, 10)
-
-        if retry < MAX_AUDIO_UPDATE_RETRIES:
-            await asyncio.sleep(sleep_time)
-            logger.warning(
-                f"Retrying ({retry + 1}/{MAX_AUDIO_UPDATE_RETRIES}) (ERROR: {e})"
-            )
-            return await update_placeholder_text(
-                chat_id, message_id, bot, video_url, message, retry=retry + 1
-            )
         if record_error:
-            record_error_message(chat_id, message_id, video_url)
-
-        raise e
+            record_error_message(chat_id, message_id, video_url, e)
+        raise
 
 
 async def update_placeholder_audio_message(
-    chat_id, message_id, audio_bytes, bot: Bot, video_url, retry=0
+    chat_id, message_id, audio, bot: Bot, video_url
 ):
-    tg_audio = InputMediaAudio(audio_bytes)
+    """`audio` is bytes or an open file; files are read from the start on every
+    attempt, so only the copy being uploaded is held in memory"""
+
+    def edit():
+        if hasattr(audio, "seek"):
+            audio.seek(0)
+        return bot.edit_message_media(InputMediaAudio(audio), chat_id, message_id)
+
     try:
-        await bot.edit_message_media(tg_audio, chat_id, message_id)
+        return await rate_limiter.call(chat_id, edit, retries=MAX_AUDIO_UPDATE_RETRIES)
     except Exception as e:
-        if isinstance(e, RetryAfter):
-            sleep_time = e.retry_after
-        else:
-            sleep_time = randint(3, 10)
-
-        if retry < MAX_AUDIO_UPDATE_RETRIES:
-            await asyncio.sleep(sleep_time)
-            logger.warning(
-                f"Retrying ({retry + 1}/{MAX_AUDIO_UPDATE_RETRIES}) (ERROR: {e})"
-            )
-            return await update_placeholder_audio_message(
-                chat_id, message_id, audio_bytes, bot, video_url, retry=retry + 1
-            )
-
         await update_placeholder_text(
             chat_id,
             message_id,
@@ -203,9 +111,52 @@ async def update_placeholder_audio_message(
             video_url,
             "Error sending audio",
         )
-        record_error_message(chat_id, message_id, video_url)
-        raise e
+        record_error_message(chat_id, message_id, video_url, e)
+        raise
+
+
+async def update_placeholder_from_file_id(chat_id, message_id, file_id, bot: Bot):
+    """Send an audio Telegram already has by its file_id. Returns False if the
+    file_id was rejected (e.g. it expired), so the caller can fall back to
+    uploading the bytes."""
+    try:
+        await rate_limiter.call(
+            chat_id,
+            lambda: bot.edit_message_media(
+                InputMediaAudio(file_id), chat_id, message_id
+            ),
+        )
+    except BadRequest as e:
+        logger.warning(f"Sending cached file_id failed ({e})")
+        return False
+    return True
+
+
+async def update_placeholder_audio_parts(
+    chat_id, message_id, parts, bot: Bot, video_url
+):
+    """Send each part into its own copy of the placeholder. The copies are made
+    first, in order, so the parts appear in sequence however the concurrent
+    uploads finish."""
+    message_ids = [message_id]
+    for _ in parts[1:]:
+        copy = await rate_limiter.call(
+            chat_id, lambda: bot.copy_message(chat_id, chat_id, message_id)
+        )
+        message_ids.append(copy.message_id)
+    files = [open(part, "rb") for part in parts]
+    try:
+        await asyncio.gather(
+            *(
+                update_placeholder_audio_message(chat_id, part_id, f, bot, video_url)
+                for part_id, f in zip(message_ids, files)
+            )
+        )
+    finally:
+        for f in files:
+            f.close()
 
 
-if __name__ == "__main__":
-    print(download_url("https://www.youtube.com/watch?v=bgWUwywrXOM"))
+def sent_file_id(message) -> str | None:
+    if isinstance(message, Message) and message.audio is not None:
+        return message.audio.file_id
@@ -0,0 +1,133 @@
+import contextvars
+import logging
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Iterable, Iterator, NamedTuple
+
+from constants import PLAYLIST_LOOKAHEAD, PLAYLIST_TMP_BUDGET, PLAYLIST_WORKERS
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class TrackResult(NamedTuple):
+    index: int
+    url: str
+    file: Any = None
+    error: Exception | None = None
+
+
+def run_pipeline(
+    urls: Iterable[str],
+    download: Callable[[str], Any],
+    transcode: Callable[[Any], Any],
+    workers: int = PLAYLIST_WORKERS,
+    transcode_workers: int | None = None,
+    lookahead: int = PLAYLIST_LOOKAHEAD,
+    budget: int = PLAYLIST_TMP_BUDGET,
+    size: Callable[[Any], int] | None = None,
+) -> Iterator[TrackResult]:
+    """Download and transcode `urls` concurrently, yielding results as they finish.
+
+    `workers` downloads run at once; transcoding is a separate stage capped at the
+    CPU count, so ffmpeg never competes with itself for cores while the network
+    bound downloads keep going. Whatever consumes the results (S3 upload, sending
+    to Telegram) is the third stage and overlaps with both. Results arrive in
+    completion order, `TrackResult.index` maps them back to their position in
+    `urls`. A failure in either stage is returned as `TrackResult.error` and does
+    not affect the other tracks.
+
+    Tracks are started in order, and only `lookahead` of them are ever in progress
+    or finished but not yet consumed, so a slow consumer doesn't leave the whole
+    playlist on disk. With `size` (bytes a result takes up, e.g. its file on
+    /tmp) no further track is started while the finished ones waiting for the
+    consumer, and the ones in progress at the average size so far, would take up
+    `budget` bytes or more. A result counts as consumed once the
+    next one is asked for, so the consumer should remove its file first.
+    """
+    urls = list(urls)
+    pending = iter(enumerate(urls))
+    results = queue.Queue()
+    # Both stages run with the caller's context (e.g. the tracing correlation ID)
+    context = contextvars.copy_context()
+    lock = threading.Lock()
+    outstanding = 0  # Tracks started and not yet consumed
+    held = 0  # Bytes of finished tracks waiting for the consumer
+    sizes = {}  # index: bytes, of those tracks
+    waiting = 0  # Tracks finished and not yet consumed
+    measured = []  # Every size so far, to estimate the tracks in progress
+
+    def finished(result: TrackResult):
+        nonlocal held, waiting
+        if size is not None and result.file is not None:
+            try:
+                track_size = size(result.file)
+            except OSError as e:
+                logger.warning(f"Could not measure {result.url} ({e})")
+            else:
+                with lock:
+                    held += track_size
+                    sizes[result.index] = track_size
+                    measured.append(track_size)
+        with lock:
+            waiting += 1
+        results.put(result)
+
+    def on_transcoded(index, url, future):
+        try:
+            finished(TrackResult(index, url, future.result()))
+        except Exception as e:
+            logger.warning(f"Transcoding {url} failed ({e})")
+            finished(TrackResult(index, url, error=e))
+
+    def on_downloaded(transcodes, index, url, future):
+        try:
+            downloaded = future.result()
+        except Exception as e:
+            logger.warning(f"Downloading {url} failed ({e})")
+            finished(TrackResult(index, url, error=e))
+            return
+        transcodes.submit(context.copy().run, transcode, downloaded).add_done_callback(
+            partial(on_transcoded, index, url)
+        )
+
+    def expected_usage():
+        """Bytes of the finished tracks, plus the ones in progress at the
+        average size so far"""
+        with lock:
+            average = sum(measured) / len(measured) if measured else 0
+            return held + (outstanding - waiting) * average
+
+    def start_more(downloads, transcodes):
+        nonlocal outstanding
+        # Always keep at least one track going, however big the last one was
+        while outstanding < lookahead and (
+            not outstanding or expected_usage() < budget
+        ):
+            if (item := next(pending, None)) is None:
+                return
+            index, url = item
+            outstanding += 1
+            downloads.submit(context.copy().run, download, url).add_done_callback(
+                partial(on_downloaded, transcodes, index, url)
+            )
+
+    # The download pool is shut down (and its callbacks have run) before the
+    # transcode pool, so no transcode is ever submitted to a closed executor.
+    with ThreadPoolExecutor(
+        transcode_workers or os.cpu_count() or 1, thread_name_prefix="transcode"
+    ) as transcodes, ThreadPoolExecutor(
+        workers, thread_name_prefix="download"
+    ) as downloads:
+        start_more(downloads, transcodes)
+        for _ in urls:
+            result = results.get()
+            yield result
+            with lock:
+                held -= sizes.pop(result.index, 0)
+                waiting -= 1
+            outstanding -= 1
+            start_more(downloads, transcodes)
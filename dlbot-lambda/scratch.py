@@ -0,0 +1,231 @@
+"""Scratch space on /tmp for downloads, which outlives invocations in a warm
+container.
+
+Every job gets a directory of its own, removed with everything in it when the
+job ends, so nothing is left behind and a job never picks up another's files.
+A job only starts once SCRATCH_JOB_RESERVE bytes fit in SCRATCH_QUOTA, next to
+the usage of the whole SCRATCH_DIR and the part of the running jobs' reserves
+they haven't used yet. Playlist jobs are held to PLAYLIST_TMP_BUDGET, derived
+from the quota, by the download pipeline. With
+SCRATCH_WARM_CACHE set, finished tracks are kept (up to that many bytes) so
+they can be sent again without fetching them from S3, and are evicted least
+recently used first whenever a job needs the room.
+"""
+
+import asyncio
+import logging
+import os
+import shutil
+import threading
+import uuid
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+from hashlib import sha256
+from typing import IO
+
+from constants import (
+    MAX_FILE_SIZE,
+    SCRATCH_DIR,
+    SCRATCH_JOB_RESERVE,
+    SCRATCH_QUOTA,
+    SCRATCH_WARM_CACHE,
+)
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+QUOTA_POLL_INTERVAL = 1.0  # Seconds between checks while waiting for space
+
+
+def directory_size(path) -> int:
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += directory_size(entry.path)
+            else:
+                total += entry.stat(follow_symlinks=False).st_size
+        except FileNotFoundError:
+            pass  # Removed while counting
+    return total
+
+
+def process_alive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class ScratchSpace:
+    """Each process (e.g. every worker.py process) has its own directory under
+    `root`, but the quota covers all of them, as they share the disk"""
+
+    def __init__(
+        self,
+        root=SCRATCH_DIR,
+        quota=SCRATCH_QUOTA,
+        warm_cache=SCRATCH_WARM_CACHE,
+        job_reserve=SCRATCH_JOB_RESERVE,
+    ):
+        self.root = root
+        self.quota = quota
+        self.warm_cache = warm_cache
+        self.job_reserve = job_reserve
+        self.home = os.path.join(root, str(os.getpid()))
+        self.jobs_dir = os.path.join(self.home, "jobs")
+        self.warm_dir = os.path.join(self.home, "warm")
+        self.warm = OrderedDict()  # key: (filename, size), least recently used first
+        self.jobs = set()  # Directories of the running jobs
+        self.peak = 0
+        self.stats = Counter()
+        self.lock = threading.Lock()
+        self.remove_leftovers()
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        os.makedirs(self.warm_dir, exist_ok=True)
+
+    def remove_leftovers(self):
+        """Directories of processes that have gone, e.g. after the Lambda
+        runtime restarted within the same container, and this process's own"""
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.isdigit() and (
+                int(name) == os.getpid() or not process_alive(int(name))
+            ):
+                logger.info(f"Removing leftover scratch space {name}")
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+    def usage(self) -> int:
+        used = directory_size(self.root)
+        self.peak = max(self.peak, used)
+        return used
+
+    def warm_bytes(self) -> int:
+        return sum(size for _, size in self.warm.values())
+
+    def _reserved(self) -> int:
+        """Bytes promised to running jobs that they haven't used yet"""
+        return sum(
+            max(0, self.job_reserve - directory_size(directory))
+            for directory in self.jobs
+        )
+
+    def _evict_warm(self, needed, used) -> int:
+        while used + needed > self.quota and self.warm:
+            _, (filename, size) = self.warm.popitem(last=False)
+            self._remove(filename)
+            used -= size
+            self.stats["evicted"] += 1
+            self.stats["evicted_bytes"] += size
+        return used
+
+    def admit(self) -> str | None:
+        """A directory for a new job, if `job_reserve` bytes fit in the quota
+        along with what's used and what's reserved for the running jobs,
+        evicting warm tracks to make room. Checked and reserved under the lock,
+        so jobs starting together can't all count the same free space."""
+        with self.lock:
+            needed = self.job_reserve + self._reserved()
+            used = self._evict_warm(needed, self.usage())
+            if used + needed > self.quota:
+                if self.jobs:
+                    return None
+                # Nothing running to wait for
+                logger.warning(
+                    f"Scratch space is over quota without any job running "
+                    f"({used} bytes used)"
+                )
+            directory = os.path.join(self.jobs_dir, uuid.uuid4().hex)
+            os.makedirs(directory)
+            self.jobs.add(directory)
+            self.stats["jobs"] += 1
+            return directory
+
+    @asynccontextmanager
+    async def job(self):
+        """A new directory for one job's files, removed when the job ends.
+        Waits while there's no room for another job."""
+        waited = False
+        while (directory := await asyncio.to_thread(self.admit)) is None:
+            if not waited:
+                logger.info("Waiting for scratch space")
+                self.stats["waits"] += 1
+                waited = True
+            await asyncio.sleep(QUOTA_POLL_INTERVAL)
+        try:
+            yield directory
+        finally:
+            self.usage()  # Catch the job's peak
+            await asyncio.to_thread(shutil.rmtree, directory, True)
+            with self.lock:
+                self.jobs.discard(directory)
+
+    def _warm_filename(self, key, filename):
+        ext = os.path.splitext(filename)[1]
+        return os.path.join(self.warm_dir, sha256(key.encode()).hexdigest() + ext)
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+    def release(self, filename, key=None):
+        """Done with a job's file: keep it as the warm copy of `key` if it fits,
+        otherwise delete it. Files Telegram needs split aren't kept."""
+        size = os.path.getsize(filename)
+        if not key or size >= MAX_FILE_SIZE or size > self.warm_cache:
+            self._remove(filename)
+            return
+        warm_filename = self._warm_filename(key, filename)
+        with self.lock:
+            if key in self.warm:
+                self._remove(self.warm.pop(key)[0])
+            os.replace(filename, warm_filename)
+            self.warm[key] = (warm_filename, size)
+            self.stats["kept"] += 1
+            # Oldest first, down to the warm cache's own limit
+            while self.warm_bytes() > self.warm_cache:
+                _, (evicted, evicted_size) = self.warm.popitem(last=False)
+                self._remove(evicted)
+                self.stats["evicted"] += 1
+                self.stats["evicted_bytes"] += evicted_size
+
+    def open(self, key) -> tuple[IO[bytes], int] | None:
+        """The warm copy of `key` opened for reading, and its size. Opened under
+        the lock, so evicting it afterwards doesn't affect the reader."""
+        if not self.warm_cache or not key:
+            return None
+        with self.lock:
+            if key not in self.warm:
+                self.stats["warm_misses"] += 1
+                return None
+            filename, size = self.warm[key]
+            self.warm.move_to_end(key)
+            self.stats["warm_hits"] += 1
+            return open(filename, "rb"), size
+
+    def metrics(self) -> dict:
+        with self.lock:
+            warm_files, warm_bytes = len(self.warm), self.warm_bytes()
+            active, reserved = len(self.jobs), self._reserved()
+        return {
+            **self.stats,
+            "usage_bytes": self.usage(),
+            "peak_bytes": self.peak,
+            "quota_bytes": self.quota,
+            "warm_files": warm_files,
+            "warm_bytes": warm_bytes,
+            "reserved_bytes": reserved,
+            "active_jobs": active,
+        }
@@ -0,0 +1,108 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from boto3_clients import dynamodb_client
+from constants import DOWNLOAD_LEASE_TTL, LEASES_DB, LEASES_TABLE
+
+
+class DynamoLeaseStore:
+    """Download leases in a DynamoDB table keyed on `key`.
+
+    A lease is taken with a conditional put that only succeeds if nobody holds
+    it or the holder's lease has expired, so exactly one worker wins.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def acquire(self, key, owner, ttl=DOWNLOAD_LEASE_TTL) -> bool:
+        now = int(time.time())
+        try:
+            self.table.put_item(
+                Item={"key": key, "owner": owner, "expires": now + ttl},
+                ConditionExpression="attribute_not_exists(#k) OR expires < :now",
+                ExpressionAttributeNames={"#k": "key"},
+                ExpressionAttributeValues={":now": now},
+            )
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def renew(self, key, owner, ttl=DOWNLOAD_LEASE_TTL) -> bool:
+        """Push back the expiry of a lease `owner` still holds"""
+        try:
+            self.table.update_item(
+                Key={"key": key},
+                UpdateExpression="SET expires = :expires",
+                ConditionExpression="#o = :owner",
+                ExpressionAttributeNames={"#o": "owner"},
+                ExpressionAttributeValues={
+                    ":owner": owner,
+                    ":expires": int(time.time()) + ttl,
+                },
+            )
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+        return True
+
+    def release(self, key, owner):
+        try:
+            self.table.delete_item(
+                Key={"key": key},
+                ConditionExpression="#o = :owner",
+                ExpressionAttributeNames={"#o": "owner"},
+                ExpressionAttributeValues={":owner": owner},
+            )
+        except self.table.meta.client.exceptions.ConditionalCheckFailedException:
+            pass  # Expired and taken over by someone else
+
+
+class SQLiteLeaseStore:
+    """Local stand-in for DynamoLeaseStore (development, load tests)"""
+
+    def __init__(self, path=LEASES_DB):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS leases "
+            "(key TEXT PRIMARY KEY, owner TEXT, expires REAL)"
+        )
+
+    def acquire(self, key, owner, ttl=DOWNLOAD_LEASE_TTL) -> bool:
+        now = time.time()
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                "INSERT INTO leases (key, owner, expires) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET owner = excluded.owner, "
+                "expires = excluded.expires WHERE leases.expires < ?",
+                (key, owner, now + ttl, now),
+            )
+        return cursor.rowcount == 1
+
+    def renew(self, key, owner, ttl=DOWNLOAD_LEASE_TTL) -> bool:
+        with self.lock, self.db:
+            cursor = self.db.execute(
+                "UPDATE leases SET expires = ? WHERE key = ? AND owner = ?",
+                (time.time() + ttl, key, owner),
+            )
+        return cursor.rowcount == 1
+
+    def release(self, key, owner):
+        with self.lock, self.db:
+            self.db.execute(
+                "DELETE FROM leases WHERE key = ? AND owner = ?", (key, owner)
+            )
+
+
+def get_lease_store():
+    if LEASES_TABLE:
+        return DynamoLeaseStore(dynamodb_client.Table(LEASES_TABLE))
+    os.makedirs(os.path.dirname(LEASES_DB), exist_ok=True)
+    return SQLiteLeaseStore(LEASES_DB)
+
+
+def new_owner() -> str:
+    return uuid.uuid4().hex
@@ -0,0 +1,72 @@
+import glob
+import logging
+import math
+import os
+import subprocess
+
+from constants import MAX_FILE_SIZE, SIZE_MARGIN
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def probe_duration(filename) -> float:
+    result = subprocess.run(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-show_entries",
+            "format=duration",
+            "-of",
+            "csv=p=0",
+            filename,
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return float(result.stdout.strip())
+
+
+def split_audio(filename, duration=None, max_size=MAX_FILE_SIZE) -> list[str]:
+    """Cut `filename` into consecutive parts that are each under `max_size`.
+
+    Uses ffmpeg's segment muxer with stream copy, so the cuts land on frame
+    boundaries and nothing is re-encoded. Bitrates vary along a track, so if a
+    part still comes out too large the file is cut again into one more part.
+    """
+    duration = duration or probe_duration(filename)
+    base, ext = os.path.splitext(filename)
+    pattern = f"{glob.escape(base)}.part*{ext}"
+    count = math.ceil(os.path.getsize(filename) / (max_size * SIZE_MARGIN))
+    while True:
+        for stale in glob.glob(pattern):
+            os.remove(stale)
+        subprocess.run(
+            [
+                "ffmpeg",
+                "-y",
+                "-loglevel",
+                "error",
+                "-i",
+                filename,
+                "-map",
+                "0:a",
+                "-codec",
+                "copy",
+                "-f",
+                "segment",
+                "-segment_time",
+                f"{duration / count:.3f}",
+                "-reset_timestamps",
+                "1",
+                f"{base}.part%03d{ext}",
+            ],
+            check=True,
+        )
+        parts = sorted(glob.glob(pattern))
+        if all(os.path.getsize(part) < max_size for part in parts):
+            logger.info(f"Split {filename} into {len(parts)} parts")
+            return parts
+        count += 1
@@ -0,0 +1,239 @@
+"""Long-running worker: the download Lambda's job processing, fed by long
+polling a queue instead of one invocation per message.
+
+    python worker.py --processes 4 --concurrency 8      # SQS (WORKER_QUEUE_URL)
+    python worker.py --local /tmp/dlbot-queue          # spool directory
+
+Each process keeps its Bot, HTTP connection pools, yt-dlp cache and file_id
+store warm for as long as it runs, and works on up to `--concurrency` messages
+at once. Scale out with `--processes` or more containers. The image is the
+Lambda one, run with `--entrypoint python` and `worker.py` as the command.
+Outside the image, put the top of the repo on PYTHONPATH for the modules shared
+with the bot.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import time
+import uuid
+
+import boto3
+
+import yt_downloader_cache
+from app import process_records, scratch
+from boto3_clients import CLIENT_CONFIG
+from constants import RECORD_CONCURRENCY, WORKER_POLL_WAIT, WORKER_QUEUE_URL
+from runtime import get_runtime
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+MAX_RECEIVE = 10  # Most messages SQS returns from one ReceiveMessage
+
+
+def lambda_record(message) -> dict:
+    """An SQS ReceiveMessage message in the shape of a Lambda SQS event record,
+    which is what `process_records` takes"""
+    return {
+        "messageId": message["MessageId"],
+        "receiptHandle": message["ReceiptHandle"],
+        "body": message["Body"],
+        "messageAttributes": {
+            name: {"dataType": attr["DataType"], "stringValue": attr["StringValue"]}
+            for name, attr in message.get("MessageAttributes", {}).items()
+        },
+    }
+
+
+class SQSSource:
+    """Long polls an SQS queue. Messages that fail aren't deleted, so SQS makes
+    them visible again after the queue's visibility timeout, as it would for a
+    Lambda event source mapping."""
+
+    def __init__(self, queue_url=WORKER_QUEUE_URL, wait=WORKER_POLL_WAIT):
+        # Only the worker reads SQS itself, so not one of the shared clients
+        self.client = boto3.client("sqs", config=CLIENT_CONFIG)
+        self.queue_url = queue_url
+        self.wait = wait
+
+    def receive(self, max_messages) -> list[dict]:
+        response = self.client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=min(max_messages, MAX_RECEIVE),
+            WaitTimeSeconds=self.wait,
+            MessageAttributeNames=["All"],
+        )
+        return [lambda_record(message) for message in response.get("Messages", [])]
+
+    def delete(self, record):
+        self.client.delete_message(
+            QueueUrl=self.queue_url, ReceiptHandle=record["receiptHandle"]
+        )
+
+    def retry(self, record):
+        pass  # Visible again once its visibility timeout runs out
+
+
+class LocalSource:
+    """Stand-in queue for running without AWS: a directory of JSON files, one
+    Lambda-shaped record each. Claiming a file renames it, which is atomic, so
+    any number of processes can share the directory. Records that fail
+    `max_attempts` times are left as `.failed` files."""
+
+    def __init__(self, root, wait=1.0, max_attempts=3):
+        self.root = root
+        self.wait = wait
+        self.max_attempts = max_attempts
+        os.makedirs(root, exist_ok=True)
+
+    def put(self, record, name=None):
+        name = name or uuid.uuid4().hex
+        tmp = os.path.join(self.root, f".{name}.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"messageId": name, **record}, f)
+        os.replace(tmp, os.path.join(self.root, f"{name}.json"))
+
+    def _claim(self, name) -> dict | None:
+        claimed = os.path.join(self.root, f"{name}.{os.getpid()}.claimed")
+        try:
+            os.rename(os.path.join(self.root, name), claimed)
+        except FileNotFoundError:
+            return None  # Another process got there first
+        with open(claimed) as f:
+            return {**json.load(f), "receiptHandle": claimed}
+
+    def receive(self, max_messages) -> list[dict]:
+        for attempt in range(2):
+            records = []
+            for name in sorted(os.listdir(self.root)):
+                if len(records) == max_messages:
+                    break
+                if name.endswith(".json") and (record := self._claim(name)):
+                    records.append(record)
+            if records or attempt:
+                return records
+            # Like a long poll, wait a little for messages before returning none
+            time.sleep(self.wait)
+        return []
+
+    def delete(self, record):
+        os.remove(record["receiptHandle"])
+
+    def retry(self, record):
+        record = dict(record)
+        claimed = record.pop("receiptHandle")
+        record["attempts"] = record.get("attempts", 0) + 1
+        name = record["messageId"]
+        if record["attempts"] < self.max_attempts:
+            self.put(record, name)
+        else:
+            with open(os.path.join(self.root, f"{name}.failed"), "w") as f:
+                json.dump(record, f)
+        os.remove(claimed)
+
+
+class Worker:
+    def __init__(self, source, concurrency=RECORD_CONCURRENCY):
+        self.source = source
+        self.concurrency = concurrency
+        self.stopping = False
+
+    def stop(self):
+        logger.info("Stopping after the messages in progress")
+        self.stopping = True
+
+    async def handle(self, bot, record, slots):
+        try:
+            if await process_records(bot, [record]):
+                await asyncio.to_thread(self.source.retry, record)
+            else:
+                await asyncio.to_thread(self.source.delete, record)
+        except Exception as e:
+            logger.error(f"Failed to finish message: {e}", exc_info=e)
+        finally:
+            slots.release()
+
+    async def run(self):
+        bot = get_runtime().bot
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        while not self.stopping:
+            # Only take messages there's room for, so the rest stay available
+            # to other workers and their visibility timeouts don't run down
+            await slots.acquire()
+            free = 1
+            while free < MAX_RECEIVE and not slots.locked():
+                await slots.acquire()
+                free += 1
+            try:
+                records = await asyncio.to_thread(self.source.receive, free)
+            except Exception as e:
+                logger.error(f"Receiving messages failed: {e}")
+                records = []
+                await asyncio.sleep(1)
+            for _ in range(free - len(records)):
+                slots.release()
+            for record in records:
+                task = asyncio.create_task(self.handle(bot, record, slots))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+        yt_downloader_cache.backend.flush()
+        logger.info(f"yt-dlp cache stats: {dict(yt_downloader_cache.backend.stats)}")
+        logger.info(f"Scratch space: {scratch.metrics()}")
+
+
+def run_worker(local, concurrency):
+    logging.basicConfig(
+        format="%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    worker = Worker(LocalSource(local) if local else SQSSource(), concurrency)
+    # The Bot and its connections belong to the runtime's event loop
+    loop = get_runtime().loop
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, worker.stop)
+    loop.run_until_complete(worker.run())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=RECORD_CONCURRENCY,
+        help="Messages in progress per process",
+    )
+    parser.add_argument("--local", help="Spool directory to use instead of SQS")
+    args = parser.parse_args(argv)
+    if args.processes == 1:
+        run_worker(args.local, args.concurrency)
+        return
+    # Spawned rather than forked, so no process shares the parent's clients
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_worker, args=(args.local, args.concurrency))
+        for _ in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    # A terminal's Ctrl-C reaches the whole process group, while `docker stop`
+    # only signals this process, so pass SIGTERM on. Either way the workers
+    # drain before exiting.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(
+        signal.SIGTERM, lambda *_: [process.terminate() for process in processes]
+    )
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
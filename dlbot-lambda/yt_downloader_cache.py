@@ -1,44 +1,156 @@
-import json
 import logging
-import traceback
-
-from yt_dlp.cache import Cache
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import quote
 
 from boto3_clients import s3_client
-from constants import CACHE_KEY, S3_BUCKET
+from constants import CACHE_KEY, NEGATIVE_CACHE_TTL, S3_BUCKET, YTDLP_CACHE_DIR
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class MemoryTier:
+    name = "memory"
+
+    def __init__(self):
+        self.items = {}
+
+    def get(self, path):
+        return self.items.get(path)
+
+    def put(self, path, value):
+        self.items[path] = value
+
 
+class DiskTier:
+    """Survives warm invocations of the same container"""
 
-class S3PersistentCache(Cache):
-    S3_BUCKET = S3_BUCKET
-    CACHE_KEY = CACHE_KEY
+    name = "disk"
 
-    def store(self, section, key, data, dtype="json"):
-        from yt_dlp.cache import __version__
+    def __init__(self, root=YTDLP_CACHE_DIR):
+        self.root = root
 
+    def _filename(self, path):
+        return os.path.join(self.root, quote(path, safe="/").replace("%", ","))
+
+    def get(self, path):
         try:
-            self._ydl.write_debug(f"Saving {section}.{key} to cache")
-            string = json.dumps({"yt-dlp_version": __version__, "data": data})
-            s3_client.put_object(
-                Bucket=self.S3_BUCKET,
-                Key=f"{self.CACHE_KEY}/{section}/{key}",
-                Body=string,
-            )
-        except Exception:
-            tb = traceback.format_exc()
-            self._ydl.report_warning(
-                f"Writing cache to {self.S3_BUCKET}{self.CACHE_KEY} failed: {tb}"
-            )
+            with open(self._filename(path), encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, path, value):
+        filename = self._filename(path)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmp = f"{filename}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(value)
+        os.replace(tmp, filename)
+
+
+class S3Tier:
+    name = "s3"
+
+    def __init__(self, client=s3_client, bucket=S3_BUCKET, prefix=CACHE_KEY):
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
 
-    def load(self, section, key, dtype="json", default=None, *, min_ver=None):
-        logger = logging.getLogger(__name__)
-        self._ydl.write_debug(f"Loading {section}.{key} from cache")
-        s3_key = f"{self.CACHE_KEY}/{section}/{key}"
+    def get(self, path):
         try:
-            obj = s3_client.get_object(Bucket=self.S3_BUCKET, Key=s3_key)
-            logger.info(type(obj["Body"]))
-            return self._validate(json.loads(obj["Body"].read()), min_ver)
-        except Exception as e:
-            self._ydl.report_warning(f"Cache retrieval from {s3_key} failed)")
-            logger.warning(e, exc_info=True)
-
-        return default
+            obj = self.client.get_object(
+                Bucket=self.bucket, Key=f"{self.prefix}/{path}"
+            )
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return obj["Body"].read().decode()
+
+    def put(self, path, value):
+        self.client.put_object(
+            Bucket=self.bucket, Key=f"{self.prefix}/{path}", Body=value
+        )
+
+
+class TieredCache:
+    """Looks `path` up in each tier in turn, fastest first, and copies hits into
+    the faster tiers.
+
+    Stores go to the first tier straight away; with `write_behind` the slower
+    tiers are written in the background (call `flush` before the process may be
+    frozen). Keys found in no tier are remembered for `negative_ttl` seconds so
+    repeated lookups don't go back to S3.
+    """
+
+    def __init__(self, tiers, write_behind=True, negative_ttl=NEGATIVE_CACHE_TTL):
+        self.tiers = tiers
+        self.negative_ttl = negative_ttl
+        self.missing = {}
+        self.stats = Counter()
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.executor = (
+            ThreadPoolExecutor(2, thread_name_prefix="cache-write")
+            if write_behind
+            else None
+        )
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def get(self, path):
+        if self.missing.get(path, 0) > time.monotonic():
+            self._count("negative_hits")
+            return None
+        for i, tier in enumerate(self.tiers):
+            try:
+                value = tier.get(path)
+            except Exception as e:
+                logger.warning(f"Reading {path} from {tier.name} cache failed ({e})")
+                continue
+            if value is not None:
+                self._count(f"{tier.name}_hits")
+                self._write(self.tiers[:i], path, value)
+                return value
+        self._count("misses")
+        self.missing[path] = time.monotonic() + self.negative_ttl
+        return None
+
+    def put(self, path, value):
+        self.missing.pop(path, None)
+        self._count("stores")
+        first, *rest = self.tiers
+        self._write([first], path, value)
+        if self.executor is None:
+            self._write(rest, path, value)
+            return
+        future = self.executor.submit(self._write, rest, path, value)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    def _write(self, tiers, path, value):
+        for tier in tiers:
+            try:
+                tier.put(path, value)
+            except Exception as e:
+                logger.warning(f"Writing {path} to {tier.name} cache failed ({e})")
+
+    def flush(self):
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending)
+
+
+# Backs downloader.S3PersistentCache, the yt-dlp cache. Lives here, apart from
+# yt-dlp, so it can be flushed without importing yt-dlp.
+backend = TieredCache([MemoryTier(), DiskTier(), S3Tier()])
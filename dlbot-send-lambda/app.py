@@ -1,104 +1,234 @@
 import asyncio
 import logging
 import os
+import tempfile
 import time
-from random import randint
 
 import boto3
-from telegram import Bot, InputMediaAudio
-from telegram.error import TimedOut
+from botocore.config import Config
+from telegram import InputMediaAudio, Message
+from telegram.error import BadRequest
+
+from ratelimit import get_rate_limiter
+from runtime import TRANSFER_CONFIG, Runtime, get_runtime
+from tracing import correlation_id, new_correlation_id, span
 
 BOT_TOKEN = os.environ["DLBOT_TOKEN"]
 BUCKET_NAME = os.environ["BUCKET_NAME"]
+FILE_IDS_TABLE = os.environ.get("FILE_IDS_TABLE")
+# Telegram RetryAfter pauses shared with the bot and the other containers
+RATE_LIMIT_TABLE = os.environ.get("RATE_LIMIT_TABLE")
+
+CLIENT_CONFIG = Config(max_pool_connections=10, tcp_keepalive=True)
+MAX_RETRIES = 5
+RECORD_CONCURRENCY = int(os.environ.get("RECORD_CONCURRENCY", 4))
 
 
 logger = logging.getLogger(__name__)
 
 
-async def edit_message_ignore_errors(bot, text, chat_id, message_id):
+class SendRuntime(Runtime):
+    """The Bot, plus the AWS clients, created once per container so warm
+    invocations reuse their connections"""
+
+    def __init__(self):
+        super().__init__(BOT_TOKEN)
+        self.s3 = boto3.client("s3", config=CLIENT_CONFIG)
+        self.file_ids_table = None
+        rate_limit_table = None
+        if FILE_IDS_TABLE or RATE_LIMIT_TABLE:
+            dynamodb = boto3.resource("dynamodb", config=CLIENT_CONFIG)
+            if FILE_IDS_TABLE:
+                self.file_ids_table = dynamodb.Table(FILE_IDS_TABLE)
+            if RATE_LIMIT_TABLE:
+                rate_limit_table = dynamodb.Table(RATE_LIMIT_TABLE)
+        self.limiter = get_rate_limiter(rate_limit_table)
+
+
+async def edit_message_ignore_errors(runtime: SendRuntime, text, chat_id, message_id):
     try:
-        await bot.edit_message_text(text, chat_id, message_id)
+        await runtime.limiter.call(
+            chat_id, lambda: runtime.bot.edit_message_text(text, chat_id, message_id)
+        )
     except Exception as e:
         logger.warning(str(e), exc_info=True)
 
 
-async def delete_message_ignore_errors(chat_id, message_id):
-    bot = Bot(token=BOT_TOKEN)
+async def delete_message_ignore_errors(runtime: SendRuntime, chat_id, message_id):
     try:
-        await bot.delete_message(chat_id, message_id)
+        await runtime.limiter.call(
+            chat_id, lambda: runtime.bot.delete_message(chat_id, message_id)
+        )
     except Exception as e:
         logger.warning(str(e), exc_info=True)
 
 
-async def add_audio(bot: Bot, chat_id, data, message_id):
-    tg_audio = InputMediaAudio(data)
-    await bot.edit_message_media(tg_audio, chat_id, message_id)
+async def add_audio(runtime: SendRuntime, chat_id, data, message_id):
+    """`data` is a file_id or an open file, which is rewound for every attempt"""
 
+    def edit():
+        if hasattr(data, "seek"):
+            data.seek(0)
+        return runtime.bot.edit_message_media(
+            InputMediaAudio(data), chat_id, message_id
+        )
 
-MAX_RETRIES = 5
+    return await runtime.limiter.call(chat_id, edit, retries=MAX_RETRIES)
 
 
-async def do_the_thing(s3_key, message_id, placeholder_id, retry=0):
-    await asyncio.sleep(randint(1, 5))
+def get_cached_file_id(table, cache_key):
+    if table is None or cache_key is None:
+        return None
     try:
-        bot = Bot(token=BOT_TOKEN)
-        chat_id, *_ = s3_key.split("/")
-        await edit_message_ignore_errors(bot, "Sending audio...", chat_id, message_id)
-        s3 = boto3.client("s3")
-        obj = s3.get_object(Bucket=BUCKET_NAME, Key=s3_key)
-        data = obj["Body"].read()
-        await add_audio(bot, chat_id, data, placeholder_id)
+        row = table.get_item(Key={"key": cache_key})
     except Exception as e:
-        if retry < MAX_RETRIES:
-            logger.warning(f"Retrying ({retry + 1}/{MAX_RETRIES}) (ERROR: {e})")
-            return await do_the_thing(
-                s3_key, message_id, placeholder_id, retry=retry + 1
-            )
-        raise e
+        logger.warning(f"Cannot read file_id for {cache_key} ({e})")
+        return None
+    return row["Item"]["file_id"] if "Item" in row else None
+
 
-    s3.delete_object(Bucket=BUCKET_NAME, Key=s3_key)
-    await delete_message_ignore_errors(chat_id, message_id)
+def store_file_id(table, cache_key, message):
+    if table is None or cache_key is None:
+        return
+    if not isinstance(message, Message) or message.audio is None:
+        return
+    try:
+        table.put_item(Item={"key": cache_key, "file_id": message.audio.file_id})
+    except Exception as e:
+        logger.warning(f"Cannot store file_id for {cache_key} ({e})")
 
 
-async def send_error_message(chat_id, message_id, error_message):
-    bot = Bot(token=BOT_TOKEN)
+async def add_cached_audio(runtime: SendRuntime, chat_id, cache_key, message_id):
+    """Send by a previously stored file_id, returns False if there is none or
+    Telegram rejects it"""
+    file_id = await asyncio.to_thread(
+        get_cached_file_id, runtime.file_ids_table, cache_key
+    )
+    if file_id is None:
+        return False
+    try:
+        await add_audio(runtime, chat_id, file_id, message_id)
+    except BadRequest as e:
+        logger.warning(f"Cached file_id for {cache_key} rejected ({e})")
+        return False
+    return True
+
+
+async def do_the_thing(
+    runtime: SendRuntime, s3_key, message_id, placeholder_id, cache_key=None
+):
+    chat_id, *_ = s3_key.split("/")
+    await edit_message_ignore_errors(runtime, "Sending audio...", chat_id, message_id)
+    with span("send_file_id"):
+        sent_cached = await add_cached_audio(
+            runtime, chat_id, cache_key, placeholder_id
+        )
+    if not sent_cached:
+        # Stream the object to disk in parts rather than reading the body
+        # into memory, Telegram's upload is then the only in-memory copy
+        with tempfile.TemporaryFile() as f:
+            with span("s3_fetch") as fetch:
+                await asyncio.to_thread(
+                    runtime.s3.download_fileobj,
+                    BUCKET_NAME,
+                    s3_key,
+                    f,
+                    Config=TRANSFER_CONFIG,
+                )
+                fetch.set(bytes=f.tell())
+            with span("send_audio", bytes=fetch.fields["bytes"]):
+                sent = await add_audio(runtime, chat_id, f, placeholder_id)
+        await asyncio.to_thread(store_file_id, runtime.file_ids_table, cache_key, sent)
+
+    await asyncio.to_thread(runtime.s3.delete_object, Bucket=BUCKET_NAME, Key=s3_key)
+    await delete_message_ignore_errors(runtime, chat_id, message_id)
+
+
+async def send_error_message(runtime: SendRuntime, chat_id, message_id, error_message):
     try:
-        await bot.edit_message_text(error_message, chat_id, message_id)
+        await runtime.limiter.call(
+            chat_id,
+            lambda: runtime.bot.edit_message_text(error_message, chat_id, message_id),
+        )
     except Exception as e:
         logger.warning(f"Cannot edit placeholder message ({e})", exc_info=True)
-        await bot.send_message(chat_id, error_message)
+        await runtime.limiter.call(
+            chat_id, lambda: runtime.bot.send_message(chat_id, error_message)
+        )
 
 
-def lambda_handler(event, _):
-    del _
-    try:
-        message = event["Records"][0]["Sns"]["Message"]
-    except (KeyError, ValueError):
-        return {"statusCode": 400}
+def parse_record(record):
+    """Message body and flattened attribute values of an SNS or SQS record"""
+    if "Sns" in record:
+        message = record["Sns"]["Message"]
+        attributes = record["Sns"]["MessageAttributes"]
+        value = "Value"
+    else:
+        message = record["body"]
+        attributes = record["messageAttributes"]
+        value = "stringValue"
+    return message, {name: attr[value] for name, attr in attributes.items()}
 
-    attributes = event["Records"][0]["Sns"]["MessageAttributes"]
 
+async def process_record(runtime: SendRuntime, record):
     try:
-        chat_id = int(attributes["chat_id"]["Value"])
-        message_id = int(attributes["message_id"]["Value"])
-        placeholder_id = int(attributes["placeholder_id"]["Value"])
-    except Exception as e:
-        return {
-            "statusCode": 400,
-            "error": {"class": e.__class__.__name__, "text": str(e)},
-        }
-
+        message, attributes = parse_record(record)
+        chat_id = int(attributes["chat_id"])
+        message_id = int(attributes["message_id"])
+        placeholder_id = int(attributes["placeholder_id"])
+    except (KeyError, ValueError) as e:
+        # Redelivering a malformed record won't help
+        logger.error(f"Invalid record ({e.__class__.__name__}: {e})")
+        return
+
+    # Each record runs in its own task, so the ID is only set for this one
+    correlation_id.set(attributes.get("correlation_id") or new_correlation_id())
     if (url := attributes.get("url")) is not None:
         error = message
-        asyncio.run(
-            send_error_message(
+        with span("send_error", chat_id=chat_id):
+            await send_error_message(
+                runtime,
                 chat_id,
                 message_id,
-                f"😭Sending mp3 from {url} failed\n({error})",
+                f"😭Sending audio from {url} failed\n({error})",
             )
-        )
     else:
         s3_key = message
-        asyncio.run(do_the_thing(s3_key, message_id, placeholder_id))
+        cache_key = attributes.get("cache_key")
+        with span("deliver", chat_id=chat_id, s3_key=s3_key):
+            await do_the_thing(runtime, s3_key, message_id, placeholder_id, cache_key)
+
+
+async def process_records(runtime: SendRuntime, records):
+    semaphore = asyncio.Semaphore(RECORD_CONCURRENCY)
+
+    async def process(record):
+        async with semaphore:
+            await process_record(runtime, record)
 
-    return {"statusCode": 200}
+    results = await asyncio.gather(
+        *(process(record) for record in records), return_exceptions=True
+    )
+    return [
+        (record, result)
+        for record, result in zip(records, results)
+        if isinstance(result, Exception)
+    ]
+
+
+def lambda_handler(event, _):
+    del _
+    runtime = get_runtime(SendRuntime)
+    failures = runtime.run(process_records(runtime, event.get("Records", [])))
+    for record, error in failures:
+        logger.error(f"Failed to process record: {error}", exc_info=error)
+        # SNS invokes with one record at a time and retries on error
+        if "Sns" in record:
+            raise error
+    # SQS only redelivers the records listed here
+    return {
+        "statusCode": 200,
+        "batchItemFailures": [
+            {"itemIdentifier": record["messageId"]} for record, _ in failures
+        ],
+    }
@@ -0,0 +1,140 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+from urllib.parse import parse_qs, urlparse
+
+
+class PlaylistEntry(NamedTuple):
+    url: str
+    id: str | None
+    ie_key: str | None
+    title: str | None
+    duration: float | None
+
+    @property
+    def cache_key(self) -> str | None:
+        """Same `extractor/video_id` key the download Lambda caches tracks under"""
+        if self.ie_key and self.id:
+            return f"{self.ie_key.lower()}/{self.id.replace('/', '_')}"
+
+
+class PlaylistInfo(NamedTuple):
+    title: str
+    count: int
+    release_year: str | None
+    thumbnails: list[dict]
+    entries: list[PlaylistEntry]
+
+
+class TTLCache:
+    """Thread safe LRU cache whose entries also expire after `ttl` seconds"""
+
+    def __init__(self, maxsize=256, ttl=3600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            expires, value = self.items[key]
+            if expires < time.monotonic():
+                del self.items[key]
+                return default
+            self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value, ttl=None):
+        with self.lock:
+            self.items[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def snapshot(self) -> list[tuple]:
+        """(key, expiry as a Unix time, value) for every live entry, least
+        recent first, for `restore` in another process. Expiry times are wall
+        clock, so the time between the two counts against the entries."""
+        now = time.monotonic()
+        wall_now = time.time()
+        with self.lock:
+            return [
+                (key, wall_now + expires - now, value)
+                for key, (expires, value) in self.items.items()
+                if expires > now
+            ]
+
+    def restore(self, entries):
+        wall_now = time.time()
+        for key, expires_at, value in entries:
+            if (ttl := expires_at - wall_now) > 0:
+                self.put(key, value, ttl)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def canonical_playlist_id(url: str) -> str:
+    parsed = urlparse(url)
+    host = (parsed.hostname or "").lower()
+    if host.endswith("youtube.com") and (
+        playlist_id := parse_qs(parsed.query).get("list", [None])[0]
+    ):
+        return f"youtube/{playlist_id}"
+    return url
+
+
+def extract_playlist(url) -> PlaylistInfo:
+    import yt_dlp  # Only playlists need it, the bot starts faster without
+
+    with yt_dlp.YoutubeDL({"extract_flat": True}) as flat:
+        info = flat.extract_info(url, download=False)
+    return PlaylistInfo(
+        title=info["title"],
+        count=info["playlist_count"],
+        release_year=info.get("release_year"),
+        thumbnails=info.get("thumbnails") or [],
+        entries=[
+            PlaylistEntry(
+                url=entry["url"],
+                id=entry.get("id"),
+                ie_key=entry.get("ie_key"),
+                title=entry.get("title"),
+                duration=entry.get("duration"),
+            )
+            for entry in info["entries"]
+        ],
+    )
+
+
+class PlaylistCache:
+    """Flat playlist metadata keyed by canonical playlist ID.
+
+    Extraction runs in a worker thread so it never blocks the event loop, and
+    concurrent requests for the same playlist share a single extraction.
+    """
+
+    def __init__(self, maxsize=256, ttl=3600.0):
+        self.cache = TTLCache(maxsize, ttl)
+        self.pending = {}
+
+    async def get(self, url) -> PlaylistInfo:
+        key = canonical_playlist_id(url)
+        if (info := self.cache.get(key)) is not None:
+            return info
+        if key not in self.pending:
+            self.pending[key] = asyncio.ensure_future(
+                asyncio.to_thread(extract_playlist, url)
+            )
+        future = self.pending[key]
+        try:
+            info = await asyncio.shield(future)
+        finally:
+            if future.done():
+                self.pending.pop(key, None)
+        self.cache.put(key, info)
+        return info
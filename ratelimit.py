@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import math
+import os
+import random
+import time
+from datetime import timedelta
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+from tracing import add as add_to_span
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Telegram allows about one message per second in a chat, and 30 per second
+# overall, per bot
+CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", 1.0))
+CHAT_BURST = 3
+MIN_CHAT_RATE = 0.1  # A chat that keeps getting RetryAfter is slowed to this
+GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", 30.0))
+MAX_RETRIES = 5
+BASE_BACKOFF = 1.0  # Seconds, doubled on each network error
+MAX_BACKOFF = 30.0
+PRUNE_INTERVAL = 60.0  # Seconds between dropping the state of idle chats
+
+
+def retry_after_seconds(e: RetryAfter) -> float:
+    if isinstance(e.retry_after, timedelta):
+        return e.retry_after.total_seconds()
+    return e.retry_after
+
+
+def backoff(attempt) -> float:
+    """Exponential backoff with jitter, so clients that failed together don't
+    all retry together"""
+    delay = min(MAX_BACKOFF, BASE_BACKOFF * 2**attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class TokenBucket:
+    """`rate` tokens a second, up to `burst` saved up. A reservation always
+    succeeds, possibly taking the balance negative; the caller then waits until
+    it would have been paid back, so callers are served in order."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self, now) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def idle(self, now, rate) -> bool:
+        """Full again at `rate`, so no different from a new bucket"""
+        return (
+            self.rate == rate
+            and self.tokens + (now - self.updated) * self.rate >= self.burst
+        )
+
+
+class DynamoLimitState:
+    """Shares RetryAfter pauses between processes (the bot and every Lambda
+    container) through a DynamoDB table keyed on `key`. Reads are cached for
+    `refresh` seconds, so at most one GetItem per chat per second."""
+
+    def __init__(self, table, refresh=1.0):
+        self.table = table
+        self.refresh = refresh
+        self.cache = {}
+
+    def cached(self, scope) -> float | None:
+        if (cached := self.cache.get(scope)) is not None and cached[0] > time.time():
+            return cached[1]
+        return None
+
+    def blocked_until(self, scope) -> float:
+        if (until := self.cached(scope)) is not None:
+            return until
+        now = time.time()
+        try:
+            row = self.table.get_item(Key={"key": f"ratelimit/{scope}"})
+        except Exception as e:
+            logger.warning(f"Cannot read rate limit for {scope} ({e})")
+            until = 0.0
+        else:
+            until = float(row["Item"]["until"]) if "Item" in row else 0.0
+        self.cache[scope] = (now + self.refresh, until)
+        return until
+
+    def prune(self):
+        now = time.time()
+        for scope, (expires, _) in list(self.cache.items()):
+            if expires <= now:
+                del self.cache[scope]
+
+    def block(self, scope, until):
+        self.cache[scope] = (time.time() + self.refresh, until)
+        try:
+            self.table.put_item(
+                Item={
+                    "key": f"ratelimit/{scope}",
+                    "until": math.ceil(until),
+                    "expires": math.ceil(until) + 60,  # For the table's TTL
+                }
+            )
+        except Exception as e:
+            logger.warning(f"Cannot share rate limit for {scope} ({e})")
+
+
+class RateLimiter:
+    """Keeps Telegram requests within the per chat and global limits.
+
+    Each request takes a token from the global bucket and its chat's bucket.
+    A RetryAfter pauses the chat for as long as Telegram asks and halves the
+    chat's rate, which then recovers a little with every success. With a
+    `shared` state the pauses are seen by every process sending as the bot.
+    """
+
+    def __init__(
+        self,
+        chat_rate=CHAT_RATE,
+        chat_burst=CHAT_BURST,
+        min_chat_rate=MIN_CHAT_RATE,
+        global_rate=GLOBAL_RATE,
+        shared: DynamoLimitState | None = None,
+    ):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.min_chat_rate = min_chat_rate
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chats = {}
+        self.paused = {}
+        self.shared = shared
+        self.pruned = time.monotonic()
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        if chat_id not in self.chats:
+            self.chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return self.chats[chat_id]
+
+    def _prune(self, now):
+        """Forget chats with nothing left to remember, so a long-running bot
+        keeps state for the chats it's been busy with lately, not every chat
+        it has ever seen"""
+        self.pruned = now
+        for chat_id, bucket in list(self.chats.items()):
+            if bucket.idle(now, self.chat_rate):
+                del self.chats[chat_id]
+        for scope, until in list(self.paused.items()):
+            if until <= now:
+                del self.paused[scope]
+        if self.shared is not None:
+            self.shared.prune()
+
+    async def acquire(self, chat_id=None):
+        now = time.monotonic()
+        if now - self.pruned >= PRUNE_INTERVAL:
+            self._prune(now)
+        delay = self.global_bucket.reserve(now)
+        scopes = ["global"]
+        if chat_id is not None:
+            delay = max(delay, self._bucket(chat_id).reserve(now))
+            scopes.append(str(chat_id))
+        for scope in scopes:
+            delay = max(delay, self.paused.get(scope, 0.0) - now)
+            if self.shared is not None:
+                until = self.shared.cached(scope)
+                if until is None:
+                    until = await asyncio.to_thread(self.shared.blocked_until, scope)
+                delay = max(delay, until - time.time())
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def slow_down(self, chat_id, seconds):
+        scope = "global" if chat_id is None else str(chat_id)
+        self.paused[scope] = max(
+            self.paused.get(scope, 0.0), time.monotonic() + seconds
+        )
+        if chat_id is not None:
+            bucket = self._bucket(chat_id)
+            bucket.rate = max(self.min_chat_rate, bucket.rate / 2)
+        if self.shared is not None:
+            await asyncio.to_thread(self.shared.block, scope, time.time() + seconds)
+
+    def _speed_up(self, chat_id):
+        if chat_id is not None and chat_id in self.chats:
+            bucket = self.chats[chat_id]
+            bucket.rate = min(self.chat_rate, bucket.rate + self.chat_rate / 10)
+
+    async def call(self, chat_id, request, retries=MAX_RETRIES):
+        """Await `request()` within the limits and return its result.
+
+        `request` is called again for every attempt, so it can rebuild anything
+        an attempt consumes (e.g. rewind a file). RetryAfter waits as long as
+        Telegram asks, other network errors back off exponentially; BadRequest
+        and anything else is raised straight away, retrying wouldn't help.
+        """
+        for attempt in range(retries + 1):
+            await self.acquire(chat_id)
+            try:
+                result = await request()
+            except BadRequest:
+                raise
+            except (RetryAfter, NetworkError) as e:
+                if attempt == retries:
+                    raise
+                logger.warning(f"Retrying ({attempt + 1}/{retries}) (ERROR: {e})")
+                add_to_span("retries")
+                if isinstance(e, RetryAfter):
+                    await self.slow_down(chat_id, retry_after_seconds(e))
+                else:
+                    await asyncio.sleep(backoff(attempt))
+            else:
+                self._speed_up(chat_id)
+                return result
+
+
+def get_rate_limiter(table=None) -> RateLimiter:
+    """`table` is the DynamoDB Table for sharing limits between processes"""
+    return RateLimiter(shared=DynamoLimitState(table) if table is not None else None)
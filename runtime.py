@@ -0,0 +1,67 @@
+"""State that lives as long as a Lambda container, shared by the download and
+send Lambdas (each gets a copy from deploy-lambda.sh)."""
+
+import asyncio
+import logging
+import os
+from typing import Callable
+
+import httpx
+from boto3.s3.transfer import TransferConfig
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+BOT_CONNECTION_POOL_SIZE = int(os.environ.get("BOT_CONNECTION_POOL_SIZE", 8))
+BOT_KEEPALIVE_EXPIRY = 300.0  # Keep Telegram connections open between warm invocations
+BOT_MEDIA_WRITE_TIMEOUT = 60.0  # Audio uploads can be up to 50MB
+
+MB = 1024**2
+# Files above the threshold are sent/fetched as 8MB parts, read from/written to
+# disk chunk by chunk instead of being held in memory
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * MB, multipart_chunksize=8 * MB, max_concurrency=4
+)
+
+
+class Runtime:
+    """State that lives as long as the Lambda container.
+
+    Warm invocations reuse the event loop and the initialised Bot, and with them
+    the open connections to api.telegram.org, instead of paying for a new TLS
+    handshake every time.
+    """
+
+    def __init__(self, token):
+        self.loop = asyncio.new_event_loop()
+        request = HTTPXRequest(
+            connection_pool_size=BOT_CONNECTION_POOL_SIZE,
+            media_write_timeout=BOT_MEDIA_WRITE_TIMEOUT,
+            httpx_kwargs={
+                "limits": httpx.Limits(
+                    max_connections=BOT_CONNECTION_POOL_SIZE,
+                    max_keepalive_connections=BOT_CONNECTION_POOL_SIZE,
+                    keepalive_expiry=BOT_KEEPALIVE_EXPIRY,
+                )
+            },
+        )
+        self.bot = Bot(token=token, request=request)
+        self.run(self.bot.initialize())
+
+    def run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+
+_runtime: Runtime | None = None
+
+
+def get_runtime(create: Callable[[], Runtime] | None = None) -> Runtime:
+    """The container's Runtime, made by `create` the first time (by default a
+    Runtime for the BOT_TOKEN environment variable)"""
+    global _runtime
+    if _runtime is None:
+        logger.info("Initialising runtime")
+        _runtime = create() if create else Runtime(os.environ["BOT_TOKEN"])
+    return _runtime
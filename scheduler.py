@@ -0,0 +1,281 @@
+import asyncio
+import contextvars
+import itertools
+import logging
+import os
+import time
+from collections import Counter, deque
+from typing import Any, Awaitable, Callable, NamedTuple
+
+from tracing import TRACING, emit
+
+logger = logging.getLogger(__name__)
+
+# Share of the download capacity a queued track is worth: single links are
+# served four times as readily as playlist tracks
+KIND_WEIGHTS = {"single": 4.0, "playlist": 1.0}
+# Only applied while several chats are busy (see FairQueue.pop), and only
+# when the Dispatcher hears back as tracks finish (see Dispatcher). Set it to
+# the download Lambda's reserved concurrency.
+MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", 20))
+CHAT_IN_FLIGHT = int(os.environ.get("CHAT_IN_FLIGHT", 3))
+# Seconds between asking which dispatched tracks have finished, while the
+# queue is held up by the caps
+COMPLETION_POLL_INTERVAL = float(os.environ.get("COMPLETION_POLL_INTERVAL", 2.0))
+# A track never reported finished (its Lambda crashed, or the message went to
+# the dead letter queue) gives its slot back after the Lambda's maximum timeout
+MAX_DISPATCH_HOLD = 900.0
+MAX_DISPATCH_ATTEMPTS = 5
+
+
+class ScheduledItem(NamedTuple):
+    payload: Any
+    user_id: int
+    chat_id: int
+    kind: str  # "single" or "playlist"
+    enqueued_at: float
+    context: contextvars.Context | None = None
+    attempts: int = 0
+
+
+class FairQueue:
+    """Weighted fair queuing of tracks across users.
+
+    Every (user, kind) pair is a flow with its own FIFO queue. Items are tagged
+    with a virtual finish time, `1 / weight` after the later of the flow's last
+    finish and the current virtual time, and the lowest tag is served first. A
+    user pasting several playlists therefore only builds up their own backlog,
+    and single links overtake playlist tracks. See `pop` for the caps on tracks
+    in progress.
+    """
+
+    def __init__(
+        self,
+        weights=KIND_WEIGHTS,
+        max_in_flight=MAX_IN_FLIGHT,
+        chat_in_flight=CHAT_IN_FLIGHT,
+    ):
+        self.weights = weights
+        self.max_in_flight = max_in_flight
+        self.chat_in_flight = chat_in_flight
+        self.flows = {}
+        self.last_finish = {}
+        self.virtual_time = 0.0
+        self.in_flight = Counter()
+
+    def __len__(self):
+        return sum(len(flow) for flow in self.flows.values())
+
+    @property
+    def total_in_flight(self) -> int:
+        return sum(self.in_flight.values())
+
+    def push(self, item: ScheduledItem):
+        flow = (item.user_id, item.kind)
+        start = max(self.virtual_time, self.last_finish.get(flow, 0.0))
+        finish = start + 1 / self.weights[item.kind]
+        self.last_finish[flow] = finish
+        self.flows.setdefault(flow, deque()).append((start, finish, item))
+
+    def _best(self, eligible=lambda item: True):
+        """The flow whose head has the lowest finish tag, among heads that are
+        `eligible`"""
+        best = None
+        for flow, queue in self.flows.items():
+            _, finish, item = queue[0]
+            if eligible(item) and (best is None or finish < best[0]):
+                best = (finish, flow)
+        return best and best[1]
+
+    def pop(self) -> ScheduledItem | None:
+        """The next item that may start now, or None.
+
+        The caps only apply while more than one chat has tracks waiting or in
+        flight, so a lone user's playlist is dispatched as fast as it can be
+        sent. Then nothing is dispatched past `max_in_flight` until a slot is
+        released, and chats under `chat_in_flight` go first, though a chat at
+        its cap still gets slots nobody else is waiting for.
+        """
+        if not self.flows:
+            return None
+        chats = {queue[0][2].chat_id for queue in self.flows.values()}
+        contended = len(chats | self.in_flight.keys()) > 1
+        if contended and self.total_in_flight >= self.max_in_flight:
+            return None
+        flow = (
+            self._best(lambda item: self.in_flight[item.chat_id] < self.chat_in_flight)
+            or self._best()
+        )
+        start, _, item = self.flows[flow].popleft()
+        if not self.flows[flow]:
+            del self.flows[flow]
+        self.virtual_time = max(self.virtual_time, start)
+        self.in_flight[item.chat_id] += 1
+        return item
+
+    def drain(self) -> list[ScheduledItem]:
+        """Remove and return every queued item"""
+        items = [item for queue in self.flows.values() for _, _, item in queue]
+        self.flows.clear()
+        return items
+
+    def done(self, item: ScheduledItem):
+        self.in_flight[item.chat_id] -= 1
+        if self.in_flight[item.chat_id] <= 0:
+            del self.in_flight[item.chat_id]
+
+
+class Dispatcher:
+    """Feeds a FairQueue into `send` (e.g. an SNS PublishBatch) from a
+    background task, up to `batch_size` items per call.
+
+    With `completed` (async, given dispatch IDs, returns the ones whose
+    downloads have finished) a dispatched item holds its slot until its ID,
+    from `dispatch_id(payload)`, is reported, or for MAX_DISPATCH_HOLD
+    seconds. Without it items release their slots as soon as they're sent, so
+    the queue only orders them. Failed sends are put back and retried with backoff, up to MAX_DISPATCH_ATTEMPTS times, after
+    which their payloads are passed to `on_failure`. Each item's queue wait is
+    traced as a "schedule" span in the context it was submitted from, so it
+    carries that request's correlation ID.
+
+    The queue is only in memory: call `drain` before the process exits to get
+    back whatever hasn't been sent yet.
+    """
+
+    def __init__(
+        self,
+        send: Callable[[list], Awaitable[None]],
+        queue: FairQueue | None = None,
+        batch_size=10,
+        on_failure: Callable[[list], Awaitable[None]] | None = None,
+        completed: Callable[[list[str]], Awaitable[set[str]]] | None = None,
+        dispatch_id: Callable[[Any], str] | None = None,
+        poll_interval=COMPLETION_POLL_INTERVAL,
+    ):
+        self.send = send
+        self.queue = queue if queue is not None else FairQueue()
+        self.batch_size = batch_size
+        self.on_failure = on_failure
+        self.completed = completed
+        self.dispatch_id = dispatch_id
+        self.poll_interval = poll_interval
+        self.in_flight = {}  # dispatch ID: (item, time sent) awaiting completion
+        self.last_poll = 0.0
+        self.retries = {}  # id: (timer handle, item) of failed sends waiting
+        self.retry_ids = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def submit(self, payloads, user_id, chat_id, kind):
+        now = time.monotonic()
+        context = contextvars.copy_context()
+        for payload in payloads:
+            self.queue.push(
+                ScheduledItem(payload, user_id, chat_id, kind, now, context)
+            )
+        if self.task is None or self.task.done():
+            # A fresh context, the task outlives the request that started it
+            self.task = asyncio.create_task(self.run(), context=contextvars.Context())
+        self.wakeup.set()
+
+    async def join(self):
+        """Wait until everything submitted has been dispatched and finished"""
+        while self.task is not None and not self.task.done():
+            await self.task
+
+    def drain(self) -> list:
+        """Stop dispatching, and return the payloads that haven't been sent"""
+        if self.task is not None:
+            self.task.cancel()
+        for handle, _ in self.retries.values():
+            handle.cancel()
+        items = [item for _, item in self.retries.values()] + self.queue.drain()
+        self.retries.clear()
+        self.in_flight.clear()
+        return [item.payload for item in items]
+
+    def _idle(self) -> bool:
+        return (
+            not len(self.queue) and not self.queue.total_in_flight and not self.retries
+        )
+
+    async def _poll(self):
+        """Release the slots of the tracks reported finished, or held too long"""
+        self.last_poll = time.monotonic()
+        ids = list(self.in_flight)
+        try:
+            done = await self.completed(ids)
+        except Exception as e:
+            logger.warning(f"Checking {len(ids)} dispatched tracks failed: {e}")
+            done = set()
+        for dispatch_id in ids:
+            item, sent_at = self.in_flight[dispatch_id]
+            if dispatch_id in done or self.last_poll - sent_at > MAX_DISPATCH_HOLD:
+                del self.in_flight[dispatch_id]
+                self.queue.done(item)
+
+    async def _wait(self):
+        """Wait for more items, or while tracks are in flight, for the next
+        poll to release some"""
+        self.wakeup.clear()
+        if not self.in_flight:
+            await self.wakeup.wait()
+            return
+        timeout = self.last_poll + self.poll_interval - time.monotonic()
+        if timeout > 0:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+                return
+            except TimeoutError:
+                pass
+        await self._poll()
+
+    def _retry(self, retry_id):
+        _, item = self.retries.pop(retry_id)
+        self.queue.push(item._replace(attempts=item.attempts + 1))
+        self.wakeup.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while not self._idle():
+            batch = []
+            while len(batch) < self.batch_size and (item := self.queue.pop()):
+                batch.append(item)
+            if not batch:
+                await self._wait()
+                continue
+            try:
+                await self.send([item.payload for item in batch])
+            except Exception as e:
+                logger.error(f"Dispatching {len(batch)} tracks failed: {e}")
+                failed = []
+                for item in batch:
+                    self.queue.done(item)
+                    if item.attempts + 1 < MAX_DISPATCH_ATTEMPTS:
+                        retry_id = next(self.retry_ids)
+                        handle = loop.call_later(
+                            2**item.attempts, self._retry, retry_id
+                        )
+                        self.retries[retry_id] = (handle, item)
+                    else:
+                        failed.append(item.payload)
+                if failed and self.on_failure:
+                    try:
+                        await self.on_failure(failed)
+                    except Exception as e:
+                        logger.error(f"Handling {len(failed)} lost tracks failed: {e}")
+                continue
+            now = time.monotonic()
+            for item in batch:
+                if TRACING:
+                    item.context.run(
+                        emit,
+                        "schedule",
+                        now - item.enqueued_at,
+                        "ok",
+                        {"kind": item.kind, "attempts": item.attempts},
+                    )
+                if self.completed is None:
+                    self.queue.done(item)
+                else:
+                    self.in_flight[self.dispatch_id(item.payload)] = (item, now)
@@ -1,18 +1,18 @@
 import asyncio
 import io
+import json
 import logging
 import os
 import re
+import time
 import wave
-from random import randint
+from typing import NamedTuple
 from uuid import uuid4
 
 import aiohttp
 
-import boto3
-import yt_dlp
 from telegram import helpers, InlineKeyboardButton, InlineKeyboardMarkup, Update
-from telegram.error import RetryAfter, TimedOut
+from telegram.error import TimedOut
 from telegram.ext import (
     Application,
     ApplicationBuilder,
@@ -23,6 +23,14 @@ from telegram.ext import (
     ChatMemberHandler,
 )
 
+from audio_limits import MAX_FILE_SIZE, SPLIT_LARGE_FILES, too_long
+from aws_io import AsyncStore, AwsBackend, InMemoryBackend
+from completions import get_completion_store
+from metadata_cache import PlaylistCache, PlaylistEntry, TTLCache
+from ratelimit import DynamoLimitState, RateLimiter
+from scheduler import Dispatcher, FairQueue
+from tracing import correlation_id, new_correlation_id, span
+
 SQS_QUEUE = os.environ["SQS_QUEUE"]
 USE_SQS = os.environ.get("USE_SQS", "false").lower() == "true"
 SNS_TOPIC = os.environ["SNS_POST_TOPIC"]
@@ -34,23 +42,65 @@ MEMBERS_CHANNEL_LINK = os.environ["MEMBERS_CHANNEL_LINK"]
 NEW_USERS_TABLE = os.environ["NEW_USERS_TABLE"]
 ERRORS_TABLE = os.environ["ERRORS_TABLE"]
 MAXIMUM_PLAYLIST_LENGTH = int(os.environ.get("MAXIMUM_PLAYLIST_LENGTH", 30))
+AWS_BACKEND = os.environ.get("AWS_BACKEND", "aws").lower()
+# Queue tracks through the fair scheduler rather than publishing them directly.
+# It only holds tracks back (MAX_IN_FLIGHT, scheduler.py) when the download
+# Lambda reports finished tracks (COMPLETIONS_TABLE, completions.py), otherwise
+# it just puts single links ahead of playlist tracks waiting to be published.
+SCHEDULE_DOWNLOADS = os.environ.get("SCHEDULE_DOWNLOADS", "true").lower() == "true"
+# Telegram RetryAfter pauses shared with the download and send Lambdas
+RATE_LIMIT_TABLE = os.environ.get("RATE_LIMIT_TABLE")
 
 MAX_RETRIES_FOR_SENDING_PLACEHOLDER_MESSAGE = 5
+PLACEHOLDER_INTERVAL = 1.0  # Telegram allows roughly one message per second per chat
+MAX_PLACEHOLDER_INTERVAL = 10.0  # Slowest a chat is paced after repeated RetryAfter
+QUEUE_BATCH_SIZE = 10  # Maximum entries for SendMessageBatch/PublishBatch
+RETRY_CONCURRENCY = 4  # PublishBatch requests in flight while retrying failures
+# Seconds between sweeps retrying failed tracks automatically, 0 to disable
+RETRY_SWEEP_INTERVAL = int(os.environ.get("RETRY_SWEEP_INTERVAL", 600))
+MAX_AUTO_RETRIES = 3
+PLAYLIST_CACHE_SIZE = int(os.environ.get("PLAYLIST_CACHE_SIZE", 256))
+PLAYLIST_CACHE_TTL = int(os.environ.get("PLAYLIST_CACHE_TTL", 3600))
+MEMBERSHIP_CACHE_SIZE = int(os.environ.get("MEMBERSHIP_CACHE_SIZE", 100_000))
+MEMBERSHIP_CACHE_TTL = int(os.environ.get("MEMBERSHIP_CACHE_TTL", 3600))
+# Non-members are checked again sooner, in case a join update was missed
+NON_MEMBER_CACHE_TTL = 60
+# Optional file the membership cache is saved to on shutdown and loaded from
+# on startup
+MEMBERSHIP_CACHE_FILE = os.environ.get("MEMBERSHIP_CACHE_FILE")
+MEMBER_STATUSES = ("creator", "administrator", "member")
+ADMIN_STATUSES = ("creator", "administrator")
+
+if AWS_BACKEND == "memory":
+    store = AsyncStore(InMemoryBackend())
+else:
+    store = AsyncStore(AwsBackend(SQS_QUEUE, SNS_TOPIC, NEW_USERS_TABLE, ERRORS_TABLE))
+
+# Finished tracks reported by the download Lambda, None if it doesn't
+completions = get_completion_store(
+    store.backend.dynamodb if AWS_BACKEND != "memory" else None
+)
 
-session = boto3.Session(profile_name="LambdaFlowFullAccess")
-sqs_client = session.client("sqs", region_name="eu-west-2")
-sns_client = session.client("sns", region_name="eu-west-2")
-dynamodb = session.resource("dynamodb", region_name="eu-west-2")
-new_users_table = dynamodb.Table(NEW_USERS_TABLE)
-errors_table = dynamodb.Table(ERRORS_TABLE)
-queue_url = sqs_client.get_queue_url(QueueName=SQS_QUEUE)["QueueUrl"]
+playlist_cache = PlaylistCache(PLAYLIST_CACHE_SIZE, PLAYLIST_CACHE_TTL)
+# User ID -> status in the members channel, kept up to date by member_join_handler
+membership_cache = TTLCache(MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_CACHE_TTL)
+
+rate_limiter = RateLimiter(
+    chat_rate=1 / PLACEHOLDER_INTERVAL,
+    min_chat_rate=1 / MAX_PLACEHOLDER_INTERVAL,
+    shared=(
+        DynamoLimitState(store.backend.dynamodb.Table(RATE_LIMIT_TABLE))
+        if RATE_LIMIT_TABLE and AWS_BACKEND != "memory"
+        else None
+    ),
+)
 
 if DEBUG:
     logging.basicConfig(
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
         level=logging.INFO,
     )
-    logger = logging.getLogger(__name__)
+logger = logging.getLogger(__name__)
 
 
 async def download_image(url: str) -> bytes:
@@ -86,34 +136,57 @@ def create_dummy_audio():
     return buffer
 
 
-async def send_dummy_audio_message(
-    chat_id, context: ContextTypes.DEFAULT_TYPE, retry=0
-) -> int:
-    audio = create_dummy_audio()
-    try:
-        message = await context.bot.send_audio(chat_id, audio, title="Downloading...")
-        return message.id
+async def send_dummy_audio_message(chat_id, context: ContextTypes.DEFAULT_TYPE) -> int:
+    async def send():
+        try:
+            return await context.bot.send_audio(
+                chat_id, create_dummy_audio(), title="Downloading..."
+            )
+        except TimedOut:
+            # It may have been sent anyway, don't risk a duplicate placeholder
+            return None
 
-    except TimedOut:
-        pass
-    except Exception as e:
-        if isinstance(e, RetryAfter):
-            sleep_time = e.retry_after
-        else:
-            sleep_time = randint(3, 10)
-        if retry < MAX_RETRIES_FOR_SENDING_PLACEHOLDER_MESSAGE:
-            await asyncio.sleep(sleep_time)
-            return await send_dummy_audio_message(chat_id, context, retry=retry + 1)
-        raise e
+    message = await rate_limiter.call(
+        chat_id, send, retries=MAX_RETRIES_FOR_SENDING_PLACEHOLDER_MESSAGE
+    )
+    return message.id if message is not None else None
+
+
+def cache_membership(user_id, status):
+    ttl = MEMBERSHIP_CACHE_TTL if status in MEMBER_STATUSES else NON_MEMBER_CACHE_TTL
+    membership_cache.put(user_id, status, ttl)
 
 
 async def check_membership(update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = MEMBERS_CHANNEL_ID
     user_id = update.effective_user.id
-    chat_member = await context.bot.get_chat_member(chat_id, user_id)
-    member = chat_member.status in ["creator", "administrator", "member"]
-    admin = chat_member.status in ["creator", "administrator"]
-    return member, admin
+    status = membership_cache.get(user_id)
+    if status is None:
+        chat_member = await context.bot.get_chat_member(MEMBERS_CHANNEL_ID, user_id)
+        status = chat_member.status
+        cache_membership(user_id, status)
+    return status in MEMBER_STATUSES, status in ADMIN_STATUSES
+
+
+def load_membership_cache():
+    try:
+        with open(MEMBERSHIP_CACHE_FILE) as f:
+            membership_cache.restore(json.load(f))
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logger.warning(f"Cannot load the membership cache ({e})")
+        return
+    logger.info(f"Loaded {len(membership_cache)} cached memberships")
+
+
+def save_membership_cache():
+    tmp = f"{MEMBERSHIP_CACHE_FILE}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(membership_cache.snapshot(), f)
+        os.replace(tmp, MEMBERSHIP_CACHE_FILE)
+    except OSError as e:
+        logger.warning(f"Cannot save the membership cache ({e})")
 
 
 def parse_message_for_urls(message):
@@ -122,76 +195,254 @@ def parse_message_for_urls(message):
         yield url
 
 
+def is_too_large(entry: PlaylistEntry) -> bool:
+    """Whether the download Lambda would reject the track, estimated from the
+    flat metadata so it's never queued. Nothing is, while it splits tracks that
+    are too long into parts."""
+    return not SPLIT_LARGE_FILES and bool(entry.duration) and too_long(entry.duration)
+
+
 async def playlist_info(url, bot, chat_id, max_tracks=None):
-    with yt_dlp.YoutubeDL({"extract_flat": True}) as flat:
-        info = flat.extract_info(url, download=False)
-        title = info["title"]
-        count = info["playlist_count"]
-        release_year = info.get("release_year")
-        if max_tracks and count > max_tracks:
-            await bot.send_message(
+    with span("playlist_info", url=url) as lookup:
+        info = await playlist_cache.get(url)
+        lookup.set(tracks=info.count)
+    title = info.title
+    count = info.count
+    release_year = info.release_year
+    if max_tracks and count > max_tracks:
+        await rate_limiter.call(
+            chat_id,
+            lambda: bot.send_message(
                 chat_id,
                 f"Sorry, I can't download playlists with more than {max_tracks} tracks.",
+            ),
+        )
+        return
+    message = helpers.escape_markdown(
+        f"{title} ({count} tracks){' (' + release_year + ')' if release_year else ''}"
+    )
+    try:
+        if info.thumbnails:
+            try:
+                image_url = info.thumbnails[-2]["url"]
+            except IndexError:
+                image_url = info.thumbnails[0]["url"]
+            image_content = await download_image(image_url)
+            await rate_limiter.call(
+                chat_id, lambda: bot.send_photo(chat_id, image_content, caption=message)
             )
-        message = helpers.escape_markdown(
-            f"{title} ({count} tracks){' (' + release_year + ')' if release_year else ''}"
+    except Exception:
+        await rate_limiter.call(chat_id, lambda: bot.send_message(chat_id, message))
+
+    too_large = [entry for entry in info.entries if is_too_large(entry)]
+    if too_large:
+        titles = "\n".join(entry.title or entry.url for entry in too_large)
+        await rate_limiter.call(
+            chat_id,
+            lambda: bot.send_message(
+                chat_id, f"Skipping tracks that are too large:\n{titles}"
+            ),
         )
-        try:
-            if info.get("thumbnails"):
-                try:
-                    image_url = info["thumbnails"][-2]["url"]
-                except IndexError:
-                    image_url = info["thumbnails"][0]["url"]
-                image_content = await download_image(image_url)
-                await bot.send_photo(chat_id, image_content, caption=message)
-        except Exception:
-            await bot.send_message(chat_id, message)
-
-        for entry in info["entries"]:
-            yield entry["url"]
 
+    for entry in info.entries:
+        if not is_too_large(entry):
+            yield entry
 
-def save_init_message_data(user_id, message_id):
-    new_users_table.put_item(Item={"user_id": user_id, "message_id": message_id})
 
+class QueuedAudio(NamedTuple):
+    audio_url: str
+    message_attrs: dict
+    message_group_id: str
 
-def get_init_message_data(user_id):
-    row = new_users_table.get_item(Key={"user_id": user_id})
-    return row["Item"] if "Item" in row else None
 
-
-async def queue_single_url(
-    update, context, message_attrs, message_group_id, audio_url, queue_url
+def queued_audio(
+    message_attrs, message_group_id, audio_url, placeholder_audio_id, cache_key=None
 ):
-    placeholder_audio_id = await send_dummy_audio_message(
-        update.effective_chat.id, context
-    )
     current_message = message_attrs.copy()
     current_message["placeholder_audio_id"] = {
         "DataType": "String",
         "StringValue": str(placeholder_audio_id),
     }
+    if cache_key:
+        # Already known from the playlist metadata, saves the worker resolving it
+        current_message["cache_key"] = {"DataType": "String", "StringValue": cache_key}
+    return QueuedAudio(audio_url, current_message, message_group_id)
+
+
+async def publish_batch(messages: list[QueuedAudio]):
+    """Publish up to QUEUE_BATCH_SIZE messages in a single SNS/SQS request"""
+    with span("enqueue", messages=len(messages)):
+        if failed := await _publish_batch(messages):
+            urls = [message.audio_url for message in failed]
+            raise RuntimeError(f"Failed to queue {', '.join(urls)}")
+
+
+async def _publish_batch(messages: list[QueuedAudio]) -> list[QueuedAudio]:
+    """Returns the messages SNS/SQS didn't accept"""
     if not USE_SQS:
-        sns_client.publish(
-            TopicArn=SNS_TOPIC, Message=audio_url, MessageAttributes=current_message
+        response = await store.publish_batch(
+            [
+                {
+                    "Id": str(i),
+                    "Message": message.audio_url,
+                    "MessageAttributes": message.message_attrs,
+                }
+                for i, message in enumerate(messages)
+            ]
         )
     else:
-        message_deduplication_id = str(uuid4())
-        sqs_client.send_message(
-            QueueUrl=queue_url,
-            MessageBody=audio_url,
-            MessageAttributes=current_message,
-            MessageGroupId=message_group_id,
-            MessageDeduplicationId=message_deduplication_id,
+        response = await store.send_message_batch(
+            [
+                {
+                    "Id": str(i),
+                    "MessageBody": message.audio_url,
+                    "MessageAttributes": message.message_attrs,
+                    "MessageGroupId": message.message_group_id,
+                    "MessageDeduplicationId": str(uuid4()),
+                }
+                for i, message in enumerate(messages)
+            ]
+        )
+    return [messages[int(entry["Id"])] for entry in response.get("Failed", [])]
+
+
+def error_row(message: QueuedAudio, error) -> dict:
+    """Errors table row for a track that never reached the download Lambda, due
+    for the next retry sweep"""
+    attrs = message.message_attrs
+    return {
+        "chat_id": int(attrs["chat_id"]["StringValue"]),
+        "message_id": int(attrs["placeholder_audio_id"]["StringValue"]),
+        "video_url": message.audio_url,
+        "attempts": 0,
+        "next_retry": int(time.time()),
+        "error": error,
+    }
+
+
+async def save_unqueued(messages: list[QueuedAudio], error):
+    """Record tracks that couldn't be queued in the errors table, where the
+    retry sweep (or the user's /retry) queues them again"""
+    try:
+        await store.put_errors([error_row(message, error) for message in messages])
+    except Exception as e:
+        urls = ", ".join(message.audio_url for message in messages)
+        logger.error(f"Lost {len(messages)} tracks ({urls}): {e}")
+
+
+async def dispatch_failed(messages: list[QueuedAudio]):
+    await save_unqueued(messages, "Failed to queue")
+
+
+def dispatch_id(message: QueuedAudio) -> str:
+    return message.message_attrs["dispatch_id"]["StringValue"]
+
+
+async def completed_dispatches(dispatch_ids) -> set[str]:
+    return await asyncio.to_thread(completions.completed, dispatch_ids)
+
+
+dispatcher = Dispatcher(
+    publish_batch,
+    FairQueue(),
+    batch_size=QUEUE_BATCH_SIZE,
+    on_failure=dispatch_failed,
+    completed=completed_dispatches if completions else None,
+    dispatch_id=dispatch_id,
+)
+
+
+async def enqueue(messages: list[QueuedAudio], update, kind):
+    """Hand tracks to the scheduler, which publishes them fairly between users
+    ("single" tracks ahead of "playlist" ones) as download capacity frees up.
+    Tracks that can't be published, with or without the scheduler, end up in
+    the errors table (see save_unqueued)."""
+    if SCHEDULE_DOWNLOADS:
+        if completions:
+            # Reported back by the download Lambda once the track is done
+            for message in messages:
+                message.message_attrs["dispatch_id"] = {
+                    "DataType": "String",
+                    "StringValue": str(uuid4()),
+                }
+        dispatcher.submit(
+            messages, update.effective_user.id, update.effective_chat.id, kind
         )
+        return
+    for i in range(0, len(messages), QUEUE_BATCH_SIZE):
+        await publish_now(messages[i : i + QUEUE_BATCH_SIZE])
+
+
+async def publish_now(messages: list[QueuedAudio]):
+    """Publish a batch without the scheduler. Tracks SNS/SQS doesn't accept go
+    to the errors table straight away, for the retry sweep, as the scheduler's
+    do once it gives up on them."""
+    with span("enqueue", messages=len(messages)):
+        try:
+            failed = await _publish_batch(messages)
+        except Exception as e:
+            logger.error(f"Queueing {len(messages)} tracks failed: {e}")
+            failed = messages
+    if failed:
+        await save_unqueued(failed, "Failed to queue")
+
+
+async def queue_single_url(update, context, message_attrs, message_group_id, audio_url):
+    with span("placeholder"):
+        placeholder_audio_id = await send_dummy_audio_message(
+            update.effective_chat.id, context
+        )
+    await enqueue(
+        [
+            queued_audio(
+                message_attrs, message_group_id, audio_url, placeholder_audio_id
+            )
+        ],
+        update,
+        "single",
+    )
+
+
+async def queue_playlist(update, context, message_attrs, url):
+    """Send a placeholder per track, paced by `rate_limiter`, and queue the
+    tracks in batches as soon as each batch has its placeholders"""
+    batch = []
+    async for playlist_entry in playlist_info(
+        url,
+        context.bot,
+        update.effective_chat.id,
+        max_tracks=MAXIMUM_PLAYLIST_LENGTH,
+    ):
+        with span("placeholder"):
+            placeholder_audio_id = await send_dummy_audio_message(
+                update.effective_chat.id, context
+            )
+        batch.append(
+            queued_audio(
+                message_attrs,
+                # A group per track, or SQS FIFO would deliver the playlist one
+                # track at a time; the scheduler caps the chat's concurrency
+                f"{update.effective_chat.id}-{playlist_entry.url}",
+                playlist_entry.url,
+                placeholder_audio_id,
+                playlist_entry.cache_key,
+            )
+        )
+        if len(batch) == QUEUE_BATCH_SIZE:
+            await enqueue(batch, update, "playlist")
+            batch = []
+    if batch:
+        await enqueue(batch, update, "playlist")
 
 
 async def member_join_handler(update, context: ContextTypes.DEFAULT_TYPE):
     new_chat_member = update.chat_member.new_chat_member
+    user_id = new_chat_member.user.id
+    # Joins, leaves, kicks and promotions all take effect straight away
+    cache_membership(user_id, new_chat_member.status)
     if new_chat_member.status != new_chat_member.MEMBER:
         return
-    user_id = new_chat_member.user.id
-    data = get_init_message_data(user_id)
+    data = await store.get_init_message_data(user_id)
     if not data:
         return
 
@@ -200,61 +451,137 @@ async def member_join_handler(update, context: ContextTypes.DEFAULT_TYPE):
         text="Channel Joined ✅", url=MEMBERS_CHANNEL_LINK
     )
     await context.bot.edit_message_text(
-        text=f"Congratulations! 🎉 You are now a member! Send me a link to a YouTube video/playlist, and I'll send you the MP3(s)! 🎵🎧",
+        text=f"Congratulations! 🎉 You are now a member! Send me a link to a YouTube video/playlist, and I'll send you the audio! 🎵🎧",
         chat_id=user_id,
         message_id=message_id,
         reply_markup=InlineKeyboardMarkup([[success_button]]),
     )
-    new_users_table.delete_item(Key={"user_id": user_id})
+    await store.delete_init_message_data(user_id)
 
 
 async def instructions(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(
         update.effective_chat.id,
-        "Send me a link to a YouTube video or playlist, and I'll send you the MP3(s)! "
+        "Send me a link to a YouTube video or playlist, and I'll send you the audio! "
         "Messages may contain multiple URLs. Messages without URLs (that are not commands "
-        "e.g. /start) will be ignored. There is a maximum file size of 50MB, and a maximum "
-        f"playlist length of {MAXIMUM_PLAYLIST_LENGTH} tracks. ",
+        "e.g. /start) will be ignored. "
+        + (
+            f"Tracks over {MAX_FILE_SIZE // 1_000_000}MB are sent in parts. "
+            if SPLIT_LARGE_FILES
+            else f"There is a maximum file size of {MAX_FILE_SIZE // 1_000_000}MB. "
+        )
+        + f"There is a maximum playlist length of {MAXIMUM_PLAYLIST_LENGTH} tracks.",
     )
 
 
-async def retry_all_failures(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    response = errors_table.query(
-        dynamodb.conditions.Key("chat_id").eq(update.effective_chat.id)
+def retry_message(item) -> QueuedAudio:
+    """Queue message for an error row. `attempts` goes with it, so if the track
+    fails again the download Lambda can record when it's next due."""
+    chat_id = int(item["chat_id"])
+    message_attrs = {
+        "chat_id": {"DataType": "String", "StringValue": str(chat_id)},
+        "placeholder_audio_id": {
+            "DataType": "String",
+            "StringValue": str(item["message_id"]),
+        },
+        "correlation_id": {"DataType": "String", "StringValue": new_correlation_id()},
+        "attempts": {
+            "DataType": "String",
+            "StringValue": str(int(item.get("attempts", 0)) + 1),
+        },
+    }
+    return QueuedAudio(
+        item["video_url"], message_attrs, f"{chat_id}-{item['video_url']}"
     )
-    for item in response["Items"]:
-        video_url = item["video_url"]
-        message_id = item["message_id"]
-        message_attrs = {
-            "chat_id": {
-                "DataType": "String",
-                "StringValue": str(update.effective_chat.id),
-            },
-            "placeholder_audio_id": {
-                "DataType": "String",
-                "StringValue": str(message_id),
-            },
-        }
+
+
+async def retry_failures(items) -> list[dict]:
+    """Republish error rows in PublishBatch-sized batches, up to
+    RETRY_CONCURRENCY batches at once, and delete the rows of the ones that were
+    queued with BatchWriteItem. Returns the rows that couldn't be queued."""
+    semaphore = asyncio.Semaphore(RETRY_CONCURRENCY)
+
+    async def retry_batch(batch):
+        messages = [retry_message(item) for item in batch]
+        async with semaphore:
+            try:
+                failed = await _publish_batch(messages)
+            except Exception as e:
+                logger.error(f"Failed to retry {len(batch)} messages: {e}")
+                return batch
+            queued = [item for item, m in zip(batch, messages) if m not in failed]
+            await store.delete_errors(queued)
+        return [item for item, m in zip(batch, messages) if m in failed]
+
+    results = await asyncio.gather(
+        *(
+            retry_batch(items[i : i + QUEUE_BATCH_SIZE])
+            for i in range(0, len(items), QUEUE_BATCH_SIZE)
+        )
+    )
+    return [item for failed in results for item in failed]
+
+
+async def retry_all_failures(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with span("retry", chat_id=update.effective_chat.id) as retry:
+        items = await store.query_errors(update.effective_chat.id)
+        failed = await retry_failures(items)
+        retry.set(errors=len(items), failed=len(failed))
+    if failed:
+        urls = "\n".join(item["video_url"] for item in failed)
+        await context.bot.send_message(
+            update.effective_chat.id, f"Failed to retry:\n{urls}"
+        )
+
+
+async def retry_sweep():
+    """Every RETRY_SWEEP_INTERVAL seconds, retry the failures that are due
+    again (backing off after each attempt) until MAX_AUTO_RETRIES. Anything
+    left after that waits for the user's /retry."""
+    while True:
+        await asyncio.sleep(RETRY_SWEEP_INTERVAL)
         try:
-            sns_client.publish(
-                TopicArn=SNS_TOPIC, Message=video_url, MessageAttributes=message_attrs
-            )
-            errors_table.delete_item(
-                Key={"chat_id": update.effective_chat.id, "message_id": message_id}
-            )
+            with span("retry_sweep") as sweep:
+                items = await store.scan_due_errors(time.time(), MAX_AUTO_RETRIES)
+                failed = await retry_failures(items)
+                sweep.set(errors=len(items), failed=len(failed))
         except Exception as e:
-            logger.error(f"Failed to retry message {message_id}: {e}")
-            await context.bot.send_message(
-                update.effective_chat.id, f"Failed to retry {video_url}: {e}"
-            )
-        await asyncio.sleep(2)
+            logger.error(f"Retry sweep failed: {e}")
+
+
+# Started by start_background_tasks, cancelled by stop_background_tasks
+background_tasks: list[asyncio.Task] = []
+
+
+async def start_background_tasks(application: Application):
+    if MEMBERSHIP_CACHE_FILE:
+        load_membership_cache()
+    if RETRY_SWEEP_INTERVAL:
+        background_tasks.append(application.create_task(retry_sweep()))
+
+
+async def stop_background_tasks(application: Application):
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    if MEMBERSHIP_CACHE_FILE:
+        save_membership_cache()
+    # Tracks still waiting in the scheduler would be lost with the process (as
+    # they are if it's killed outright). Their placeholders have been sent, so
+    # hand them to the retry sweep.
+    if unsent := dispatcher.drain():
+        logger.info(f"Saving {len(unsent)} unqueued tracks for the retry sweep")
+        await save_unqueued(unsent, "Bot stopped before queueing")
 
 
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    member, admin = await check_membership(update, context)
+    with span("membership"):
+        member, admin = await check_membership(update, context)
     is_own_chat = update.effective_chat.id == update.effective_user.id
     if not admin and not is_own_chat:
-        bot_username = (await context.bot.get_me()).username
+        # Fetched once, by get_me when the application was initialised
+        bot_username = context.bot.username
         await update.message.reply_text(
             f"Sorry, {update.effective_user.first_name}, you are not permitted use this bot in groups.\n@{bot_username} <- click here to open a private chat.",
         )
@@ -269,12 +596,12 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "You must be a member to use this bot. Click the button to join the members channel. (By joining the channel you will be automatically allowed to use the bot.)",
             reply_markup=keyboard,
         )
-        save_init_message_data(update.effective_user.id, message.message_id)
+        await store.save_init_message_data(update.effective_user.id, message.message_id)
         return
 
     if update.message.text == "/start":
         message_prefix = f"You're already {'an admin' if admin else 'a member'}! "
-        message = "Send me a link and I'll send you the MP3!"
+        message = "Send me a link and I'll send you the audio!"
         if is_own_chat:
             message = message_prefix + message
         await context.bot.send_message(
@@ -290,34 +617,27 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "Sorry, I can't download from Spotify 😢",
             )
             continue
+        # Follows the link through the download and send Lambdas
+        correlation_id.set(new_correlation_id())
         message_attrs = {
             "chat_id": {
                 "DataType": "String",
                 "StringValue": str(update.effective_chat.id),
-            }
+            },
+            "correlation_id": {
+                "DataType": "String",
+                "StringValue": correlation_id.get(),
+            },
         }
         message_group_id = f"{update.effective_chat.id}-{url}"
         try:
-            if "playlist" in url:
-                async for playlist_entry_url in playlist_info(
-                    url,
-                    context.bot,
-                    update.effective_chat.id,
-                    max_tracks=MAXIMUM_PLAYLIST_LENGTH,
-                ):
+            with span("queue", url=url, chat_id=update.effective_chat.id):
+                if "playlist" in url:
+                    await queue_playlist(update, context, message_attrs, url)
+                else:
                     await queue_single_url(
-                        update,
-                        context,
-                        message_attrs,
-                        message_group_id,
-                        playlist_entry_url,
-                        queue_url,
+                        update, context, message_attrs, message_group_id, url
                     )
-                    await asyncio.sleep(2)
-            else:
-                await queue_single_url(
-                    update, context, message_attrs, message_group_id, url, queue_url
-                )
         except Exception as e:
             error_message = helpers.escape_markdown(str(e))
             await context.bot.send_message(
@@ -327,7 +647,16 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 def build_bot(token: str) -> Application:
-    application = ApplicationBuilder().token(token).build()
+    # Updates are handled concurrently, so one user's playlist doesn't hold up
+    # everyone else's messages
+    application = (
+        ApplicationBuilder()
+        .token(token)
+        .concurrent_updates(True)
+        .post_init(start_background_tasks)
+        .post_shutdown(stop_background_tasks)
+        .build()
+    )
     application.add_handler(
         ChatMemberHandler(
             member_join_handler,
@@ -0,0 +1,12 @@
+import os
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# The download Lambda's modules, and the top-level ones deploy-lambda.sh copies in
+sys.path[:0] = [str(ROOT / "dlbot-lambda"), str(ROOT)]
+os.environ.setdefault("BOT_TOKEN", "123456:test")
+os.environ.setdefault("ERRORS_TABLE", "errors")
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-2")
+os.environ.setdefault("TRACING", "false")
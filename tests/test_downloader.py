@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+import downloader
+
+VIDEO = {
+    "id": "bgWUwywrXOM",
+    "title": "Artist - Track",
+    "extractor": "youtube",
+    "extractor_key": "Youtube",
+    "duration": 200,
+    "formats": [
+        {"format_id": "140", "vcodec": "none", "acodec": "mp4a.40.2", "abr": 128}
+    ],
+}
+MIX_URL = "https://www.youtube.com/watch?v=bgWUwywrXOM&list=RDbgWUwywrXOM"
+
+
+VIDEO_STUB = {
+    "_type": "url",
+    "url": "https://www.youtube.com/watch?v=bgWUwywrXOM",
+    "ie_key": "Youtube",
+    "id": "bgWUwywrXOM",
+}
+RESULTS = {
+    # What YoutubeTabIE returns for a mix link without processing: a playlist
+    # whose entries are `url` stubs, with no extractor
+    MIX_URL: lambda: {"_type": "playlist", "entries": iter([VIDEO_STUB])},
+    VIDEO_STUB["url"]: lambda: VIDEO,
+    "https://example.com/embed": lambda: {
+        "_type": "url_transparent",
+        "url": VIDEO_STUB["url"],
+        "title": "Embedded title",
+    },
+}
+
+
+class FakeDownloader:
+    def __init__(self, options, cache_cls=None):
+        self.options = options
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def extract_info(self, url, download=True, ie_key=None, process=True):
+        assert not process
+        return RESULTS[url]()
+
+    def process_ie_result(self, result, download=True):
+        home = self.options["paths"]["home"]
+        path = os.path.join(home, f"{result['id']}.download.m4a")
+        with open(path, "wb") as f:
+            f.write(b"audio")
+        return {**result, "requested_downloads": [{"filepath": path}]}
+
+
+@pytest.fixture(autouse=True)
+def fake_downloader(monkeypatch):
+    monkeypatch.setattr(downloader, "Downloader", FakeDownloader)
+
+
+def test_playlist_entry_url_stub_is_resolved(tmp_path):
+    url, info, filepath, plan = downloader.download_audio(MIX_URL, str(tmp_path))
+    assert info["id"] == "bgWUwywrXOM"
+    assert plan.format == "140"
+    assert os.path.exists(filepath)
+
+
+def test_cache_is_checked_with_the_resolved_key(tmp_path):
+    looked_up = []
+    result = downloader.download_audio(
+        MIX_URL, str(tmp_path), cached=lambda key: looked_up.append(key) or True
+    )
+    assert looked_up == ["youtube/bgWUwywrXOM"]
+    assert result == downloader.Cached(MIX_URL, "youtube/bgWUwywrXOM")
+
+
+def test_url_transparent_keeps_outer_metadata(tmp_path):
+    _, info, _, _ = downloader.download_audio(
+        "https://example.com/embed", str(tmp_path)
+    )
+    assert info["title"] == "Embedded title"
+    assert info["extractor_key"] == "Youtube"
@@ -0,0 +1,59 @@
+import asyncio
+
+from completions import SQLiteCompletionStore
+from scheduler import Dispatcher, FairQueue
+
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 5))
+
+
+def test_slots_held_until_completion_reported(tmp_path):
+    store = SQLiteCompletionStore(str(tmp_path / "completions.sqlite3"))
+    sent = []
+
+    async def send(payloads):
+        sent.extend(payloads)
+
+    async def completed(ids):
+        return store.completed(ids)
+
+    async def main():
+        dispatcher = Dispatcher(
+            send,
+            FairQueue(max_in_flight=2),
+            completed=completed,
+            dispatch_id=lambda payload: payload,
+            poll_interval=0.01,
+        )
+        dispatcher.submit(["a1", "a2"], 1, 1, "playlist")
+        dispatcher.submit(["b1"], 2, 2, "single")
+        await asyncio.sleep(0.1)
+        # Two chats contend, so the third track waits for a free slot
+        assert len(sent) == 2
+        store.complete(sent[0])
+        await asyncio.sleep(0.1)
+        assert len(sent) == 3
+        for dispatch_id in sent[1:]:
+            store.complete(dispatch_id)
+        await dispatcher.join()
+
+    run(main())
+    assert sorted(sent) == ["a1", "a2", "b1"]
+
+
+def test_without_completions_nothing_is_held():
+    sent = []
+
+    async def send(payloads):
+        sent.extend(payloads)
+
+    async def main():
+        dispatcher = Dispatcher(send, FairQueue(max_in_flight=1), batch_size=1)
+        dispatcher.submit(["a1", "a2"], 1, 1, "playlist")
+        dispatcher.submit(["b1"], 2, 2, "single")
+        await dispatcher.join()
+
+    run(main())
+    # The single link goes out ahead of the playlist, and nothing waits on a cap
+    assert sent == ["b1", "a1", "a2"]
@@ -0,0 +1,18 @@
+from single_flight import SQLiteLeaseStore
+
+
+def test_renew_keeps_the_lease(tmp_path):
+    leases = SQLiteLeaseStore(str(tmp_path / "leases.sqlite3"))
+    assert leases.acquire("key", "a", ttl=0)
+    # Renewed before anyone else asks, so the lease hasn't expired
+    assert leases.renew("key", "a", ttl=60)
+    assert not leases.acquire("key", "b")
+
+
+def test_renew_after_takeover_fails(tmp_path):
+    leases = SQLiteLeaseStore(str(tmp_path / "leases.sqlite3"))
+    assert leases.acquire("key", "a", ttl=-1)
+    assert leases.acquire("key", "b")
+    assert not leases.renew("key", "a")
+    leases.release("key", "a")
+    assert not leases.acquire("key", "c")
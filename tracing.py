@@ -0,0 +1,95 @@
+import json
+import os
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+SERVICE = os.environ.get("TRACING_SERVICE", "bot")
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "dlbot")
+TRACING = os.environ.get("TRACING", "true").lower() == "true"
+
+# Field -> CloudWatch unit, for the span fields that are published as metrics
+METRICS = {"Duration": "Milliseconds", "Bytes": "Bytes", "Retries": "Count"}
+
+# Carried between services in the "correlation_id" message attribute
+correlation_id: ContextVar[str | None] = ContextVar("correlation_id", default=None)
+_current_span: ContextVar["Span | None"] = ContextVar("span", default=None)
+
+
+def new_correlation_id() -> str:
+    return uuid.uuid4().hex
+
+
+class Span:
+    def __init__(self, stage, fields):
+        self.stage = stage
+        self.fields = fields
+
+    def add(self, name, value=1):
+        self.fields[name] = self.fields.get(name, 0) + value
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+
+def emit(stage, duration, outcome, fields):
+    """Write one span as a CloudWatch embedded metric format (EMF) line.
+    It goes to stdout rather than through logging, whose prefix would stop
+    CloudWatch parsing it."""
+    fields = dict(fields)
+    metrics = {"Duration": round(duration * 1000, 3)}
+    if "bytes" in fields:
+        metrics["Bytes"] = fields.pop("bytes")
+    if "retries" in fields:
+        metrics["Retries"] = fields.pop("retries")
+    record = {
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [
+                {
+                    "Namespace": NAMESPACE,
+                    "Dimensions": [["Service", "Stage"]],
+                    "Metrics": [
+                        {"Name": name, "Unit": METRICS[name]} for name in metrics
+                    ],
+                }
+            ],
+        },
+        "Service": SERVICE,
+        "Stage": stage,
+        "Outcome": outcome,
+        "CorrelationId": correlation_id.get(),
+        **metrics,
+        **fields,
+    }
+    sys.stdout.write(json.dumps(record, default=str) + "\n")
+    sys.stdout.flush()
+
+
+@contextmanager
+def span(stage, **fields):
+    """Time the block as `stage`. `bytes` and `retries` fields (set up front, or
+    later with `Span.add`/`add`) are published as metrics, the rest are logged
+    alongside them."""
+    current = Span(stage, fields)
+    token = _current_span.set(current)
+    outcome = "ok"
+    started = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        outcome = "error"
+        current.fields["error"] = e.__class__.__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        if TRACING:
+            emit(stage, time.perf_counter() - started, outcome, current.fields)
+
+
+def add(name, value=1):
+    """Add to a counter on the innermost open span, if there is one"""
+    if (current := _current_span.get()) is not None:
+        current.add(name, value)
@@ -0,0 +1,187 @@
+"""Webhook ingress for the bot, instead of `telegram_bot.run_polling`.
+
+Telegram POSTs each update to WEBHOOK_PATH. The request is acknowledged as soon
+as the update is queued, so a slow handler never holds up Telegram's delivery.
+WEBHOOK_CONCURRENCY tasks take updates off the queue and run them through the
+Application from `telegram_bot.build_bot`. The queue is bounded
+(WEBHOOK_QUEUE_SIZE). When it is full the update is refused with a 503 and
+Telegram delivers it again later, rather than piling up in memory.
+
+    python webhook.py --workers 4 --port 8080 --set-webhook
+
+Each worker is a process with its own Application, all listening on the same
+port (SO_REUSEPORT), so they can also be spread over hosts behind a load
+balancer. Only the first worker runs the retry sweep. Per-process state (the
+membership and playlist caches, the fair scheduler) isn't shared between
+workers. Set RATE_LIMIT_TABLE so they share Telegram's rate limits.
+"""
+
+import argparse
+import asyncio
+import hmac
+import logging
+import multiprocessing
+import os
+import signal
+
+from aiohttp import web
+from telegram import Bot, Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # Public URL Telegram posts to
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_QUEUE_SIZE = int(os.environ.get("WEBHOOK_QUEUE_SIZE", 1000))
+# Updates handled at once per worker, like concurrent_updates when polling
+WEBHOOK_CONCURRENCY = int(os.environ.get("WEBHOOK_CONCURRENCY", 256))
+# Most concurrent connections Telegram opens to the webhook (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", 40))
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def make_web_app(application: Application, updates: asyncio.Queue, secret):
+    async def receive(request: web.Request) -> web.Response:
+        token = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(token.encode(), secret.encode()):
+            return web.Response(status=403)
+        try:
+            update = Update.de_json(await request.json(), application.bot)
+        except ValueError:
+            return web.Response(status=400)
+        try:
+            updates.put_nowait(update)
+        except asyncio.QueueFull:
+            return web.Response(status=503)
+        return web.Response()
+
+    web_app = web.Application()
+    web_app.router.add_post(WEBHOOK_PATH, receive)
+    return web_app
+
+
+async def dispatch(application: Application, updates: asyncio.Queue):
+    while True:
+        update = await updates.get()
+        try:
+            await application.process_update(update)
+        except Exception as e:
+            logger.error(f"Failed to process update: {e}", exc_info=e)
+        finally:
+            updates.task_done()
+
+
+async def serve(
+    application: Application,
+    host,
+    port,
+    secret,
+    stop: asyncio.Event,
+    queue_size=WEBHOOK_QUEUE_SIZE,
+    concurrency=WEBHOOK_CONCURRENCY,
+):
+    """Handle updates posted to the webhook with `application` until `stop` is
+    set, up to `concurrency` at once"""
+    updates = asyncio.Queue(queue_size)
+    await application.initialize()
+    # Called by run_polling/run_webhook, which aren't used here
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    dispatchers = [
+        asyncio.create_task(dispatch(application, updates)) for _ in range(concurrency)
+    ]
+    runner = web.AppRunner(make_web_app(application, updates, secret))
+    await runner.setup()
+    await web.TCPSite(runner, host, port, reuse_port=True).start()
+    logger.info(f"Listening for updates on {host}:{port}{WEBHOOK_PATH}")
+    try:
+        await stop.wait()
+    finally:
+        await runner.cleanup()  # Stop taking updates, then finish the queued ones
+        await updates.join()
+        for task in dispatchers:
+            task.cancel()
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+
+
+def bot_token() -> str:
+    # Imported where it's needed: importing telegram_bot connects to AWS
+    import telegram_bot
+
+    return (
+        telegram_bot.DEBUG_BOT_TOKEN if telegram_bot.DEBUG else telegram_bot.BOT_TOKEN
+    )
+
+
+async def set_webhook(url, secret):
+    async with Bot(bot_token()) as bot:
+        await bot.set_webhook(
+            url,
+            secret_token=secret,
+            allowed_updates=Update.ALL_TYPES,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+        )
+    logger.info(f"Webhook set to {url}")
+
+
+def run_worker(index, host, port, secret):
+    logging.basicConfig(
+        format="%(asctime)s - %(process)d - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO,
+    )
+    import telegram_bot
+
+    if index:
+        telegram_bot.RETRY_SWEEP_INTERVAL = 0  # One sweep is enough
+    application = telegram_bot.build_bot(bot_token())
+
+    async def main():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+        await serve(application, host, port, secret, stop)
+
+    asyncio.run(main())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--workers", type=int, default=1, help="Processes")
+    parser.add_argument(
+        "--set-webhook", action="store_true", help="Point Telegram at WEBHOOK_URL"
+    )
+    args = parser.parse_args(argv)
+    if not WEBHOOK_SECRET:
+        parser.error("WEBHOOK_SECRET must be set")
+
+    if args.set_webhook:
+        asyncio.run(set_webhook(WEBHOOK_URL, WEBHOOK_SECRET))
+
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(
+            target=run_worker, args=(i, args.host, args.port, WEBHOOK_SECRET)
+        )
+        for i in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    # Pass `docker stop`'s SIGTERM on, the workers drain before exiting
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(
+        signal.SIGTERM, lambda *_: [process.terminate() for process in processes]
+    )
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()